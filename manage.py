@@ -0,0 +1,142 @@
+"""
+    Manage
+    ~~~~~~
+    Maintenance commands, ie.,
+    
+        $ python manage.py rebuild_rollups
+"""
+import argparse
+import time
+
+from sqlalchemy.engine.reflection import Inspector
+
+from mapmystairs import app, db
+from mapmystairs.imports import import_user_workouts
+from mapmystairs.models import User
+from mapmystairs.snapshot import write_leaderboard_snapshot
+from mapmystairs.submissions import process_workout_submissions
+from mapmystairs.utils import (compact_leaderboard_buckets,
+                               rebuild_leaderboard_rollups)
+
+
+# commands
+def compact_buckets(args):
+    """
+    Compact old daily leaderboard buckets into monthly buckets
+    """
+    months = compact_leaderboard_buckets(stairwell_id=args.stairwell_id,
+                                         retention_days=args.days)
+    print "Compacted %s monthly buckets" % months
+
+
+def create_indexes(args):
+    """
+    Create indexes declared on the models that are missing from existing
+    tables (db.create_all only creates new tables)
+    """
+    inspector = Inspector.from_engine(db.engine)
+    table_names = inspector.get_table_names()
+    
+    for table in db.metadata.sorted_tables:
+        if table.name not in table_names:
+            continue
+        
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                print "Creating index %s on %s" % (index.name, table.name)
+                index.create(db.engine)
+
+
+def import_workouts(args):
+    """
+    Import stair workouts logged through other MMF apps
+    """
+    users = User.query
+    if not args.all_users:
+        users = users.filter(User.id.in_(args.user_id or []))
+    
+    for user in users:
+        imported = import_user_workouts(user, concurrency=args.concurrency)
+        print "Imported %s workouts of %s" % (imported, user)
+
+
+def process_submissions(args):
+    """
+    Post queued workouts to the MMF API
+    """
+    while True:
+        processed = process_workout_submissions()
+        db.session.remove()
+        
+        if not args.forever:
+            print "Processed %s workout submissions" % processed
+            return
+        
+        if not processed:
+            time.sleep(app.config['WORKOUT_SUBMISSION_POLL_INTERVAL'])
+
+
+def rebuild_rollups(args):
+    """
+    Rebuild the leaderboard rollups from existing workouts
+    """
+    rebuild_leaderboard_rollups(stairwell_id=args.stairwell_id)
+
+
+def write_snapshot(args):
+    """
+    Write the leaderboard snapshot served after a restart
+    """
+    path = args.path or app.config['LEADERBOARD_SNAPSHOT_PATH']
+    started = time.time()
+    rows = write_leaderboard_snapshot(path)
+    print "Wrote %s rows to %s in %.2fs" % (rows, path, time.time() - started)
+
+
+# parser
+parser = argparse.ArgumentParser(description="MapMyStairs management")
+subparsers = parser.add_subparsers()
+
+compact_buckets_parser = subparsers.add_parser('compact_buckets',
+                                               help=compact_buckets.__doc__)
+compact_buckets_parser.add_argument('--stairwell-id', type=int)
+compact_buckets_parser.add_argument('--days', type=int,
+                                    help="keep daily buckets for N days")
+compact_buckets_parser.set_defaults(func=compact_buckets)
+
+create_indexes_parser = subparsers.add_parser('create_indexes',
+                                              help=create_indexes.__doc__)
+create_indexes_parser.set_defaults(func=create_indexes)
+
+import_workouts_parser = subparsers.add_parser('import_workouts',
+                                               help=import_workouts.__doc__)
+import_workouts_parser.add_argument('--user-id', type=int, action='append')
+import_workouts_parser.add_argument('--all-users', action='store_true')
+import_workouts_parser.add_argument('--concurrency', type=int, default=4,
+                                    help="pages fetched at the same time")
+import_workouts_parser.set_defaults(func=import_workouts)
+
+process_submissions_parser = subparsers.add_parser(
+                                'process_submissions',
+                                help=process_submissions.__doc__)
+process_submissions_parser.add_argument('--forever', action='store_true',
+                                        help="keep polling the queue")
+process_submissions_parser.set_defaults(func=process_submissions)
+
+rebuild_rollups_parser = subparsers.add_parser('rebuild_rollups',
+                                               help=rebuild_rollups.__doc__)
+rebuild_rollups_parser.add_argument('--stairwell-id', type=int)
+rebuild_rollups_parser.set_defaults(func=rebuild_rollups)
+
+write_snapshot_parser = subparsers.add_parser('write_snapshot',
+                                              help=write_snapshot.__doc__)
+write_snapshot_parser.add_argument(
+        '--path', help="defaults to LEADERBOARD_SNAPSHOT_PATH")
+write_snapshot_parser.set_defaults(func=write_snapshot)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with app.app_context():
+        args.func(args)
@@ -10,8 +10,8 @@ from flask.ext.cache import Cache
 
 import settings
 
-# set logging
-log_level = logging.DEBUG
+# set logging, see LOG_LEVEL in settings
+log_level = getattr(logging, settings.LOG_LEVEL.upper(), logging.INFO)
 log_format = "%(asctime)s [%(levelname)s] %(message)s:"
 logging.basicConfig(format=log_format, level=log_level)
 
@@ -24,12 +24,42 @@ app.config.from_object(settings)
 
 # Load SqlAlchemay
 db = SQLAlchemy(app)
+
+# read replica routing and connection checks, see mapmystairs/database.py
+from mapmystairs.database import init_database
+init_database(app)
  
 # set the secret key.  keep this really secret:
 app.secret_key = '001011!0 00011011 1100a111 10001111 10100101 1011y001'
 
-# cache
-cache = Cache(app,config={'CACHE_TYPE': 'simple'})
+# cache, see CACHE_TYPE in settings
+cache = Cache(app)
+
+# sessions and active climbs, kept apart from the leaderboards so they're
+# never evicted, see SESSION_CACHE_TYPE in settings
+session_cache = Cache(app, with_jinja2_ext=False, config={
+    'CACHE_TYPE': app.config['SESSION_CACHE_TYPE'],
+    'CACHE_DIR': app.config['SESSION_CACHE_DIR']})
+
+# server-side sessions, the cookie only holds the session id
+from mapmystairs.sessions import CacheSessionInterface
+app.session_interface = CacheSessionInterface(session_cache)
+
+# request metrics, see mapmystairs/metrics.py
+from mapmystairs.metrics import init_metrics
+init_metrics(app, cache)
+
+# slow query log, see SQL_PROFILER in settings
+from mapmystairs.profiler import init_profiler
+init_profiler(app)
+
+# MapMyFitness API connection pool
+from mapmystairs.mmf import MapMyFitnessAPI
+MapMyFitnessAPI.configure(
+    api_url=app.config['MMF_API_URL'],
+    pool_size=app.config['MMF_API_POOL_SIZE'],
+    connect_timeout=app.config['MMF_API_CONNECT_TIMEOUT'],
+    read_timeout=app.config['MMF_API_READ_TIMEOUT'])
 
 # load views
 import views
@@ -0,0 +1,214 @@
+"""
+    Climbing Statistics
+    ~~~~~~~~~~~~~~~~~~~
+    Personal trends for every climber of a stairwell: pace per step,
+    percentile against the other climbers, improvement over time and
+    streaks of consecutive days.
+
+    A stairwell's workouts are read with a single query into NumPy arrays
+    and the statistics of all climbers are computed at once with grouped
+    array operations, never through per-user `User.workouts` loads.  They
+    are cached like the leaderboards, see get_cached_leaderboards, and
+    recomputed once per leaderboard version.
+"""
+import datetime
+
+import numpy as np
+import pytz
+from sqlalchemy.sql import text
+
+from mapmystairs.database import get_read_engine
+from mapmystairs.utils import get_cached_leaderboards
+
+
+# improvement is the pace trend over this many days
+TREND_DAYS = 30
+
+# ...reported once the climbs span this many days with this many climbs,
+# and clamped to +/- this many percent
+TREND_MIN_DAYS = 7
+TREND_MIN_CLIMBS = 5
+TREND_MAX_IMPROVEMENT = 100.0
+
+
+# functions
+def get_stairwell_stats(stairwell_id):
+    """
+    Get the statistics of every climber of a stairwell
+
+    :param int stairwell_id: Stairwell id
+    :returns: dict with the 'climber_count' and 'users', user_id -> stats,
+              see query_stairwell_stats
+    """
+    def query(stairwell_ids):
+        return dict((s, query_stairwell_stats(s)) for s in stairwell_ids)
+
+    return get_cached_leaderboards([stairwell_id], query,
+                                   name="stats")[stairwell_id]
+
+
+def get_user_stats(stairwell_id, user_id, time_zone):
+    """
+    Get a climber's statistics on a stairwell
+
+    :param int stairwell_id: Stairwell id
+    :param int user_id: User id
+    :param str time_zone: climber's time zone, for the current streak
+    :returns: dict, the stats with a 'current_streak' or None if the user
+              never climbed the stairwell
+    """
+    stats = get_stairwell_stats(stairwell_id)['users'].get(user_id)
+    if stats is None:
+        return None
+
+    # the last streak is current if it includes today or yesterday
+    today = datetime.datetime.now(pytz.timezone(time_zone)).date()
+    stats = dict(stats)
+    stats['current_streak'] = 0
+    if stats['last_climb_date'] >= today - datetime.timedelta(days=1):
+        stats['current_streak'] = stats['last_streak']
+    return stats
+
+
+def load_workouts(stairwell_id):
+    """
+    Read a stairwell's dated workouts into arrays
+
+    :param int stairwell_id: Stairwell id
+    :returns: dict of 'user_id', 'up' (bool), 'day' (days since the
+              epoch), 'time' (fraction of the day) and 'pace' (seconds per
+              step) arrays
+    """
+    results = get_read_engine().execute(text("""
+        SELECT
+            user_id, direction, workout_date, time_taken, number_of_steps
+        FROM
+            workout
+        WHERE
+            stairwell_id = :stairwell_id AND
+            workout_date IS NOT NULL AND
+            time_taken > 0 AND
+            number_of_steps > 0;
+        """), stairwell_id=stairwell_id).fetchall()
+
+    columns = zip(*results) or [(), (), (), (), ()]
+    user_ids, directions, dates, times, steps = columns
+
+    # workout dates are the climber's local time
+    dates = np.array(dates, dtype='datetime64[us]')
+    return {
+        'user_id': np.array(user_ids, dtype=np.int64),
+        'up': np.array(directions, dtype=object) == 'up',
+        'day': dates.astype('datetime64[D]').astype(np.int64),
+        'time': (dates - dates.astype('datetime64[D]'))
+                .astype(np.float64) / 86400e6,
+        'pace': np.array(times, dtype=np.float64) /
+                np.array(steps, dtype=np.float64)
+        }
+
+
+def group_starts(keys):
+    """
+    :param array keys: sorted group keys
+    :returns: array, index of the first row of each group
+    """
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+
+def query_stairwell_stats(stairwell_id):
+    """
+    Compute the statistics of every climber of a stairwell.  Per direction
+    each climber has their 'workout_count', 'best_pace' and 'median_pace'
+    (seconds per step), the 'percentile' of the other climbers whose best
+    pace is slower and the 'improvement' in percent faster per TREND_DAYS
+    days (None until they have TREND_MIN_CLIMBS climbs spanning
+    TREND_MIN_DAYS days, clamped to TREND_MAX_IMPROVEMENT).  Streaks count
+    consecutive days with a climb in either direction.
+
+    :param int stairwell_id: Stairwell id
+    :returns: dict with the 'climber_count' and 'users', user_id -> stats
+    """
+    workouts = load_workouts(stairwell_id)
+    users, user_index = np.unique(workouts['user_id'], return_inverse=True)
+    if not len(users):
+        return {'climber_count': 0, 'users': {}}
+
+    # one group per user and direction, rows ordered by pace
+    group = user_index * 2 + workouts['up']
+    order = np.lexsort((workouts['pace'], group))
+    keys = group[order]
+    pace = workouts['pace'][order]
+    starts = group_starts(keys)
+    groups = keys[starts]
+    counts = np.diff(np.r_[starts, len(keys)])
+
+    best = pace[starts]
+    median = (pace[starts + (counts - 1) // 2] + pace[starts + counts // 2]) \
+             / 2
+
+    # least squares slope of pace over time, in days since the first climb
+    x = workouts['day'] + workouts['time']
+    x = (x - x.min())[order]
+    n = counts.astype(np.float64)
+    sx = np.add.reduceat(x, starts)
+    sy = np.add.reduceat(pace, starts)
+    sxx = np.add.reduceat(x * x, starts)
+    sxy = np.add.reduceat(x * pace, starts)
+    spread = np.maximum.reduceat(x, starts) - np.minimum.reduceat(x, starts)
+    trended = (spread >= TREND_MIN_DAYS) & (counts >= TREND_MIN_CLIMBS)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+        improvement = np.clip(-slope * TREND_DAYS / (sy / n) * 100,
+                              -TREND_MAX_IMPROVEMENT, TREND_MAX_IMPROVEMENT)
+
+    # climbers of the same direction with a slower best pace
+    percentile = np.empty(len(groups))
+    for direction_up in (False, True):
+        mask = (groups % 2) == direction_up
+        best_paces = np.sort(best[mask])
+        slower = len(best_paces) - np.searchsorted(best_paces, best[mask],
+                                                   side='right')
+        percentile[mask] = slower * 100.0 / max(len(best_paces) - 1, 1) \
+                           if len(best_paces) > 1 else 100.0
+
+    user_ids = users.tolist()
+    stats = dict((user_id, {}) for user_id in user_ids)
+    for g, count, b, m, p, i, t in zip(groups.tolist(), counts.tolist(),
+                                       best.tolist(), median.tolist(),
+                                       percentile.tolist(),
+                                       improvement.tolist(), trended.tolist()):
+        direction = 'up' if g % 2 else 'down'
+        stats[user_ids[g // 2]][direction] = {
+            'workout_count': count,
+            'best_pace': b,
+            'median_pace': m,
+            'percentile': p,
+            'improvement': i if t else None
+            }
+
+    # streaks, runs of consecutive days with a climb.  Days are numbered
+    # per user with a gap between users, so a run never spans two users.
+    first_day = workouts['day'].min()
+    days = workouts['day'] - first_day
+    span = days.max() + 2
+    climbed = np.unique(user_index * span + days)
+    runs = np.flatnonzero(np.r_[True, np.diff(climbed) != 1])
+    run_lengths = np.diff(np.r_[runs, len(climbed)])
+    run_users = climbed[runs] // span
+    user_runs = group_starts(run_users)
+    longest = np.maximum.reduceat(run_lengths, user_runs)
+    last_runs = np.r_[user_runs[1:], len(runs)] - 1
+    last_days = climbed[runs[last_runs] + run_lengths[last_runs] - 1] % span
+
+    epoch = datetime.date(1970, 1, 1) + datetime.timedelta(days=int(first_day))
+    for u, l, r, d in zip(run_users[user_runs].tolist(), longest.tolist(),
+                          run_lengths[last_runs].tolist(),
+                          last_days.tolist()):
+        stats[user_ids[u]].update({
+            'longest_streak': l,
+            'last_streak': r,
+            'last_climb_date': epoch + datetime.timedelta(days=d)
+            })
+
+    # return
+    return {'climber_count': len(users), 'users': stats}
@@ -0,0 +1,214 @@
+"""
+    Caching
+    ~~~~~~~
+    Flask-Cache backends, select one with CACHE_TYPE in settings.py (and
+    SESSION_CACHE_TYPE for sessions), and a small in-process LRU cache for
+    hot records
+"""
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from time import time
+
+from werkzeug.contrib.cache import FileSystemCache
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class LRUFileSystemCache(FileSystemCache):
+    """
+    File system cache shared by every worker process on a host.
+    
+    Reads touch the cache file so pruning can evict the least recently 
+    used entries once there are more than `threshold` of them, and add() 
+    is atomic across processes so it can be used for locks.
+    """
+    
+    def get(self, key):
+        value = FileSystemCache.get(self, key)
+        
+        # mark as recently used
+        if value is not None:
+            try:
+                os.utime(self._get_filename(key), None)
+            except OSError:
+                pass
+        
+        return value
+    
+    def add(self, key, value, timeout=None):
+        """
+        Only set the key if it doesn't exist yet.  Returns True if the 
+        value was added.
+        """
+        if timeout is None:
+            timeout = self.default_timeout
+        filename = self._get_filename(key)
+        
+        # clears the entry if it has expired
+        FileSystemCache.get(self, key)
+        
+        try:
+            fd, tmp = tempfile.mkstemp(suffix=self._fs_transaction_suffix,
+                                       dir=self._path)
+        except (IOError, OSError):
+            return False
+        
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump(int(time() + timeout), f, 1)
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.chmod(tmp, self._mode)
+            
+            # link fails if the key already exists
+            os.link(tmp, filename)
+            return True
+        except (IOError, OSError):
+            return False
+        finally:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+    
+    def _prune(self):
+        entries = self._list_dir()
+        if len(entries) <= self._threshold:
+            return
+        
+        # drop expired entries, sort the rest by last use
+        now = time()
+        live_entries = []
+        for fname in entries:
+            try:
+                f = open(fname, 'rb')
+                try:
+                    expires = pickle.load(f)
+                finally:
+                    f.close()
+                
+                if expires <= now:
+                    os.remove(fname)
+                else:
+                    live_entries.append((os.path.getmtime(fname), fname))
+            except Exception:
+                pass
+        
+        # evict down to 90% of the threshold so we don't prune on every set
+        live_entries.sort()
+        excess = len(live_entries) - int(self._threshold * 0.9)
+        for mtime, fname in live_entries[:max(excess, 0)]:
+            try:
+                os.remove(fname)
+            except (IOError, OSError):
+                pass
+
+
+class SessionFileSystemCache(FileSystemCache):
+    """
+    File system cache for sessions and active climbs, shared by every 
+    worker process on a host.
+    
+    Unlike LRUFileSystemCache it never evicts live entries, that would log
+    users out.  Once there are more than `threshold` entries the expired 
+    ones are swept, at most every `sweep_interval` seconds.
+    """
+    
+    def __init__(self, cache_dir, threshold=500, default_timeout=300,
+                 mode=0o600, sweep_interval=60):
+        FileSystemCache.__init__(self, cache_dir, threshold=threshold,
+                                 default_timeout=default_timeout, mode=mode)
+        self.sweep_interval = sweep_interval
+        self._swept_at = 0
+    
+    def _prune(self):
+        now = time()
+        if now - self._swept_at < self.sweep_interval:
+            return
+        self._swept_at = now
+        
+        entries = self._list_dir()
+        if len(entries) <= self._threshold:
+            return
+        
+        # only drop expired entries
+        for fname in entries:
+            try:
+                f = open(fname, 'rb')
+                try:
+                    expires = pickle.load(f)
+                finally:
+                    f.close()
+                
+                if expires <= now:
+                    os.remove(fname)
+            except Exception:
+                pass
+
+
+class LRUCache(object):
+    """
+    Thread safe in-process cache holding at most `maxsize` entries, each 
+    for at most `ttl` seconds.  The least recently used entries are 
+    evicted first.
+    """
+    
+    def __init__(self, maxsize=1000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            
+            # expired
+            expires, value = entry
+            if expires <= time():
+                return None
+            
+            # mark as recently used
+            self._entries[key] = entry
+            return value
+    
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time() + ttl, value)
+            
+            # evict least recently used
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+    
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Flask-Cache factories
+def lrufilesystem(app, config, args, kwargs):
+    args.insert(0, config['CACHE_DIR'])
+    kwargs.update(dict(threshold=config['CACHE_THRESHOLD']))
+    return LRUFileSystemCache(*args, **kwargs)
+
+
+def sessionfilesystem(app, config, args, kwargs):
+    args.insert(0, config['CACHE_DIR'])
+    kwargs.update(dict(threshold=config['CACHE_THRESHOLD']))
+    return SessionFileSystemCache(*args, **kwargs)
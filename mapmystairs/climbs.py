@@ -0,0 +1,320 @@
+"""
+    Climbs
+    ~~~~~~
+    Saves finished climbs: the local workout, its leaderboard rollups and
+    its queued MMF submission, in one transaction.
+
+    Climbs are finished either by scanning the other end of the stairwell
+    or by the phone, which times the climb itself and syncs one or more
+    finished climbs at once when it has a connection, see sync_climbs.
+    Climbs are always started by the server: a synced climb carries the
+    signed token of its start, see get_climb_token.
+"""
+import logging
+
+from itsdangerous import BadSignature, URLSafeSerializer
+import pytz
+
+from mapmystairs import app, db
+from mapmystairs.database import new_version
+from mapmystairs.models import DIRECTIONS, Workout
+from mapmystairs.sessions import ActiveClimb
+from mapmystairs.stairwells import get_stairwell
+from mapmystairs.stream import build_climb_event, publish_climbs
+from mapmystairs.submissions import (enqueue_workout_submission,
+                                     wake_submission_worker)
+from mapmystairs.utils import update_leaderboard_rollup
+
+
+# logging
+logger = logging.getLogger(__name__)
+
+
+# functions
+def start_climb(stairwell, direction, start_epoch, time_zone):
+    """
+    :param Stairwell stairwell: Stairwell climbed
+    :param str direction: up or down
+    :param float start_epoch: when the climb started
+    :param str time_zone: climber's time zone
+    :returns: ActiveClimb
+    """
+    # build workout name
+    workout_name = 'walked %s %s stairs' % (direction,
+                                            stairwell.number_of_steps)
+
+    return ActiveClimb(stairwell.id, direction, start_epoch,
+                       stairwell.number_of_steps, workout_name,
+                       'climbed %s' % stairwell.name, time_zone)
+
+
+def get_climb_token(user_id, climb):
+    """
+    :param int user_id: the climber's id
+    :param ActiveClimb climb: climb started by the server
+    :returns: str, signed token of the climb's start, sent back with the
+              climb when the phone syncs it
+    """
+    serializer = URLSafeSerializer(app.secret_key, salt='climb-token')
+    return serializer.dumps([user_id, climb.stairwell_id, climb.direction,
+                             climb.start_epoch])
+
+
+def parse_climb_token(token, user_id):
+    """
+    :param str token: token made by get_climb_token
+    :param int user_id: the climber's id
+    :returns: (stairwell_id, direction, start_epoch) tuple
+    :raises ValueError: if the token is invalid or someone else's
+    """
+    serializer = URLSafeSerializer(app.secret_key, salt='climb-token')
+    try:
+        token_user_id, stairwell_id, direction, start_epoch = \
+                serializer.loads(token)
+    except (BadSignature, TypeError, ValueError):
+        raise ValueError("Invalid climb_token")
+
+    if token_user_id != user_id:
+        raise ValueError("Invalid climb_token")
+    return stairwell_id, direction, start_epoch
+
+
+def build_vx_workout(climb, active_time_total):
+    """
+    :param ActiveClimb climb: the finished climb
+    :param float active_time_total: seconds the climb took
+    :returns: dict, the vx workout to post to the MMF API
+    """
+    fmt = '%Y-%m-%d %H:%M:%S %Z'
+    return {
+        "start_datetime": climb.start_datetime.strftime(fmt),
+        "name": climb.name,
+        "notes": climb.notes or "",
+        "privacy": "/v7.0/privacy_option/1/",
+        "aggregates": {
+            "active_time_total": active_time_total,
+        },
+        "time_series": {
+            "steps": [[0, 0],
+                      [active_time_total, climb.number_of_steps]]
+        },
+        "start_locale_timezone": climb.time_zone,
+        "activity_type": "/v7.0/activity_type/%s/" % climb.activity_type_id
+        }
+
+
+def get_workout_date(climb):
+    """
+    :returns: datetime, naive start of the climb in the climber's time zone
+    """
+    tz = pytz.timezone(climb.time_zone)
+    return climb.start_datetime.astimezone(tz)\
+                .replace(tzinfo=None, microsecond=0)
+
+
+def add_climb(user, climb, active_time_total, client_climb_id=None):
+    """
+    Add a finished climb to the current db.session: its workout, with a
+    provisional id until it's posted, its rollups and its MMF submission.
+
+    A synced climb is inserted with INSERT IGNORE (INSERT OR IGNORE on
+    SQLite), so if a concurrent retry of the sync saved the same
+    client_climb_id first, nothing is added instead of failing the
+    transaction.
+
+    :param dict user: the climber's identity, see get_user_identity
+    :param ActiveClimb climb: the finished climb
+    :param float active_time_total: seconds the climb took
+    :optparam str client_climb_id: id the phone gave a synced climb
+    :returns: Workout, None if the synced climb was saved already
+    """
+    vx_workout = build_vx_workout(climb, active_time_total)
+    logger.debug("vx_workout: %s", vx_workout)
+
+    # queue the vx workout, posted by the submission worker
+    submission = enqueue_workout_submission(vx_workout, user['id'],
+                                            user['oauth_token'],
+                                            user['oauth_token_secret'])
+
+    values = {
+        'id': submission.workout_id,
+        'workout_date': get_workout_date(climb),
+        'user_id': user['id'],
+        'time_taken': int(round(active_time_total)),
+        'number_of_steps': climb.number_of_steps,
+        'energy_burned': 0,
+        'stairwell_id': climb.stairwell_id,
+        'direction': climb.direction,
+        'client_climb_id': client_climb_id
+        }
+    w = Workout(**values)
+
+    # add workout
+    logger.debug("Saving w:%s", w)
+    if client_climb_id is None:
+        db.session.add(w)
+    else:
+        insert = Workout.__table__.insert()\
+                                  .prefix_with('IGNORE', dialect='mysql')\
+                                  .prefix_with('OR IGNORE', dialect='sqlite')
+        if not db.session.execute(insert, values).rowcount:
+            logger.info("Climb %s of %s was saved already", client_climb_id,
+                        user['id'])
+            db.session.delete(submission)
+            return None
+    update_leaderboard_rollup(w, organization_id=user['organization_id'])
+
+    return w
+
+
+def save_climbs(user, finished):
+    """
+    Save finished climbs in a single transaction, then retire the cached
+    leaderboards, push the climbs to the lobby displays and wake the
+    submission worker
+
+    :param dict user: the climber's identity, see get_user_identity
+    :param list finished: (ActiveClimb, seconds taken, client_climb_id)
+                          tuples, the client_climb_id is None unless synced
+    :returns: list of the saved Workouts, without synced climbs that were
+              saved already
+    """
+    workouts = []
+    for climb, active_time_total, client_climb_id in finished:
+        w = add_climb(user, climb, active_time_total, client_climb_id)
+        if w is not None:
+            workouts.append(w)
+
+        # rollups are incremented with SQL expressions, flush them before
+        # the next climb increments the same rows
+        db.session.flush()
+    db.session.commit()
+
+    if not workouts:
+        return workouts
+
+    # retire the cached leaderboards, push to the lobby displays
+    for stairwell_id in set(w.stairwell_id for w in workouts):
+        version = new_version()
+        events = []
+        for w in workouts:
+            if w.stairwell_id != stairwell_id:
+                continue
+            try:
+                events.append(build_climb_event(w, user))
+            except Exception:
+                logger.exception("Publishing %s failed", w)
+        publish_climbs(stairwell_id, events, version)
+
+    # post the workouts
+    wake_submission_worker()
+
+    return workouts
+
+
+def parse_synced_climb(data, user, now):
+    """
+    Validate a climb timed by the phone.  The stairwell, direction and
+    start come from the climb_token of the climb the server started, only
+    the finish comes from the phone.
+
+    :param dict data: climb_token and finish_epoch, on the server's clock
+    :param dict user: the climber's identity, see get_user_identity
+    :param float now: server time of the sync
+    :returns: (ActiveClimb, seconds taken) tuple
+    :raises ValueError: if the climb is invalid
+    """
+    try:
+        token = data['climb_token']
+        finish_epoch = float(data['finish_epoch'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("climb_token and finish_epoch are required")
+
+    stairwell_id, direction, start_epoch = parse_climb_token(token,
+                                                             user['id'])
+    if direction not in DIRECTIONS:
+        raise ValueError("Unknown direction %r" % direction)
+
+    stairwell = get_stairwell(stairwell_id)
+    if stairwell is None:
+        raise ValueError("Unknown stairwell %s" % stairwell_id)
+
+    active_time_total = finish_epoch - start_epoch
+    if not 0 < active_time_total <= app.config['ACTIVE_CLIMB_TIMEOUT']:
+        raise ValueError("Climb took %.0f seconds" % active_time_total)
+
+    min_seconds = stairwell.number_of_steps \
+                  * app.config['WORKOUT_MIN_SECONDS_PER_STEP']
+    if active_time_total < min_seconds:
+        raise ValueError("Climb took %.1f seconds, at least %.1f expected"
+                         % (active_time_total, min_seconds))
+
+    if finish_epoch > now + app.config['WORKOUT_SYNC_CLOCK_SKEW']:
+        raise ValueError("Climb finishes in the future")
+    if finish_epoch < now - app.config['WORKOUT_SYNC_MAX_AGE']:
+        raise ValueError("Climb is too old to sync")
+
+    climb = start_climb(stairwell, direction, start_epoch, user['time_zone'])
+    return climb, active_time_total
+
+
+def sync_climbs(user, climbs, now):
+    """
+    Save a batch of climbs timed by the phone.  Invalid climbs are rejected
+    and climbs that were already saved, ie., resent after a lost response
+    or also finished by a scan, are skipped.
+
+    :param dict user: the climber's identity, see get_user_identity
+    :param list climbs: dicts with a client_id, see parse_synced_climb
+    :param float now: server time of the sync
+    :returns: (result, finished) tuple, the result dict has the client_ids
+              'saved' and 'duplicates', and 'rejected' climbs with their
+              client_id and error, finished is the list of ActiveClimbs
+              saved now or before
+    """
+    result = {'saved': [], 'duplicates': [], 'rejected': []}
+
+    # validate
+    parsed = []
+    for data in climbs:
+        client_id = data.get('client_id') if isinstance(data, dict) else None
+        try:
+            if not isinstance(client_id, basestring) or not client_id:
+                client_id = None
+                raise ValueError("client_id is required")
+            if len(client_id) > 64:
+                raise ValueError("client_id is too long")
+            climb, active_time_total = parse_synced_climb(data, user, now)
+        except ValueError as e:
+            result['rejected'].append({'client_id': client_id,
+                                       'error': str(e)})
+            continue
+        parsed.append((client_id, climb, active_time_total))
+
+    # skip climbs saved before, by their start.  Concurrent retries can
+    # both pass this check, add_climb saves only one of them.
+    saved = set()
+    if parsed:
+        dates = set(get_workout_date(climb) for _, climb, _ in parsed)
+        saved = set(db.session.query(Workout.stairwell_id, Workout.direction,
+                                     Workout.workout_date)
+                    .filter(Workout.user_id == user['id'],
+                            Workout.workout_date.in_(dates)))
+
+    unsaved = []
+    for client_id, climb, active_time_total in parsed:
+        key = (climb.stairwell_id, climb.direction, get_workout_date(climb))
+        if key in saved:
+            result['duplicates'].append(client_id)
+            continue
+        saved.add(key)
+        unsaved.append((climb, active_time_total, client_id))
+
+    workouts = save_climbs(user, unsaved)
+    saved_ids = set(w.client_climb_id for w in workouts)
+    for _, _, client_id in unsaved:
+        if client_id in saved_ids:
+            result['saved'].append(client_id)
+        else:
+            result['duplicates'].append(client_id)
+    return result, [climb for _, climb, _ in parsed]
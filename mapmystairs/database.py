@@ -0,0 +1,108 @@
+"""
+    Database Routing
+    ~~~~~~~~~~~~~~~~
+    Read-only leaderboard and stairwell queries go to the replica in
+    SQLALCHEMY_REPLICA_URI, with its own connection pool, so leaderboard
+    scans don't compete with workout inserts for primary connections.
+    Everything else, and every write, uses the primary (db.engine).
+
+    A replica lags behind the primary, and a board computed from it right
+    after a climb would be cached without that climb.  Leaderboard and
+    stairwell versions therefore record when they were made, and reads for
+    data changed less than SQLALCHEMY_REPLICA_LAG seconds ago go to the
+    primary, see fresh_reads.
+"""
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool
+
+from mapmystairs import app, db
+
+
+# reads of this thread go to the primary
+_local = threading.local()
+
+
+# functions
+def new_version():
+    """
+    :returns: str, a unique cache version starting with its creation time
+    """
+    return '%08x%s' % (int(time.time()), uuid.uuid4().hex[:24])
+
+
+def get_version_age(version):
+    """
+    :param str version: version made by new_version
+    :returns: float, seconds since the version was made, infinite for
+              versions without a time
+    """
+    try:
+        return time.time() - int(version[:8], 16)
+    except (TypeError, ValueError):
+        return float('inf')
+
+
+@contextmanager
+def primary_reads(enabled=True):
+    """
+    Send the reads in the block to the primary, ie., right after a write
+
+    :optparam bool enabled: False leaves the routing as is
+    """
+    previous = getattr(_local, 'primary', False)
+    _local.primary = previous or enabled
+    try:
+        yield
+    finally:
+        _local.primary = previous
+
+
+def fresh_reads(*versions):
+    """
+    Send the reads in the block to the primary if any of the versions is
+    younger than the replica lag
+
+    :param str versions: leaderboard or stairwell versions read
+    """
+    lag = app.config['SQLALCHEMY_REPLICA_LAG']
+    return primary_reads(any(get_version_age(version) < lag
+                             for version in versions))
+
+
+def get_read_engine():
+    """
+    :returns: Engine for read-only queries, the replica unless there is
+              none or the reads have to be fresh
+    """
+    if not app.config['SQLALCHEMY_REPLICA_URI'] \
+            or getattr(_local, 'primary', False):
+        return db.engine
+    return db.get_engine(app, bind='replica')
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """
+    Test pooled connections before handing them out.  A connection the
+    server closed, ie., after a MySQL restart or wait_timeout, is dropped
+    and the pool retries with a new one.
+    """
+    try:
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        cursor.close()
+    except Exception:
+        raise exc.DisconnectionError()
+
+
+def init_database(app):
+    """
+    :param Flask app: the app
+    """
+    if app.config['SQLALCHEMY_POOL_PRE_PING']:
+        event.listen(Pool, 'checkout', ping_connection)
@@ -3,15 +3,25 @@
     ~~~~~~~~~~
 """
 from functools import wraps
-from flask import g, request, redirect, session, url_for
+from flask import abort, current_app, g, request, redirect, url_for
 
 
 # decorators
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        user = session.get("user")
-        if user is None:
+        if g.user is None:
             return redirect(url_for('auth_login', next=request.url))
         return f(*args, **kwargs)
     return decorated_function
+
+
+def admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if g.user is None:
+            return redirect(url_for('auth_login', next=request.url))
+        if g.user['id'] not in current_app.config['ADMIN_USER_IDS']:
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated_function
@@ -0,0 +1,226 @@
+"""
+    User Identity
+    ~~~~~~~~~~~~~
+    Cached user identity records shared by login, the leaderboards and the
+    workout flow.  Lookups go through a per-process LRU cache, then the
+    shared cache, and only then the database.  MMF profiles older than
+    USER_PROFILE_MAX_AGE are served as is and refreshed in the background,
+    the time of the last refresh is kept with the user.
+"""
+import logging
+import threading
+import time
+import uuid
+
+from mapmystairs import app, cache, db
+from mapmystairs.caching import LRUCache
+from mapmystairs.mmf import MapMyFitnessAPI
+from mapmystairs.models import User
+
+
+# logging
+logger = logging.getLogger(__name__)
+
+# per-process identity cache
+_identities = LRUCache(maxsize=app.config['USER_IDENTITY_CACHE_SIZE'],
+                       ttl=app.config['USER_IDENTITY_TTL'])
+
+# users with a profile refresh running in this process
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+# functions
+def build_user_identity(user):
+    """
+    :param User user: User to build the identity from
+    :returns: dict, the user identity record
+    """
+    return {
+        'id': user.id,
+        'username': user.username,
+        'email': user.email,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'organization_id': user.organization_id,
+        'time_zone': user.time_zone,
+        'oauth_token': user.oauth_token,
+        'oauth_token_secret': user.oauth_token_secret,
+        'refreshed_at': user.profile_refreshed_at or 0
+        }
+
+
+def store_user_identity(identity):
+    """
+    Put an identity record in the process and shared caches
+
+    :param dict identity: the user identity record
+    """
+    _identities.set(identity['id'], identity)
+    cache.set('user-%s' % identity['id'], identity,
+              timeout=app.config['USER_IDENTITY_CACHE_TIMEOUT'])
+
+
+def invalidate_user_identity(user_id):
+    """
+    :param int user_id: User to drop from the caches
+    """
+    _identities.delete(user_id)
+    cache.delete('user-%s' % user_id)
+
+
+def get_user_identity(user_id):
+    """
+    :param int user_id: User to get
+    :returns: dict, the user identity record or None if there is no user
+    """
+    if user_id is None:
+        return None
+    user_id = int(user_id)
+
+    # process cache, then shared cache, then the database
+    identity = _identities.get(user_id)
+    if identity is None:
+        identity = cache.get('user-%s' % user_id)
+
+        if identity is None:
+            user = User.query.get(user_id)
+            if user is None:
+                return None
+            identity = build_user_identity(user)
+            store_user_identity(identity)
+        else:
+            _identities.set(user_id, identity)
+
+    # serve stale profiles, refresh them in the background
+    age = time.time() - identity['refreshed_at']
+    if age > app.config['USER_PROFILE_MAX_AGE']:
+        refresh_user_profile_async(user_id)
+
+    return identity
+
+
+def login_user_identity(user_id, token_key, token_secret, organization_id):
+    """
+    Get the identity of a user who just authorized, creating the user from
+    their MMF profile on first login
+
+    :param int user_id: mmf.user.id
+    :param str token_key: User's mmf oauth token
+    :param str token_secret: User's mmf oauth token secret
+    :param int organization_id: Organization new users join
+    :returns: dict, the user identity record
+    """
+    user_id = int(user_id)
+    identity = get_user_identity(user_id)
+
+    if identity is None:
+
+        # get current user
+        mmf = MapMyFitnessAPI(app.config['MMF_API_KEY'],
+                              app.config['MMF_API_SECRET'],
+                              token_key=token_key,
+                              token_secret=token_secret)
+
+        mmf_user = mmf.call("/user/%s/" % user_id)
+
+        user = User(id=user_id,
+                    username=mmf_user['username'],
+                    email=mmf_user['email'],
+                    first_name=mmf_user['first_name'],
+                    last_name=mmf_user['last_name'],
+                    organization_id=organization_id,
+                    time_zone=mmf_user['time_zone'],
+                    oauth_token=token_key,
+                    oauth_token_secret=token_secret)
+        user.profile_refreshed_at = time.time()
+
+        # add user
+        db.session.add(user)
+        db.session.commit()
+
+        identity = build_user_identity(user)
+        store_user_identity(identity)
+
+    elif (identity['oauth_token'], identity['oauth_token_secret']) \
+            != (token_key, token_secret):
+
+        # keep the newest credentials
+        User.query.filter_by(id=user_id).update(
+            {'oauth_token': token_key, 'oauth_token_secret': token_secret})
+        db.session.commit()
+
+        identity = dict(identity, oauth_token=token_key,
+                        oauth_token_secret=token_secret)
+        store_user_identity(identity)
+
+    return identity
+
+
+def refresh_user_profile(user_id):
+    """
+    Update a user from their MMF profile and re-cache their identity
+
+    :param int user_id: User to refresh
+    :returns: dict, the refreshed identity record or None
+    """
+    user = User.query.get(user_id)
+    if user is None:
+        return None
+
+    mmf = MapMyFitnessAPI(app.config['MMF_API_KEY'],
+                          app.config['MMF_API_SECRET'],
+                          token_key=user.oauth_token,
+                          token_secret=user.oauth_token_secret)
+
+    mmf_user = mmf.call("/user/%s/" % user_id)
+
+    user.username = mmf_user['username']
+    user.email = mmf_user['email']
+    user.first_name = mmf_user['first_name']
+    user.last_name = mmf_user['last_name']
+    user.time_zone = mmf_user['time_zone']
+    user.profile_refreshed_at = time.time()
+    db.session.commit()
+
+    identity = build_user_identity(user)
+    store_user_identity(identity)
+    return identity
+
+
+def refresh_user_profile_async(user_id):
+    """
+    Refresh a user's MMF profile in a background thread, at most one
+    refresh per user runs across all processes
+
+    :param int user_id: User to refresh
+    """
+    with _refreshing_lock:
+        if user_id in _refreshing:
+            return
+        _refreshing.add(user_id)
+
+    # take the shared refresh lock, it expires on its own
+    lock_key = 'user-%s-refresh' % user_id
+    lock_token = uuid.uuid4().hex
+    cache.add(lock_key, lock_token,
+              timeout=app.config['USER_PROFILE_REFRESH_INTERVAL'])
+    if cache.get(lock_key) != lock_token:
+        with _refreshing_lock:
+            _refreshing.discard(user_id)
+        return
+
+    def run():
+        with app.app_context():
+            try:
+                refresh_user_profile(user_id)
+            except Exception:
+                logger.exception("Refreshing user %s failed", user_id)
+            finally:
+                db.session.remove()
+                with _refreshing_lock:
+                    _refreshing.discard(user_id)
+
+    thread = threading.Thread(target=run, name="user-refresh-%s" % user_id)
+    thread.daemon = True
+    thread.start()
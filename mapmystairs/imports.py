@@ -0,0 +1,210 @@
+"""
+    Workout Imports
+    ~~~~~~~~~~~~~~~
+    Bulk import of stair workouts (activity_type 133) logged through 
+    other MMF apps, ie.,
+    
+        $ python manage.py import_workouts --user-id 123
+"""
+import datetime
+import logging
+import re
+from multiprocessing.pool import ThreadPool
+
+import pytz
+
+from mapmystairs import app, db
+from mapmystairs.mmf import MapMyFitnessAPI
+from mapmystairs.models import Workout
+from mapmystairs.stairwells import get_stairwells
+from mapmystairs.submissions import KCAL_PER_JOULE
+from mapmystairs.utils import add_leaderboard_workouts, invalidate_leaderboard
+
+
+# logging
+logger = logging.getLogger(__name__)
+
+# stair climbing
+ACTIVITY_TYPE_ID = 133
+
+# see views.workout, ie., 'walked up 65 stairs' / 'climbed ABC Bank Building'
+WORKOUT_NAME_RE = re.compile(r'walked (up|down) (\d+) stairs')
+WORKOUT_NOTES_RE = re.compile(r'climbed (.+)')
+
+# ie., 2014-07-15T14:00:00+00:00
+VX_DATETIME_RE = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.\d+)?'
+                            r'(Z|[+-]\d\d:?\d\d)?$')
+
+
+# functions
+def fetch_user_workouts(mmf, user_id, page_size=40, concurrency=4):
+    """
+    Page through a user's stair workouts, fetching the pages concurrently
+    
+    :param MapMyFitnessAPI mmf: API connection of the user
+    :param int user_id: MMF user id
+    :optparam int page_size: workouts per page
+    :optparam int concurrency: pages fetched at the same time
+    :returns: list of vx workouts
+    """
+    def fetch_page(offset):
+        return mmf.call("/workout/", params={
+                            'user': "/v7.0/user/%s/" % user_id,
+                            'activity_type': ACTIVITY_TYPE_ID,
+                            'limit': page_size,
+                            'offset': offset
+                            })
+    
+    # the first page tells us how many there are
+    first_page = fetch_page(0)
+    vx_workouts = first_page.get('_embedded', {}).get('workouts', [])
+    total_count = first_page.get('total_count', len(vx_workouts))
+    
+    offsets = range(page_size, total_count, page_size)
+    if offsets:
+        pool = ThreadPool(min(concurrency, len(offsets)))
+        try:
+            for page in pool.map(fetch_page, offsets):
+                vx_workouts.extend(page.get('_embedded', {})
+                                       .get('workouts', []))
+        finally:
+            pool.close()
+    
+    return vx_workouts
+
+
+def parse_vx_datetime(value):
+    """
+    Parse a VX ISO 8601 datetime, ie., 2014-07-15T14:00:00+00:00, into an
+    UTC datetime
+    
+    :raises ValueError: for other formats
+    """
+    match = VX_DATETIME_RE.match(value or '')
+    if match is None:
+        raise ValueError("Invalid VX datetime %r" % value)
+    dt = datetime.datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S')
+    
+    # to UTC
+    offset = match.group(2)
+    if offset and offset != 'Z':
+        sign = -1 if offset[0] == '-' else 1
+        dt -= sign * datetime.timedelta(hours=int(offset[1:3]),
+                                        minutes=int(offset[-2:]))
+    
+    return dt.replace(tzinfo=pytz.utc)
+
+
+def map_vx_workout(vx_workout, user, stairwells):
+    """
+    Map a VX workout to a local Workout row using the name and notes 
+    views.workout posts with
+    
+    :param dict vx_workout: VX workout
+    :param User user: the user the workout belongs to
+    :param list stairwells: Stairwells to map to
+    :returns: dict of Workout columns or None if it can't be mapped
+    :raises ValueError: for malformed workouts
+    """
+    name_match = WORKOUT_NAME_RE.search(vx_workout.get('name') or '')
+    if not name_match:
+        return None
+    
+    direction, number_of_steps = name_match.group(1), int(name_match.group(2))
+    
+    # match on the stairwell name, then on the number of steps
+    notes_match = WORKOUT_NOTES_RE.search(vx_workout.get('notes') or '')
+    candidates = [s for s in stairwells if notes_match
+                  and s.name == notes_match.group(1).strip()]
+    if len(candidates) != 1:
+        candidates = [s for s in stairwells
+                      if s.number_of_steps == number_of_steps]
+    if len(candidates) != 1:
+        return None
+    
+    # local workout date
+    tz = pytz.timezone(vx_workout.get('start_locale_timezone')
+                       or user.time_zone)
+    workout_date = parse_vx_datetime(vx_workout['start_datetime'])\
+                        .astimezone(tz).replace(tzinfo=None)
+    
+    aggregates = vx_workout.get('aggregates') or {}
+    energy = aggregates.get('metabolic_energy_total') or 0
+    time_taken = aggregates.get('elapsed_time_total',
+                                aggregates.get('active_time_total'))
+    
+    return {
+        'id': int(vx_workout['_links']['self'][0]['id']),
+        'workout_date': workout_date,
+        'user_id': user.id,
+        'time_taken': int(time_taken) if time_taken is not None else None,
+        'number_of_steps': number_of_steps,
+        'energy_burned': float(energy) * KCAL_PER_JOULE,
+        'stairwell_id': candidates[0].id,
+        'direction': direction
+        }
+
+
+def import_user_workouts(user, concurrency=4, batch_size=500):
+    """
+    Import a user's stair workouts from the MMF API.  Workouts that exist 
+    already (by Workout.id) are skipped so the import can be re-run.  Each
+    batch is added to the rollups with the insert, in its own transaction.
+    
+    :param User user: the user to import
+    :optparam int concurrency: pages fetched at the same time
+    :optparam int batch_size: rows per bulk insert
+    :returns: number of workouts imported
+    """
+    mmf = MapMyFitnessAPI(app.config['MMF_API_KEY'],
+                          app.config['MMF_API_SECRET'],
+                          token_key=user.oauth_token,
+                          token_secret=user.oauth_token_secret)
+    
+    vx_workouts = fetch_user_workouts(mmf, user.id, concurrency=concurrency)
+    
+    # map to stairwells
+    stairwells = get_stairwells()
+    rows = {}
+    for vx_workout in vx_workouts:
+        
+        # skip malformed workouts, the rest of the import goes on
+        try:
+            row = map_vx_workout(vx_workout, user, stairwells)
+        except (AttributeError, KeyError, IndexError, TypeError,
+                ValueError) as e:
+            logger.warning("Skipping workout %s of %s: %r",
+                           vx_workout.get('_links'), user, e)
+            continue
+        
+        if row:
+            rows[row['id']] = row
+    
+    logger.info("Mapped %s of %s workouts of %s", len(rows),
+                len(vx_workouts), user)
+    
+    # skip existing workouts
+    workout_ids = rows.keys()
+    for n in range(0, len(workout_ids), batch_size):
+        existing = db.session.query(Workout.id)\
+                    .filter(Workout.id.in_(workout_ids[n:n + batch_size]))
+        for r in existing:
+            rows.pop(r[0], None)
+    
+    if not rows:
+        return 0
+    
+    # bulk insert, with the batch's aggregates added to the rollups
+    rows = rows.values()
+    for n in range(0, len(rows), batch_size):
+        batch = rows[n:n + batch_size]
+        db.session.execute(Workout.__table__.insert(), batch)
+        add_leaderboard_workouts([Workout(**r) for r in batch],
+                                 organization_id=user.organization_id)
+        db.session.commit()
+    
+    # new leaderboard versions
+    for stairwell_id in set(row['stairwell_id'] for row in rows):
+        invalidate_leaderboard(stairwell_id)
+    
+    return len(rows)
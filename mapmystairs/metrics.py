@@ -0,0 +1,340 @@
+"""
+    Metrics
+    ~~~~~~~
+    Request level instrumentation.  Times SQL statements (SQLAlchemy engine
+    events), cache operations and hit rates, MapMyFitness API calls per
+    endpoint and template rendering, and keeps them in process wide
+    counters and histograms served in the Prometheus text format.
+
+    Each request also sums its own timings, which are sent back in a
+    `Server-Timing` header when METRICS_SERVER_TIMING is on.  Metrics are
+    per process, so with several gunicorn workers every scrape sees one
+    worker only unless each worker is scraped separately.
+"""
+import re
+import threading
+from time import time
+
+from flask import g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# SQL statements are labelled by their first keyword
+SQL_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+class Metric(object):
+    """
+    Process wide metric, one value per combination of label values
+    """
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def format_labels(self, labelvalues, extra=()):
+        """
+        :returns: str, ie., {endpoint="leaderboard",le="0.1"}
+        """
+        pairs = zip(self.labelnames, labelvalues) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, escape_label(value))
+                                 for name, value in pairs)
+
+    def render(self):
+        """
+        :returns: list of str, lines in the Prometheus text format
+        """
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        with self._lock:
+            values = sorted(self.values.items())
+        for labelvalues, value in values:
+            lines.extend(self.render_value(labelvalues, value))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labelvalues, **kwargs):
+        amount = kwargs.get('amount', 1)
+        with self._lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) \
+                                       + amount
+
+    def render_value(self, labelvalues, value):
+        return ['%s%s %s' % (self.name, self.format_labels(labelvalues),
+                             value)]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = buckets
+
+    def observe(self, seconds, *labelvalues):
+        with self._lock:
+            value = self.values.get(labelvalues)
+            if value is None:
+                value = self.values[labelvalues] = \
+                        [[0] * len(self.buckets), 0.0, 0]
+
+            # buckets are cumulative
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    value[0][i] += 1
+            value[1] += seconds
+            value[2] += 1
+
+    def render_value(self, labelvalues, value):
+        counts, total, count = value
+        lines = ['%s_bucket%s %s' % (
+                    self.name,
+                    self.format_labels(labelvalues, [('le', repr(bound))]),
+                    counts[i])
+                 for i, bound in enumerate(map(float, self.buckets))]
+        lines.append('%s_bucket%s %s' % (
+                        self.name,
+                        self.format_labels(labelvalues, [('le', '+Inf')]),
+                        count))
+        lines.append('%s_sum%s %r' % (self.name,
+                                      self.format_labels(labelvalues), total))
+        lines.append('%s_count%s %s' % (self.name,
+                                        self.format_labels(labelvalues),
+                                        count))
+        return lines
+
+
+def escape_label(value):
+    return unicode(value).replace('\\', r'\\').replace('"', r'\"')\
+                         .replace('\n', r'\n')
+
+
+# process wide metrics
+request_seconds = Histogram(
+        'mapmystairs_request_seconds', "Time spent handling requests",
+        ('endpoint', 'method', 'status'))
+sql_seconds = Histogram(
+        'mapmystairs_sql_seconds', "Time spent executing SQL statements",
+        ('statement',))
+cache_seconds = Histogram(
+        'mapmystairs_cache_seconds', "Time spent in cache operations",
+        ('operation',))
+cache_operations = Counter(
+        'mapmystairs_cache_operations_total',
+        "Cache operations, reads by hit or miss",
+        ('operation', 'result'))
+upstream_seconds = Histogram(
+        'mapmystairs_upstream_seconds',
+        "Time spent calling the MapMyFitness API",
+        ('method', 'endpoint', 'status'))
+render_seconds = Histogram(
+        'mapmystairs_render_seconds', "Time spent rendering templates",
+        ('template',))
+
+METRICS = (request_seconds, sql_seconds, cache_seconds, cache_operations,
+           upstream_seconds, render_seconds)
+
+
+# per request timings
+def record_timing(name, seconds):
+    """
+    Add to the current request's timings, see Server-Timing
+
+    :param str name: db, cache, mmf or render
+    :param float seconds: time spent
+    """
+    if not has_request_context():
+        return
+
+    timings = getattr(g, 'timings', None)
+    if timings is None:
+        timings = g.timings = {}
+    timing = timings.setdefault(name, [0, 0.0])
+    timing[0] += 1
+    timing[1] += seconds
+
+
+def server_timing(timings, total):
+    """
+    :param dict timings: [count, seconds] by name, see record_timing
+    :param float total: seconds spent on the request
+    :returns: str, Server-Timing header value
+    """
+    metrics = ['%s;dur=%.1f;desc="%s calls"' % (name, seconds * 1000, count)
+               for name, (count, seconds) in sorted(timings.items())]
+    metrics.append('total;dur=%.1f' % (total * 1000))
+    return ', '.join(metrics)
+
+
+def render_metrics():
+    """
+    :returns: str, all metrics in the Prometheus text format
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# SQL
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    # on the statement's context, so failed statements leave nothing behind
+    context._query_started = time()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    seconds = time() - context._query_started
+
+    keyword = statement.lstrip().split(None, 1)[0].upper() \
+              if statement.strip() else ''
+    if keyword not in SQL_STATEMENTS:
+        keyword = 'OTHER'
+
+    sql_seconds.observe(seconds, keyword)
+    record_timing('db', seconds)
+
+
+# cache
+class InstrumentedCache(object):
+    """
+    Wraps a werkzeug cache backend, timing every operation and counting
+    read hits and misses
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _timed(self, operation, method, *args, **kwargs):
+        started = time()
+        try:
+            return getattr(self.backend, method)(*args, **kwargs)
+        finally:
+            seconds = time() - started
+            cache_seconds.observe(seconds, operation)
+            record_timing('cache', seconds)
+
+    def get(self, key):
+        value = self._timed('get', 'get', key)
+        cache_operations.inc('get', 'miss' if value is None else 'hit')
+        return value
+
+    def get_many(self, *keys):
+        values = self._timed('get_many', 'get_many', *keys)
+        misses = sum(1 for value in values if value is None)
+        cache_operations.inc('get', 'hit', amount=len(keys) - misses)
+        cache_operations.inc('get', 'miss', amount=misses)
+        return values
+
+    def get_dict(self, *keys):
+        return dict(zip(keys, self.get_many(*keys)))
+
+    def set(self, key, value, timeout=None):
+        cache_operations.inc('set', 'ok')
+        return self._timed('set', 'set', key, value, timeout)
+
+    def set_many(self, mapping, timeout=None):
+        cache_operations.inc('set', 'ok', amount=len(mapping))
+        return self._timed('set_many', 'set_many', mapping, timeout)
+
+    def add(self, key, value, timeout=None):
+        added = self._timed('add', 'add', key, value, timeout)
+        cache_operations.inc('add', 'ok' if added else 'exists')
+        return added
+
+    def delete(self, key):
+        cache_operations.inc('delete', 'ok')
+        return self._timed('delete', 'delete', key)
+
+    def delete_many(self, *keys):
+        cache_operations.inc('delete', 'ok', amount=len(keys))
+        return self._timed('delete_many', 'delete_many', *keys)
+
+
+# templates
+class InstrumentedTemplate(Template):
+    """
+    Times top level renders, included templates and cached fragments
+    count towards the template that renders them
+    """
+
+    def render(self, *args, **kwargs):
+        started = time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            seconds = time() - started
+            render_seconds.observe(seconds, self.name or 'string')
+            record_timing('render', seconds)
+
+
+# MapMyFitness API
+def record_upstream(method, path, status, seconds):
+    """
+    :param str method: HTTP method
+    :param str path: API path, ids are replaced so endpoints group together
+    :param status: HTTP status code or 'error'
+    :param float seconds: time the call took
+    """
+    endpoint = re.sub(r'/\d+(?=/|$)', '/{id}', path.split('?', 1)[0])
+    upstream_seconds.observe(seconds, method, endpoint, status)
+    record_timing('mmf', seconds)
+
+
+# requests
+def start_request_timer():
+    g.request_started = time()
+    g.timings = {}
+
+
+def finish_request_timer(response, server_timing_header=False):
+    started = getattr(g, 'request_started', None)
+    if started is None:
+        return response
+
+    total = time() - started
+    request_seconds.observe(total, request.endpoint or 'none',
+                            request.method, response.status_code)
+
+    if server_timing_header:
+        response.headers['Server-Timing'] = server_timing(
+                                                getattr(g, 'timings', {}),
+                                                total)
+    return response
+
+
+def init_metrics(app, cache):
+    """
+    Instrument the app's cache, templates and requests.  SQL statements and
+    MapMyFitness API calls are timed on their own.
+
+    :param Flask app: the app
+    :param Cache cache: the app's Flask-Cache
+    """
+    app.extensions['cache'][cache] = InstrumentedCache(cache.cache)
+    app.jinja_env.template_class = InstrumentedTemplate
+
+    server_timing_header = app.config['METRICS_SERVER_TIMING']
+    app.before_request(start_request_timer)
+    app.after_request(lambda response: finish_request_timer(
+                                            response, server_timing_header))
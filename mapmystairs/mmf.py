@@ -2,16 +2,23 @@
     MapMyFitness API
     ~~~~~~~~~~~~~~~~
 """
-import requests
-from requests_oauthlib import OAuth1
+import threading
 import time
 from urlparse import parse_qs
 
+import requests
+from requests.adapters import HTTPAdapter
+from requests_oauthlib import OAuth1
 
-class MapMyFitnessAPI:
+from mapmystairs.metrics import record_upstream
+
+
+class MapMyFitnessAPI(object):
     """
     Main API Class to handle talking to the MapMyFitness API
     See: https://developer.mapmyapi.com/docs
+    
+    All instances share one keep-alive connection pool, see configure()
     """
     
     API_VERSION = "v7.0"
@@ -19,6 +26,13 @@ class MapMyFitnessAPI:
     
     # API_URL = "https://api.mapmyapi.com/api/0.2"
     
+    # connection pool
+    POOL_SIZE = 10
+    TIMEOUT = (3.05, 10)  # (connect, read) in seconds
+    
+    _session = None
+    _session_lock = threading.Lock()
+    
     def __init__(self, client_key, client_secret,
                  token_key=None, token_secret=None):
         """
@@ -33,7 +47,74 @@ class MapMyFitnessAPI:
         self.client_key = client_key
         self.client_secret = client_secret
         self.token_key = token_key
-        self.token_secret = token_secret          
+        self.token_secret = token_secret
+        
+        # signs every call()
+        self.oauth = OAuth1(self.client_key, client_secret=self.client_secret,
+                            resource_owner_key=self.token_key,
+                            resource_owner_secret=self.token_secret,
+                            signature_type='AUTH_HEADER')
+    
+    @classmethod
+    def configure(cls, api_url=None, pool_size=None,
+                  connect_timeout=None, read_timeout=None):
+        """
+        Configure the shared connection pool
+        
+        :optparam str api_url: API base url, ie., a local stub server
+        :optparam int pool_size: Max. connections kept alive to the API
+        :optparam float connect_timeout: Seconds to wait for a connection
+        :optparam float read_timeout: Seconds to wait for a response
+        """
+        if api_url:
+            cls.API_URL = api_url.rstrip("/")
+        if pool_size:
+            cls.POOL_SIZE = pool_size
+        if connect_timeout or read_timeout:
+            cls.TIMEOUT = (connect_timeout or cls.TIMEOUT[0],
+                           read_timeout or cls.TIMEOUT[1])
+        
+        # rebuild the pool on next use
+        with cls._session_lock:
+            if cls._session is not None:
+                cls._session.close()
+            cls._session = None
+    
+    @classmethod
+    def get_session(cls):
+        """
+        Get the shared, thread-safe requests session
+        """
+        if cls._session is None:
+            with cls._session_lock:
+                if cls._session is None:
+                    adapter = HTTPAdapter(pool_connections=1,
+                                          pool_maxsize=cls.POOL_SIZE)
+                    session = requests.Session()
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    cls._session = session
+        
+        return cls._session
+
+    def request(self, http_method, url, **kwargs):
+        """
+        Send a request through the shared pool, timing it per endpoint
+        
+        :param str http_method: GET or POST
+        :param str url: Full API url
+        :returns: requests.Response
+        """
+        started = time.time()
+        status = 'error'
+        try:
+            r = self.get_session().request(http_method, url,
+                                           timeout=self.TIMEOUT, **kwargs)
+            status = r.status_code
+            return r
+        finally:
+            record_upstream(http_method, url[len(self.API_URL):], status,
+                            time.time() - started)
 
     def call(self, method, http_method="GET", params=None, data=None):
         """
@@ -50,18 +131,13 @@ class MapMyFitnessAPI:
         # get data 
         url = self.API_URL + method
         
-        oauth = OAuth1(self.client_key, client_secret=self.client_secret, 
-                       resource_owner_key=self.token_key,
-                       resource_owner_secret=self.token_secret,
-                       signature_type='AUTH_HEADER')
-        
         headers = {"Accept-Encoding": "gzip", "Accept": "application/json"}
         
         if http_method == "GET":
-            r = requests.get(url=url, params=params, auth=oauth,
+            r = self.request("GET", url, params=params, auth=self.oauth,
                              headers=headers)
         elif http_method == "POST":
-            r = requests.post(url=url, params=params, auth=oauth,
+            r = self.request("POST", url, params=params, auth=self.oauth,
                              data=data, headers=headers)
         
         return r.json()
@@ -79,7 +155,7 @@ class MapMyFitnessAPI:
                        callback_uri=callback_uri, signature_type='AUTH_HEADER')
         
         # Send Request
-        r = requests.post(url=url,
+        r = self.request("POST", url,
                  headers={'Content-Type': 'application/x-www-form-urlencoded',
                           'Accept': 'application/x-www-form-urlencoded'},
                  auth=oauth)
@@ -100,10 +176,9 @@ class MapMyFitnessAPI:
                        resource_owner_secret=self.token_secret,
                        verifier=verifier)
     
-        r = requests.post(url=url, 
+        r = self.request("POST", url,
                 headers={'Content-Type': 'application/x-www-form-urlencoded',
                          'Accept': 'application/x-www-form-urlencoded'},
                 auth=oauth)
         
         return parse_qs(r.content)
-    
\ No newline at end of file
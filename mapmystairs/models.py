@@ -7,6 +7,10 @@
 from mapmystairs import db
 
 
+# workout directions
+DIRECTIONS = ('up', 'down')
+
+
 # Models
 class Organization(db.Model):
     """
@@ -68,15 +72,19 @@ class User(db.Model):
     last_name = db.Column(db.String(50))
     time_zone = db.Column(db.String(50))
     
-    # organization
+    # organization.  The users backref is a query, too long to load whole.
     organization_id = db.Column(db.Integer, db.ForeignKey('organization.id'))
     organization = db.relationship('Organization',
-                                      backref=db.backref('users'))
+                                   backref=db.backref('users',
+                                                      lazy='dynamic'))
     
     # mmf oauth params
     oauth_token = db.Column(db.String(255))
     oauth_token_secret = db.Column(db.String(255))
     
+    # epoch the profile was last fetched from MMF, see get_user_identity
+    profile_refreshed_at = db.Column(db.Float)
+    
     def __init__(self, id, username, email, first_name, last_name,
                  time_zone, organization_id, 
                  oauth_token, oauth_token_secret):
@@ -100,13 +108,28 @@ class Workout(db.Model):
     Local Representation of the MMF Workout which is tied to a 
     Stairwell and direction (up vs. down)
     """
+    __table_args__ = (
+        # fastest workouts per stairwell / direction, see
+        # query_fastest_workouts
+        db.Index('ix_workout_fastest',
+                 'stairwell_id', 'direction', 'time_taken'),
+        # date range filters
+        db.Index('ix_workout_stairwell_date', 'stairwell_id', 'workout_date'),
+        # a user's climb history, see query_workout_rows
+        db.Index('ix_workout_user_date', 'user_id', 'workout_date', 'id'),
+        # a synced climb is saved once, see add_climb
+        db.Index('ux_workout_user_client_climb', 'user_id', 'client_climb_id',
+                 unique=True),
+        )
+    
     id = db.Column(db.Integer, primary_key=True)  # is the mmf.workout.id
     workout_date = db.Column(db.DateTime)
     
-    # user
+    # user.  The workouts backrefs are queries, they are too long to load
+    # as a whole.
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    user = db.relationship("User", 
-        backref=db.backref('workouts', order_by=id))
+    user = db.relationship("User",
+        backref=db.backref('workouts', lazy='dynamic', order_by=id))
     
     # workout details
     time_taken = db.Column(db.Integer)
@@ -115,14 +138,17 @@ class Workout(db.Model):
     
     # stairwell
     stairwell_id = db.Column(db.Integer, db.ForeignKey('stairwell.id'))
-    stairwell = db.relationship("Stairwell", 
-        backref=db.backref('workouts', order_by=id))
+    stairwell = db.relationship("Stairwell",
+        backref=db.backref('workouts', lazy='dynamic', order_by=id))
     direction = db.Column(db.String(5))  # ie., up, down
     
+    # id the phone gave a synced climb, None for other workouts
+    client_climb_id = db.Column(db.String(64))
+    
     # methods
     def __init__(self, id, workout_date, user_id,
                  time_taken, number_of_steps, energy_burned,
-                 stairwell_id, direction):
+                 stairwell_id, direction, client_climb_id=None):
         
         self.id = id
         self.workout_date = workout_date
@@ -132,7 +158,180 @@ class Workout(db.Model):
         self.energy_burned = energy_burned
         self.stairwell_id = stairwell_id
         self.direction = direction
+        self.client_climb_id = client_climb_id
     
     def __repr__(self):
         return '<Workout: User %s on %s>' % (self.user_id, self.workout_date)
 
+
+
+class LeaderboardRollup(db.Model):
+    """
+    Per Stairwell / User / direction totals maintained alongside each 
+    Workout insert so the leaderboard doesn't have to GROUP BY workouts.
+    
+    Rebuild from existing workouts with: python manage.py rebuild_rollups
+    """
+    __table_args__ = (
+        # users within an organization, see query_organization_leaderboards
+        db.Index('ix_leaderboard_rollup_organization',
+                 'organization_id', 'stairwell_id'),
+        # rank order of a list, see sql_leaderboard_list
+        db.Index('ix_leaderboard_rollup_rank', 'stairwell_id', 'direction',
+                 'total_number_of_steps', 'user_id'),
+        )
+    
+    stairwell_id = db.Column(db.Integer, db.ForeignKey('stairwell.id'),
+                             primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    direction = db.Column(db.String(5), primary_key=True)  # ie., up, down
+    
+    # the user's organization, for ranking within an organization
+    organization_id = db.Column(db.Integer, db.ForeignKey('organization.id'))
+    
+    # aggregates
+    workout_count = db.Column(db.Integer, default=0)
+    min_time_taken = db.Column(db.Integer)
+    total_energy_burned = db.Column(db.Integer, default=0)
+    total_number_of_steps = db.Column(db.Integer, default=0)
+    
+    # methods
+    def __init__(self, stairwell_id, user_id, direction, organization_id=None,
+                 workout_count=0, min_time_taken=None,
+                 total_energy_burned=0, total_number_of_steps=0):
+        self.stairwell_id = stairwell_id
+        self.user_id = user_id
+        self.direction = direction
+        self.organization_id = organization_id
+        self.workout_count = workout_count
+        self.min_time_taken = min_time_taken
+        self.total_energy_burned = total_energy_burned
+        self.total_number_of_steps = total_number_of_steps
+    
+    def __repr__(self):
+        return '<LeaderboardRollup: User %s on %s %s>' % (self.user_id,
+                                                          self.stairwell_id,
+                                                          self.direction)
+
+
+class LeaderboardBucket(db.Model):
+    """
+    LeaderboardRollup totals bucketed by the (local) workout date so date
+    range leaderboards sum a few buckets instead of scanning workouts.
+    
+    Buckets are per day, days older than LEADERBOARD_BUCKET_RETENTION_DAYS
+    are compacted into a bucket per month dated the 1st of the month.
+    """
+    stairwell_id = db.Column(db.Integer, db.ForeignKey('stairwell.id'),
+                             primary_key=True)
+    bucket_date = db.Column(db.Date, primary_key=True)
+    period = db.Column(db.String(5), primary_key=True)  # ie., day, month
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    direction = db.Column(db.String(5), primary_key=True)  # ie., up, down
+    
+    # aggregates
+    workout_count = db.Column(db.Integer, default=0)
+    min_time_taken = db.Column(db.Integer)
+    total_energy_burned = db.Column(db.Integer, default=0)
+    total_number_of_steps = db.Column(db.Integer, default=0)
+    
+    # methods
+    def __init__(self, stairwell_id, bucket_date, period, user_id, direction,
+                 workout_count=0, min_time_taken=None,
+                 total_energy_burned=0, total_number_of_steps=0):
+        self.stairwell_id = stairwell_id
+        self.bucket_date = bucket_date
+        self.period = period
+        self.user_id = user_id
+        self.direction = direction
+        self.workout_count = workout_count
+        self.min_time_taken = min_time_taken
+        self.total_energy_burned = total_energy_burned
+        self.total_number_of_steps = total_number_of_steps
+    
+    def __repr__(self):
+        return '<LeaderboardBucket: User %s on %s %s %s>' % (
+                    self.user_id, self.stairwell_id, self.direction,
+                    self.bucket_date)
+
+
+class OrganizationRollup(db.Model):
+    """
+    Per Organization / Stairwell / direction totals so companies in the 
+    same building can compete, maintained like LeaderboardRollup.
+    """
+    organization_id = db.Column(db.Integer, db.ForeignKey('organization.id'),
+                                primary_key=True)
+    stairwell_id = db.Column(db.Integer, db.ForeignKey('stairwell.id'),
+                             primary_key=True)
+    direction = db.Column(db.String(5), primary_key=True)  # ie., up, down
+    
+    # aggregates
+    climber_count = db.Column(db.Integer, default=0)
+    workout_count = db.Column(db.Integer, default=0)
+    min_time_taken = db.Column(db.Integer)
+    total_energy_burned = db.Column(db.Integer, default=0)
+    total_number_of_steps = db.Column(db.Integer, default=0)
+    
+    # methods
+    def __init__(self, organization_id, stairwell_id, direction,
+                 climber_count=0, workout_count=0, min_time_taken=None,
+                 total_energy_burned=0, total_number_of_steps=0):
+        self.organization_id = organization_id
+        self.stairwell_id = stairwell_id
+        self.direction = direction
+        self.climber_count = climber_count
+        self.workout_count = workout_count
+        self.min_time_taken = min_time_taken
+        self.total_energy_burned = total_energy_burned
+        self.total_number_of_steps = total_number_of_steps
+    
+    def __repr__(self):
+        return '<OrganizationRollup: Organization %s on %s %s>' % (
+                    self.organization_id, self.stairwell_id, self.direction)
+
+
+class WorkoutSubmission(db.Model):
+    """
+    Durable queue of workouts waiting to be posted to the MMF API.  The 
+    local Workout is saved right away with a provisional (negative) id, 
+    -WorkoutSubmission.id, which is swapped for the mmf.workout.id once 
+    the post succeeded and was recorded (status 'posted').
+    
+    See mapmystairs.submissions
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    workout_id = db.Column(db.Integer)  # provisional, then mmf.workout.id
+    energy_burned = db.Column(db.Float)  # kcal, as calculated by MMF
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    
+    # vx workout json and the mmf oauth params to post it with
+    payload = db.Column(db.Text)
+    oauth_token = db.Column(db.String(255))
+    oauth_token_secret = db.Column(db.String(255))
+    
+    # queue state
+    # pending, posted (not reconciled yet), done, failed
+    status = db.Column(db.String(10), index=True)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, index=True)
+    last_error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime)
+    
+    # methods
+    def __init__(self, user_id, payload, oauth_token, oauth_token_secret,
+                 created_at):
+        self.user_id = user_id
+        self.payload = payload
+        self.oauth_token = oauth_token
+        self.oauth_token_secret = oauth_token_secret
+        self.status = 'pending'
+        self.attempts = 0
+        self.next_attempt_at = created_at
+        self.created_at = created_at
+    
+    def __repr__(self):
+        return '<WorkoutSubmission: %s for Workout %s (%s)>' % (
+                    self.id, self.workout_id, self.status)
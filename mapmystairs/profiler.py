@@ -0,0 +1,191 @@
+"""
+    SQL Profiler
+    ~~~~~~~~~~~~
+    Opt-in slow query log, see SQL_PROFILER in settings.  Statements slower
+    than SQL_PROFILER_THRESHOLD seconds are logged with their parameter
+    types, the view that ran them and their EXPLAIN plan, and the latest
+    SQL_PROFILER_SAMPLES of them are kept in memory for /admin/slow-queries.
+    Parameter values are never logged, they include the users' oauth
+    tokens.
+
+    Plans are fetched on a separate raw connection, once per distinct
+    statement, so a missing index shows up under real load at the cost of
+    one extra query per slow statement.
+"""
+import datetime
+import logging
+import threading
+import time
+from collections import deque
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# logging
+logger = logging.getLogger(__name__)
+
+
+class SlowQueryProfiler(object):
+    """
+    Collects statements slower than `threshold` seconds into a ring buffer
+    """
+
+    # plans are cached per statement, dropped once there are this many
+    MAX_PLANS = 500
+
+    def __init__(self, threshold=0.1, samples=100, explain=True):
+        self.threshold = threshold
+        self.explain = explain
+        self.samples = deque(maxlen=samples)
+        self.plans = {}
+        self._lock = threading.Lock()
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        context._profiler_started = time.time()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        seconds = time.time() - context._profiler_started
+        if seconds >= self.threshold:
+            self.record(conn, statement, parameters, executemany, seconds)
+
+    def record(self, conn, statement, parameters, executemany, seconds):
+        """
+        Log a slow statement and add it to the samples
+        """
+        if has_request_context():
+            view = request.endpoint
+            url = request.path
+        else:
+            view = threading.current_thread().name
+            url = None
+
+        plan = None
+        if self.explain and not executemany:
+            plan = self.get_plan(conn.engine, statement, parameters)
+
+        sample = {
+            'time': datetime.datetime.now(),
+            'seconds': seconds,
+            'statement': statement,
+            'parameters': describe_parameters(parameters, executemany),
+            'view': view,
+            'url': url,
+            'plan': plan
+            }
+        with self._lock:
+            self.samples.appendleft(sample)
+
+        logger.warning("Slow query, %.3fs in %s: %s %s%s", seconds, view,
+                       statement, sample['parameters'],
+                       format_plan(plan) if plan else '')
+
+    def get_plan(self, engine, statement, parameters):
+        """
+        :returns: dict with the plan's 'columns' and 'rows', None if the
+                  statement can't be explained
+        """
+        if not statement.lstrip().upper().startswith('SELECT'):
+            return None
+
+        with self._lock:
+            if statement in self.plans:
+                return self.plans[statement]
+
+        # raw connection, so the EXPLAIN isn't profiled or timed itself
+        explain = 'EXPLAIN QUERY PLAN ' if engine.dialect.name == 'sqlite' \
+                  else 'EXPLAIN '
+        plan = None
+        try:
+            connection = engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                cursor.execute(explain + statement, parameters)
+                plan = {
+                    'columns': [column[0] for column in cursor.description],
+                    'rows': [tuple(row) for row in cursor.fetchall()]
+                    }
+                cursor.close()
+            finally:
+                connection.close()
+        except Exception:
+            logger.exception("EXPLAIN failed: %s", statement)
+
+        with self._lock:
+            if len(self.plans) >= self.MAX_PLANS:
+                self.plans.clear()
+            self.plans[statement] = plan
+        return plan
+
+    def get_samples(self):
+        """
+        :returns: list, slow statement samples, newest first
+        """
+        with self._lock:
+            return list(self.samples)
+
+    def clear(self):
+        with self._lock:
+            self.samples.clear()
+            self.plans.clear()
+
+
+def describe_parameters(parameters, executemany=False):
+    """
+    Describe a statement's parameters by their keys and types only
+
+    :param parameters: DBAPI parameters, a dict or a sequence, or a list
+                       of them for executemany
+    :optparam bool executemany: if there is a list of parameter sets
+    :returns: str, ie., "{'user_id': int}" or "(int, unicode)"
+    """
+    def describe(values):
+        if isinstance(values, dict):
+            return '{%s}' % ', '.join('%r: %s' % (key, type(value).__name__)
+                                      for key, value
+                                      in sorted(values.items()))
+        return '(%s)' % ', '.join(type(value).__name__ for value in values)
+
+    if executemany:
+        if not parameters:
+            return '[]'
+        return '%s x %s' % (len(parameters), describe(parameters[0]))
+    return describe(parameters or ())
+
+
+def format_plan(plan):
+    """
+    :returns: str, the plan as indented text lines
+    """
+    lines = [' | '.join(plan['columns'])]
+    lines.extend(' | '.join(unicode(value) for value in row)
+                 for row in plan['rows'])
+    return ''.join('\n    ' + line for line in lines)
+
+
+# process wide profiler, None unless SQL_PROFILER is on
+profiler = None
+
+
+def init_profiler(app):
+    """
+    Start profiling every engine's statements if SQL_PROFILER is on
+
+    :param Flask app: the app
+    """
+    global profiler
+
+    if not app.config['SQL_PROFILER'] or profiler is not None:
+        return
+
+    profiler = SlowQueryProfiler(
+                    threshold=app.config['SQL_PROFILER_THRESHOLD'],
+                    samples=app.config['SQL_PROFILER_SAMPLES'],
+                    explain=app.config['SQL_PROFILER_EXPLAIN'])
+    event.listen(Engine, 'before_cursor_execute',
+                 profiler.before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute',
+                 profiler.after_cursor_execute)
@@ -0,0 +1,77 @@
+"""
+    Queries
+    ~~~~~~~
+    Queries for list pages.  Lists read lightweight rows, named tuples of
+    the columns shown joined in a single query, see query_workout_rows, so
+    they never lazy load their rows' relationships one query per row.
+
+    The `workouts` and `users` backrefs are dynamic queries, filter and
+    limit them instead of loading whole collections.
+"""
+import datetime
+from collections import namedtuple
+
+from sqlalchemy import and_, or_
+
+from mapmystairs import db
+from mapmystairs.models import Stairwell, Workout
+
+
+# a workout in a list, without the ORM entity
+WorkoutRow = namedtuple('WorkoutRow', ['id', 'workout_date', 'direction',
+                                       'time_taken', 'number_of_steps',
+                                       'energy_burned', 'stairwell_id',
+                                       'stairwell_name'])
+
+
+# functions
+def query_workout_rows(user_id, limit, before=None):
+    """
+    A page of a user's workouts, newest first, in a single query.
+    Workouts without a date aren't listed.
+
+    :param int user_id: User id
+    :param int limit: number of workouts
+    :optparam str before: cursor of the page, see workout_rows_cursor
+    :returns: list of WorkoutRows
+    """
+    query = db.session.query(Workout.id, Workout.workout_date,
+                             Workout.direction, Workout.time_taken,
+                             Workout.number_of_steps, Workout.energy_burned,
+                             Workout.stairwell_id, Stairwell.name)\
+                      .outerjoin(Stairwell,
+                                 Stairwell.id == Workout.stairwell_id)\
+                      .filter(Workout.user_id == user_id,
+                              Workout.workout_date.isnot(None))
+
+    # keyset, workouts older than the cursor
+    cursor = parse_workout_rows_cursor(before)
+    if cursor is not None:
+        workout_date, workout_id = cursor
+        query = query.filter(or_(Workout.workout_date < workout_date,
+                                 and_(Workout.workout_date == workout_date,
+                                      Workout.id < workout_id)))
+
+    query = query.order_by(Workout.workout_date.desc(), Workout.id.desc())\
+                 .limit(limit)
+    return [WorkoutRow(*row) for row in query]
+
+
+def workout_rows_cursor(row):
+    """
+    :param WorkoutRow row: last row of a page
+    :returns: str, the cursor of the next page
+    """
+    return "%s~%s" % (row.workout_date.strftime('%Y%m%d%H%M%S%f'), row.id)
+
+
+def parse_workout_rows_cursor(cursor):
+    """
+    :returns: (workout_date, id) tuple, None for a missing or invalid cursor
+    """
+    try:
+        workout_date, workout_id = cursor.split('~')
+        return (datetime.datetime.strptime(workout_date, '%Y%m%d%H%M%S%f'),
+                int(workout_id))
+    except (AttributeError, ValueError):
+        return None
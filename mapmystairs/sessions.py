@@ -0,0 +1,192 @@
+"""
+    Sessions
+    ~~~~~~~~
+    Server-side sessions kept in the session cache, apart from the
+    leaderboards so they're never evicted.  The cookie only carries a short
+    random session id, the user dict, oauth tokens and any active climb stay
+    on the server.  The session id is replaced on login, see rotate_session.
+"""
+import base64
+import datetime
+import os
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+import pytz
+
+from mapmystairs import app, session_cache
+
+
+# classes
+class CacheSession(CallbackDict, SessionMixin):
+    """
+    Session dict stored in the cache under its session id
+    """
+
+    def __init__(self, initial=None, sid=None, new=False):
+
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class CacheSessionInterface(SessionInterface):
+    """
+    Session interface that keeps session data in the cache and only sends
+    the session id to the browser
+    """
+    session_class = CacheSession
+
+    def __init__(self, cache, prefix='session-'):
+        self.cache = cache
+        self.prefix = prefix
+
+    def generate_sid(self):
+        """
+        :returns: str, 22 character url safe random session id
+        """
+        return base64.urlsafe_b64encode(os.urandom(16)).rstrip('=')
+
+    def get_session_timeout(self, app):
+        """
+        :returns: int, seconds to keep a session in the cache
+        """
+        lifetime = app.permanent_session_lifetime
+        return lifetime.days * 86400 + lifetime.seconds
+
+    def open_session(self, app, request):
+
+        # load existing session
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            data = self.cache.get(self.prefix + sid)
+            if data is not None:
+                return self.session_class(data, sid=sid)
+
+        # new session, only stored once something is added
+        return self.session_class(sid=self.generate_sid(), new=True)
+
+    def rotate_session(self, session):
+        """
+        Move a session to a new session id, ie., on login so a session id
+        planted before the login can't be used after it.  The active climb
+        moves along.
+
+        :param CacheSession session: the current session
+        """
+        sid = session.sid
+        self.cache.delete(self.prefix + sid)
+
+        session.sid = self.generate_sid()
+        session.modified = True
+
+        climb = get_active_climb(sid)
+        if climb is not None:
+            set_active_climb(session.sid, climb)
+            clear_active_climb(sid)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        # drop emptied sessions
+        if not session:
+            if session.modified:
+                self.cache.delete(self.prefix + session.sid)
+                clear_active_climb(session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+
+        # unchanged sessions don't need to be written back
+        if not session.modified:
+            return
+
+        self.cache.set(self.prefix + session.sid, dict(session),
+                       timeout=self.get_session_timeout(app))
+        response.set_cookie(app.session_cookie_name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app))
+
+
+class ActiveClimb(object):
+    """
+    In progress stair climb, started at the scan of one end of a stairwell
+    and finished at the scan of the other end
+    """
+    __slots__ = ('stairwell_id', 'direction', 'start_epoch',
+                 'number_of_steps', 'name', 'notes', 'time_zone',
+                 'activity_type_id')
+
+    def __init__(self, stairwell_id, direction, start_epoch,
+                 number_of_steps, name, notes, time_zone,
+                 activity_type_id=133):
+        self.stairwell_id = stairwell_id
+        self.direction = direction
+        self.start_epoch = start_epoch
+        self.number_of_steps = number_of_steps
+        self.name = name
+        self.notes = notes
+        self.time_zone = time_zone
+        self.activity_type_id = activity_type_id
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return '<ActiveClimb %r %r %r>' % (self.stairwell_id, self.direction,
+                                           self.start_epoch)
+
+    @property
+    def start_datetime(self):
+        """
+        :returns: datetime, UTC start of the climb
+        """
+        return datetime.datetime.fromtimestamp(self.start_epoch, pytz.utc)
+
+    def elapsed(self, now=None):
+        """
+        :optparam float now: epoch to measure to, defaults to now
+        :returns: float, seconds since the climb started
+        """
+        if now is None:
+            now = time.time()
+        return now - self.start_epoch
+
+
+# functions
+def get_active_climb(sid):
+    """
+    :param str sid: Session id
+    :returns: ActiveClimb or None if there isn't one or it expired
+    """
+    return session_cache.get('climb-%s' % sid)
+
+
+def set_active_climb(sid, climb):
+    """
+    Store the active climb, it expires after ACTIVE_CLIMB_TIMEOUT seconds
+
+    :param str sid: Session id
+    :param ActiveClimb climb: climb to store
+    """
+    session_cache.set('climb-%s' % sid, climb,
+                      timeout=app.config['ACTIVE_CLIMB_TIMEOUT'])
+
+
+def clear_active_climb(sid):
+    """
+    :param str sid: Session id
+    """
+    session_cache.delete('climb-%s' % sid)
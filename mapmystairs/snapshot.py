@@ -0,0 +1,462 @@
+"""
+    Leaderboard Snapshot
+    ~~~~~~~~~~~~~~~~~~~~
+    Compact, columnar copy of the all-time leaderboards in a local file so
+    a freshly started worker can serve boards right away, while a single
+    background refresh per board queries the database, instead of every
+    first request waiting on the full leaderboard SQL.
+
+    The file holds typed columns (see the `array` module) in native byte
+    order: each stairwell / direction list in rank order, the podiums, the
+    stairwell totals and the users' names.  Workers memory-map it and only
+    copy out the rows of a board they serve.  It is rewritten atomically
+    by one worker at most every LEADERBOARD_SNAPSHOT_INTERVAL seconds, or
+    with `manage.py write_snapshot`.
+"""
+import array
+import bisect
+import calendar
+import datetime
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from sqlalchemy.sql import text
+
+from mapmystairs import app, cache
+from mapmystairs.database import get_read_engine
+from mapmystairs.models import DIRECTIONS
+
+
+# logging
+logger = logging.getLogger(__name__)
+
+# file layout: header, column index, column data
+MAGIC = 'MMSL'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHBdI')  # magic, version, big endian, time, count
+INDEX_ENTRY = struct.Struct('<48scBQQ')  # name, typecode, size, count, offset
+
+# list columns, in rank order
+LIST_COLUMNS = (('user_id', 'i'), ('workout_count', 'i'),
+                ('min_time_taken', 'd'), ('total_energy_burned', 'd'),
+                ('total_number_of_steps', 'i'))
+
+# podium columns, fastest first
+PODIUM_COLUMNS = (('user_id', 'i'), ('workout_date', 'd'),
+                  ('time_taken', 'd'), ('energy_burned', 'd'),
+                  ('number_of_steps', 'i'))
+
+
+class LeaderboardSnapshot(object):
+    """
+    Read-only, memory-mapped leaderboard snapshot file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+
+        f = open(path, 'rb')
+        try:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        # header and column index
+        magic, version, big_endian, self.created_at, count = \
+                HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC or version != FORMAT_VERSION \
+                or big_endian != (sys.byteorder == 'big'):
+            raise ValueError("Unsupported snapshot %s" % path)
+
+        self.columns = {}
+        for n in range(count):
+            name, typecode, itemsize, length, offset = \
+                    INDEX_ENTRY.unpack_from(self.mmap,
+                                            HEADER.size + n * INDEX_ENTRY.size)
+            if array.array(typecode).itemsize != itemsize:
+                raise ValueError("Unsupported snapshot %s" % path)
+            self.columns[name.rstrip('\0')] = (typecode, itemsize, length,
+                                              offset)
+
+        # users are looked up by id for their names
+        self.user_ids = self.column('users/id')
+        self.name_offsets = self.column('users/name_offsets')
+        totals = zip(self.column('stairwells/id'),
+                     self.column('stairwells/climber_count'),
+                     self.column('stairwells/total_number_of_steps'))
+        self.totals = dict((s, (climbers, steps))
+                           for s, climbers, steps in totals)
+
+    def close(self):
+        self.mmap.close()
+
+    def column(self, name, limit=None):
+        """
+        :param str name: column name, ie., "1/up/user_id"
+        :optparam int limit: only copy the first `limit` values
+        :returns: array of the column, empty if there is no such column
+        """
+        if name not in self.columns:
+            return array.array('i')
+
+        typecode, itemsize, length, offset = self.columns[name]
+        if limit is not None:
+            length = min(length, limit)
+
+        values = array.array(typecode)
+        values.fromstring(self.mmap[offset:offset + length * itemsize])
+        return values
+
+    def get_user_names(self, user_id):
+        """
+        :returns: (first_name, last_name) tuple
+        """
+        n = bisect.bisect_left(self.user_ids, user_id)
+        if n == len(self.user_ids) or self.user_ids[n] != user_id:
+            return None, None
+
+        typecode, itemsize, length, offset = self.columns['users/names']
+        names = self.mmap[offset + self.name_offsets[n]:
+                          offset + self.name_offsets[n + 1]]
+        first_name, last_name = names.decode('utf-8').split('\0')
+        return first_name, last_name
+
+    def get_leaderboard(self, stairwell_id, page_size, podium_size):
+        """
+        Build a stairwell's all-time leaderboard like query_leaderboards
+
+        :returns: dict, the leaderboard or None if it's not in the snapshot
+        """
+        from mapmystairs.utils import build_leaderboard_page
+
+        if stairwell_id not in self.totals:
+            return None
+
+        podium = {}
+        pages = {}
+        for direction in DIRECTIONS:
+
+            # podium
+            prefix = '%s/podium-%s/' % (stairwell_id, direction)
+            columns = [self.column(prefix + name, podium_size)
+                       for name, typecode in PODIUM_COLUMNS]
+            podium[direction] = []
+            for user_id, date, time_taken, energy, steps in zip(*columns):
+                first_name, last_name = self.get_user_names(user_id)
+                podium[direction].append({
+                    'user_id': user_id,
+                    'first_name': first_name,
+                    'last_name': last_name,
+                    'workout_date': datetime.datetime.utcfromtimestamp(date),
+                    'time_taken': number(time_taken),
+                    'energy_burned': number(energy),
+                    'number_of_steps': steps
+                    })
+
+            # first page of the list
+            prefix = '%s/%s/' % (stairwell_id, direction)
+            columns = [self.column(prefix + name, page_size + 1)
+                       for name, typecode in LIST_COLUMNS]
+            rows = []
+            for user_id, count, min_time, energy, steps in zip(*columns):
+                first_name, last_name = self.get_user_names(user_id)
+                rows.append({
+                    'user_id': user_id,
+                    'first_name': first_name,
+                    'last_name': last_name,
+                    'direction': direction,
+                    'workout_count': count,
+                    'min_time_taken': number(min_time),
+                    'total_energy_burned': number(energy),
+                    'total_number_of_steps': steps
+                    })
+            pages[direction] = build_leaderboard_page(rows, page_size)
+
+        climber_count, total_number_of_steps = self.totals[stairwell_id]
+        return {
+            'fastest_up': (podium['up'] or [None])[0],
+            'fastest_down': (podium['down'] or [None])[0],
+            'podium': podium,
+            'pages': pages,
+            'climber_count': climber_count,
+            'total_number_of_steps': int(total_number_of_steps),
+            'version': 'snapshot-%d' % self.created_at
+            }
+
+
+def number(value):
+    """
+    :returns: the float as an int if it's whole, like the database returns
+              integer columns
+    """
+    return int(value) if value == int(value) else value
+
+
+def epoch(value):
+    """
+    :param value: naive datetime, or a string for SQLite
+    :returns: int, the datetime as seconds since the epoch
+    """
+    if isinstance(value, basestring):
+        value = datetime.datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+    return calendar.timegm(value.timetuple())
+
+
+# writing
+def write_leaderboard_snapshot(path):
+    """
+    Query all of the all-time leaderboards and write them to a snapshot
+    file, replacing the previous one atomically
+
+    :param str path: snapshot file
+    :returns: int, number of list rows written
+    """
+    from mapmystairs.utils import query_fastest_workouts
+
+    engine = get_read_engine()
+    columns = []
+
+    # lists, in rank order, like sql_leaderboard_list
+    lists = {}
+    names = {}
+    results = engine.execute(text("""
+        SELECT
+            r.stairwell_id, r.direction, u.id as user_id, r.workout_count,
+            r.min_time_taken, r.total_energy_burned, r.total_number_of_steps,
+            u.first_name, u.last_name
+        FROM
+            leaderboard_rollup r
+            INNER JOIN user u ON u.id = r.user_id
+        ORDER BY
+            r.stairwell_id, r.direction, r.total_number_of_steps DESC,
+            r.user_id ASC;
+        """))
+    for r in results:
+        lists.setdefault((r[0], r[1]), []).append(r[2:7])
+        names[r[2]] = (r[7], r[8])
+
+    rows = 0
+    for (stairwell_id, direction), values in sorted(lists.items()):
+        rows += len(values)
+        for n, (name, typecode) in enumerate(LIST_COLUMNS):
+            columns.append(('%s/%s/%s' % (stairwell_id, direction, name),
+                            typecode, [v[n] or 0 for v in values]))
+
+    # totals, like query_leaderboards
+    totals = {}
+    results = engine.execute(text("""
+        SELECT
+            stairwell_id, COUNT(DISTINCT user_id),
+            SUM(total_number_of_steps)
+        FROM
+            leaderboard_rollup
+        GROUP BY
+            stairwell_id;
+        """))
+    for r in results:
+        totals[r[0]] = (r[1], int(r[2] or 0))
+
+    stairwell_ids = sorted(totals)
+    columns.append(('stairwells/id', 'i', stairwell_ids))
+    columns.append(('stairwells/climber_count', 'i',
+                    [totals[s][0] for s in stairwell_ids]))
+    columns.append(('stairwells/total_number_of_steps', 'd',
+                    [totals[s][1] for s in stairwell_ids]))
+
+    # podiums
+    fastest_workouts = query_fastest_workouts(
+                            stairwell_ids,
+                            limit=app.config['LEADERBOARD_PODIUM_SIZE'])
+    for (stairwell_id, direction), workouts in \
+            sorted(fastest_workouts.items()):
+        values = [(w['user_id'],
+                   epoch(w['workout_date']),
+                   w['time_taken'] or 0, w['energy_burned'] or 0,
+                   w['number_of_steps'] or 0) for w in workouts]
+        for n, (name, typecode) in enumerate(PODIUM_COLUMNS):
+            columns.append(('%s/podium-%s/%s' % (stairwell_id, direction,
+                                                 name),
+                            typecode, [v[n] for v in values]))
+        names.update((w['user_id'], (w['first_name'], w['last_name']))
+                     for w in workouts)
+
+    # names of everyone on a board
+    user_ids = sorted(names)
+    blob = []
+    offsets = [0]
+    for user_id in user_ids:
+        first_name, last_name = names[user_id]
+        name = u'%s\0%s' % (first_name or u'', last_name or u'')
+        blob.append(name.encode('utf-8'))
+        offsets.append(offsets[-1] + len(blob[-1]))
+    columns.append(('users/id', 'i', user_ids))
+    columns.append(('users/name_offsets', 'i', offsets))
+    columns.append(('users/names', 'c', ''.join(blob)))
+
+    write_columns(path, columns)
+    return rows
+
+
+def write_columns(path, columns):
+    """
+    Write (name, typecode, values) columns to a snapshot file, through a
+    temporary file so readers never see a partial snapshot
+    """
+    arrays = [(name, array.array(typecode, values))
+              for name, typecode, values in columns]
+
+    # column data follows the header and index
+    offset = HEADER.size + INDEX_ENTRY.size * len(arrays)
+    index = []
+    for name, values in arrays:
+        index.append(INDEX_ENTRY.pack(str(name), values.typecode,
+                                      values.itemsize, len(values), offset))
+        offset += len(values) * values.itemsize
+
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION,
+                                sys.byteorder == 'big', time.time(),
+                                len(arrays)))
+            f.write(''.join(index))
+            for name, values in arrays:
+                values.tofile(f)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+# reading
+_snapshot = None
+_snapshot_lock = threading.Lock()
+_write_checked_at = [0]
+
+
+def get_leaderboard_snapshot():
+    """
+    :returns: LeaderboardSnapshot of this process, reopened when the file
+              was rewritten, or None if there is no snapshot
+    """
+    global _snapshot
+
+    path = app.config['LEADERBOARD_SNAPSHOT_PATH']
+    if not path:
+        return None
+
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.mtime != mtime:
+            try:
+                snapshot = LeaderboardSnapshot(path)
+            except Exception:
+                logger.exception("Opening leaderboard snapshot %s failed",
+                                 path)
+                return _snapshot
+            _snapshot = snapshot
+            logger.info("Opened leaderboard snapshot %s from %s", path,
+                        datetime.datetime.utcfromtimestamp(
+                                                snapshot.created_at))
+
+    return _snapshot
+
+
+def get_snapshot_leaderboards(stairwell_ids):
+    """
+    :param list stairwell_ids: Stairwell ids
+    :returns: dict of stairwell_id -> all-time leaderboard, only for the
+              stairwells in the snapshot
+    """
+    snapshot = get_leaderboard_snapshot()
+    if snapshot is None:
+        return {}
+
+    page_size = app.config['LEADERBOARD_PAGE_SIZE']
+    podium_size = app.config['LEADERBOARD_PODIUM_SIZE']
+    leaderboards = {}
+    for stairwell_id in stairwell_ids:
+        try:
+            leaderboard = snapshot.get_leaderboard(stairwell_id, page_size,
+                                                   podium_size)
+        except Exception:
+            logger.exception("Reading leaderboard snapshot failed")
+            return leaderboards
+        if leaderboard is not None:
+            leaderboards[stairwell_id] = leaderboard
+
+    return leaderboards
+
+
+def write_leaderboard_snapshot_async():
+    """
+    Rewrite the snapshot in a background thread if it's older than
+    LEADERBOARD_SNAPSHOT_INTERVAL seconds, one writer across processes
+    """
+    path = app.config['LEADERBOARD_SNAPSHOT_PATH']
+    interval = app.config['LEADERBOARD_SNAPSHOT_INTERVAL']
+    if not path or not interval:
+        return
+
+    # check the file at most once a minute per process
+    now = time.time()
+    if now - _write_checked_at[0] < 60:
+        return
+    _write_checked_at[0] = now
+
+    try:
+        if now - os.path.getmtime(path) < interval:
+            return
+    except OSError:
+        pass
+
+    lock_key = 'leaderboard-snapshot-lock'
+    lock_token = uuid.uuid4().hex
+    cache.add(lock_key, lock_token, timeout=interval)
+    if cache.get(lock_key) != lock_token:
+        return
+
+    def run():
+        with app.app_context():
+            try:
+                started = time.time()
+                rows = write_leaderboard_snapshot(path)
+                logger.info("Wrote leaderboard snapshot, %s rows in %.2fs",
+                            rows, time.time() - started)
+            except Exception:
+                logger.exception("Writing leaderboard snapshot failed")
+
+    thread = threading.Thread(target=run, name="leaderboard-snapshot")
+    thread.daemon = True
+    thread.start()
+
+
+@app.before_first_request
+def load_leaderboard_snapshot():
+    get_leaderboard_snapshot()
+
+
+@app.before_request
+def refresh_leaderboard_snapshot():
+    write_leaderboard_snapshot_async()
@@ -0,0 +1,237 @@
+"""
+    Stairwell Registry
+    ~~~~~~~~~~~~~~~~~~
+    Stairwells rarely change, so every process keeps all of them in memory
+    and looks them up by id or by location without a query.  Commits that
+    change a stairwell bump a version in the shared cache and every process
+    reloads its registry when it notices the new version.
+"""
+import logging
+import threading
+import time
+
+from flask import request, url_for
+from sqlalchemy import event, orm
+
+from mapmystairs import app, cache
+from mapmystairs.caching import LRUCache
+from mapmystairs.database import fresh_reads, get_read_engine, new_version
+from mapmystairs.models import Stairwell
+
+
+# logging
+logger = logging.getLogger(__name__)
+
+
+class StairwellRegistry(object):
+    """
+    Read-mostly, in-process index of all Stairwells.  Stairwells are
+    detached from the session so they can be shared between threads.
+    Hotlinks are kept for the `hotlinks_size` most recent stairwells and
+    hosts, the Host header comes from the client.
+    """
+
+    def __init__(self, check_interval=10, hotlinks_size=1000):
+        self.check_interval = check_interval
+        self.version = None
+        self.checked_at = 0
+        self.stairwells = []
+        self.by_id = {}
+        self.by_location = {}
+        self.hotlinks = LRUCache(maxsize=hotlinks_size, ttl=24 * 60 * 60)
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        (Re)load all stairwells from the database
+        """
+        version = get_stairwells_version()
+
+        # separate session on the read engine, so closing it detaches only
+        # our copies
+        with fresh_reads(version):
+            session = orm.Session(bind=get_read_engine())
+        try:
+            stairwells = session.query(Stairwell)\
+                            .order_by(Stairwell.id).all()
+        finally:
+            session.close()
+
+        # build the indexes, then swap them in
+        by_id = dict((stairwell.id, stairwell) for stairwell in stairwells)
+        by_location = {}
+        for stairwell in stairwells:
+            key = location_key(stairwell.city, stairwell.postal_code)
+            by_location[key] = by_location.get(key, ()) + (stairwell,)
+
+        with self._lock:
+            self.stairwells = stairwells
+            self.by_id = by_id
+            self.by_location = by_location
+            self.hotlinks.clear()
+            self.version = version
+            self.checked_at = time.time()
+
+        logger.info("Loaded %s stairwells, version %s", len(stairwells),
+                    version)
+
+    def refresh(self):
+        """
+        Reload if never loaded or another process changed a stairwell, the
+        shared version is checked at most every `check_interval` seconds
+        """
+        if self.version is not None \
+                and time.time() - self.checked_at < self.check_interval:
+            return
+
+        self.checked_at = time.time()
+        if self.version is None or self.version != get_stairwells_version():
+            self.load()
+
+    def get(self, stairwell_id):
+        """
+        :param int stairwell_id: Stairwell id
+        :returns: Stairwell or None
+        """
+        self.refresh()
+        return self.by_id.get(stairwell_id)
+
+    def all(self):
+        """
+        :returns: list, all Stairwells ordered by id
+        """
+        self.refresh()
+        return self.stairwells
+
+    def find(self, city, postal_code):
+        """
+        :param str city: City of the stairwell
+        :param str postal_code: Postal code of the stairwell
+        :returns: tuple, Stairwells at the location
+        """
+        self.refresh()
+        return self.by_location.get(location_key(city, postal_code), ())
+
+    def get_hotlinks(self, stairwell):
+        """
+        QR code hotlinks starting a climb at the bottom (up) or top (down)
+        of a stairwell.  Built once per stairwell and host, the least
+        recently used are dropped.
+
+        :param Stairwell stairwell: Stairwell to link to
+        :returns: dict, external workout url by direction
+        """
+        key = (request.url_root, stairwell.id)
+        hotlinks = self.hotlinks.get(key)
+
+        if hotlinks is None:
+            hotlinks = dict((direction,
+                             url_for('workout', stairwell_id=stairwell.id,
+                                     direction=direction, _external=True))
+                            for direction in ('up', 'down'))
+            self.hotlinks.set(key, hotlinks)
+
+        return hotlinks
+
+
+# process wide registry
+registry = StairwellRegistry(
+            check_interval=app.config['STAIRWELL_REGISTRY_CHECK_INTERVAL'])
+
+
+# functions
+def get_stairwell(stairwell_id):
+    """
+    :param int stairwell_id: Stairwell id
+    :returns: Stairwell or None
+    """
+    return registry.get(stairwell_id)
+
+
+def get_stairwells():
+    """
+    :returns: list, all Stairwells ordered by id
+    """
+    return registry.all()
+
+
+def get_registry_version():
+    """
+    :returns: str, version of the stairwells loaded in this process, ie., 
+              to key cached fragments rendered from them
+    """
+    registry.refresh()
+    return registry.version
+
+
+def find_stairwells(city, postal_code):
+    """
+    :param str city: City of the stairwell
+    :param str postal_code: Postal code of the stairwell
+    :returns: tuple, Stairwells at the location
+    """
+    return registry.find(city, postal_code)
+
+
+def get_stairwell_hotlinks(stairwell):
+    """
+    :param Stairwell stairwell: Stairwell to link to
+    :returns: dict, external workout url by direction
+    """
+    return registry.get_hotlinks(stairwell)
+
+
+def location_key(city, postal_code):
+    """
+    :returns: tuple, normalized (city, postal_code) lookup key
+    """
+    return ((city or '').strip().lower(), (postal_code or '').strip())
+
+
+def get_stairwells_version():
+    """
+    The version expires with the default cache timeout, so stairwells 
+    edited outside the app are picked up too.
+    
+    :returns: str, shared version of the stairwell table
+    """
+    version = cache.get('stairwells-version')
+    if version is None:
+        cache.add('stairwells-version', new_version())
+        version = cache.get('stairwells-version')
+    return version
+
+
+def invalidate_stairwells():
+    """
+    Make every process reload its stairwell registry
+    """
+    cache.set('stairwells-version', new_version())
+
+    # reload this process right away
+    registry.version = None
+
+
+@app.before_first_request
+def load_stairwells():
+    registry.refresh()
+
+
+# invalidate after commits that change a stairwell
+def stairwell_changed(mapper, connection, target):
+    orm.object_session(target).info['stairwells_changed'] = True
+
+
+def session_committed(session):
+    if session.info.pop('stairwells_changed', False):
+        invalidate_stairwells()
+
+
+def session_rolled_back(session):
+    session.info.pop('stairwells_changed', None)
+
+
+for operation in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Stairwell, operation, stairwell_changed)
+event.listen(orm.Session, 'after_commit', session_committed)
+event.listen(orm.Session, 'after_rollback', session_rolled_back)
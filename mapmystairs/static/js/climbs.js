@@ -0,0 +1,88 @@
+/*
+ * Climbs timed on the phone.  Finished climbs are kept in localStorage
+ * until they are synced to /workout/sync, so climbs finished without a
+ * connection are uploaded once the phone is back online.
+ */
+var Climbs = (function ($) {
+    var KEY = 'mapmystairs-climbs';
+    var syncing = false;
+
+    function pending() {
+        try {
+            return JSON.parse(window.localStorage.getItem(KEY)) || [];
+        } catch (e) {
+            return [];
+        }
+    }
+
+    function store(climbs) {
+        try {
+            window.localStorage.setItem(KEY, JSON.stringify(climbs));
+        } catch (e) {}
+    }
+
+    function clientId() {
+        return new Date().getTime().toString(36) + '-' +
+               Math.random().toString(36).slice(2);
+    }
+
+    function add(climb) {
+        var climbs = pending();
+        climb.client_id = clientId();
+        climbs.push(climb);
+        store(climbs);
+        return climb;
+    }
+
+    // upload pending climbs, done(synced) is called with false if they
+    // couldn't be uploaded and are kept for the next try
+    function sync(url, max, done) {
+        var climbs = pending().slice(0, max);
+        done = done || function () {};
+
+        if (syncing || !climbs.length) {
+            done(!climbs.length);
+            return;
+        }
+
+        syncing = true;
+        $.ajax({
+            url: url,
+            type: 'POST',
+            contentType: 'application/json',
+            dataType: 'json',
+            data: JSON.stringify({climbs: climbs})
+        }).done(function (result) {
+            // drop saved, duplicate and rejected climbs
+            var handled = {};
+            $.each(result.saved.concat(result.duplicates), function (i, id) {
+                handled[id] = true;
+            });
+            $.each(result.rejected, function (i, rejected) {
+                handled[rejected.client_id] = true;
+            });
+            store($.grep(pending(), function (climb) {
+                return !handled[climb.client_id];
+            }));
+            done(true, result);
+        }).fail(function () {
+            done(false);
+        }).always(function () {
+            syncing = false;
+        });
+    }
+
+    // sync now, when the phone comes back online and every minute
+    function autoSync(url, max) {
+        var run = function () {
+            if (pending().length) {
+                sync(url, max);
+            }
+        };
+        run();
+        $(window).on('online', run);
+        setInterval(run, 60000);
+    }
+
+    return {add: add, pending: pending, sync: sync, autoSync: autoSync};
+})(jQuery);
@@ -0,0 +1,359 @@
+"""
+    Leaderboard Stream
+    ~~~~~~~~~~~~~~~~~~
+    Pushes leaderboard changes to lobby displays as Server-Sent Events.
+
+    Each process has one broadcaster fanning events out to its subscribers.
+    Climbs are appended to a per stairwell event log in the shared cache
+    before the leaderboard version is bumped, then published to the local
+    subscribers.  The broadcaster polls the versions of the stairwells it
+    has subscribers for and reads every event appended after its position
+    in the log when one changes, so climbs saved by other processes are
+    delivered too, even several saves within one poll, and idle subscribers
+    cost a single cache lookup per poll instead of database queries.
+
+    The log is a sequence number, 'leaderboard-events-<stairwell_id>', and
+    an entry per event, 'leaderboard-event-<stairwell_id>-<sequence>', which
+    is claimed with an atomic cache add.  The sequence is the event's id.
+"""
+import logging
+import threading
+import time
+import uuid
+from Queue import Empty, Full, Queue
+
+import simplejson
+
+from mapmystairs import app, cache
+from mapmystairs.database import primary_reads
+from mapmystairs.utils import (get_leaderboard_version,
+                               get_leaderboard_versions,
+                               invalidate_leaderboard,
+                               query_fastest_workouts, query_leaderboard_rank)
+
+
+# logging
+logger = logging.getLogger(__name__)
+
+# sequence numbers tried before an event is dropped from the log
+EVENT_LOG_ATTEMPTS = 100
+
+
+class LeaderboardBroadcaster(threading.Thread):
+    """
+    Background thread fanning leaderboard events out to the subscriber
+    queues of this process
+    """
+
+    def __init__(self, poll_interval, queue_size=100):
+        threading.Thread.__init__(self, name="leaderboard-stream")
+        self.daemon = True
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.subscribers = {}
+        self.versions = {}
+        self.positions = {}
+        self.sent = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, stairwell_id, version, position):
+        """
+        :param int stairwell_id: Stairwell to follow
+        :param str version: current leaderboard version of the stairwell
+        :param int position: current sequence of the stairwell's event log,
+                             see get_event_position
+        :returns: Queue of events for the subscriber
+        """
+        queue = Queue(maxsize=self.queue_size)
+        with self.lock:
+            self.subscribers.setdefault(stairwell_id, set()).add(queue)
+            self.versions.setdefault(stairwell_id, version)
+            self.positions.setdefault(stairwell_id, position)
+        return queue
+
+    def unsubscribe(self, stairwell_id, queue):
+        with self.lock:
+            queues = self.subscribers.get(stairwell_id, set())
+            queues.discard(queue)
+            if not queues:
+                self.subscribers.pop(stairwell_id, None)
+                self.versions.pop(stairwell_id, None)
+                self.positions.pop(stairwell_id, None)
+                self.sent.pop(stairwell_id, None)
+
+    def publish(self, stairwell_id, events):
+        """
+        Broadcast events appended to the log by this process, the next poll
+        skips them
+        """
+        with self.lock:
+            if stairwell_id not in self.subscribers:
+                return
+            self.sent.setdefault(stairwell_id, set())\
+                .update(event['id'] for event in events)
+
+        for event in events:
+            self.broadcast(stairwell_id, event)
+
+    def broadcast(self, stairwell_id, event):
+        """
+        Put an event on every subscriber queue of a stairwell, slow
+        subscribers lose their oldest events
+        """
+        with self.lock:
+            queues = list(self.subscribers.get(stairwell_id, ()))
+
+        for queue in queues:
+            while True:
+                try:
+                    queue.put_nowait(event)
+                    break
+                except Full:
+                    try:
+                        queue.get_nowait()
+                    except Empty:
+                        pass
+
+    def poll(self):
+        """
+        Broadcast changes made by other processes
+        """
+        with self.lock:
+            seen = dict(self.versions)
+            positions = dict(self.positions)
+            stairwell_ids = list(self.subscribers)
+
+        if not stairwell_ids:
+            return
+
+        versions = get_leaderboard_versions(stairwell_ids)
+        for stairwell_id, version in versions.items():
+            if seen.get(stairwell_id) == version:
+                continue
+
+            # every climb since the last poll, the ones published by this
+            # process were broadcast already
+            events, position = read_events(stairwell_id,
+                                           positions.get(stairwell_id, 0),
+                                           limit=self.queue_size)
+            with self.lock:
+                if stairwell_id not in self.subscribers:
+                    continue
+                self.versions[stairwell_id] = version
+                self.positions[stairwell_id] = position
+                sent = self.sent.get(stairwell_id, set())
+                new_events = [e for e in events if e['id'] not in sent]
+                sent.difference_update(s for s in list(sent)
+                                       if s <= position)
+
+            # and an update if the version wasn't bumped by a climb
+            if not any(e['version'] == version for e in events):
+                new_events.append({
+                    'id': version,
+                    'type': 'update',
+                    'stairwell_id': stairwell_id,
+                    'time': time.time()
+                    })
+            for event in new_events:
+                self.broadcast(stairwell_id, event)
+
+    def run(self):
+        while True:
+            time.sleep(self.poll_interval)
+
+            with app.app_context():
+                try:
+                    self.poll()
+                except Exception:
+                    logger.exception("Polling leaderboard versions failed")
+
+
+# one broadcaster per process, started on first use
+_broadcaster = None
+_broadcaster_lock = threading.Lock()
+
+
+def get_broadcaster():
+    """
+    :returns: LeaderboardBroadcaster of this process
+    """
+    global _broadcaster
+
+    with _broadcaster_lock:
+        if _broadcaster is None or not _broadcaster.is_alive():
+            _broadcaster = LeaderboardBroadcaster(
+                    app.config['LEADERBOARD_STREAM_POLL_INTERVAL'])
+            _broadcaster.start()
+
+    return _broadcaster
+
+
+def get_event_position(stairwell_id):
+    """
+    :param int stairwell_id: Stairwell id
+    :returns: int, sequence of the last event in the stairwell's log or 0
+    """
+    return cache.get('leaderboard-events-%s' % stairwell_id) or 0
+
+
+def append_events(stairwell_id, events, version):
+    """
+    Append events to a stairwell's event log.  Each event claims the next
+    free sequence number with an atomic add, stored with a token to tell
+    whether the add won, so concurrent writers never overwrite each
+    other's events.  A new log starts at the current time
+    in milliseconds, so a log that expired never reuses sequence numbers.
+
+    :param int stairwell_id: Stairwell id
+    :param list events: events to append
+    :param str version: leaderboard version the events bump to
+    :returns: list of the appended events, with their sequence as 'id' and
+              the 'version'
+    """
+    timeout = app.config['LEADERBOARD_STREAM_EVENT_TIMEOUT']
+    sequence = get_event_position(stairwell_id) or int(time.time() * 1000)
+    token = uuid.uuid4().hex
+
+    appended = []
+    for event in events:
+        for attempt in range(EVENT_LOG_ATTEMPTS):
+            sequence += 1
+            event = dict(event, id=sequence, version=version)
+            key = 'leaderboard-event-%s-%s' % (stairwell_id, sequence)
+            cache.add(key, (token, event), timeout=timeout)
+            entry = cache.get(key)
+            if entry and entry[0] == token:
+                appended.append(event)
+                break
+        else:
+            logger.warning("Appending %s to the event log of stairwell %s "
+                           "failed", event['type'], stairwell_id)
+
+    # only a hint, readers look past it for events being appended
+    if appended:
+        cache.set('leaderboard-events-%s' % stairwell_id, sequence,
+                  timeout=timeout)
+
+    return appended
+
+
+def read_events(stairwell_id, position, limit=100):
+    """
+    Read the events appended to a stairwell's log after a position
+
+    :param int stairwell_id: Stairwell id
+    :param int position: sequence of the last event read
+    :optparam int limit: most events read at once, older ones are skipped
+    :returns: (list of events in order, new position)
+    """
+    last = get_event_position(stairwell_id)
+    first = max(position + 1, last - limit + 1)
+    keys = ['leaderboard-event-%s-%s' % (stairwell_id, sequence)
+            for sequence in range(first, last + 1)]
+    entries = list(cache.get_many(*keys)) if keys else []
+
+    # events appended before the sequence was moved
+    sequence = max(last, position)
+    while True:
+        entry = cache.get('leaderboard-event-%s-%s' % (stairwell_id,
+                                                        sequence + 1))
+        if entry is None:
+            break
+        entries.append(entry)
+        sequence += 1
+
+    events = [event for token, event in filter(None, entries)]
+
+    return events[-limit:], sequence
+
+
+def build_climb_event(workout, user):
+    """
+    Build the event of a committed climb, with the climber's new rank and
+    whether it is the new fastest time.  The event gets its id when it is
+    appended to the log, see publish_climbs.
+
+    :param Workout workout: the saved workout
+    :param dict user: the climber's identity, see get_user_identity
+    :returns: dict, the climb event
+    """
+    stairwell_id = workout.stairwell_id
+    direction = workout.direction
+
+    # the replica may not have the climb yet
+    with primary_reads():
+        rank = query_leaderboard_rank(stairwell_id, direction, user['id'])
+        fastest = query_fastest_workouts([stairwell_id])\
+                    .get((stairwell_id, direction), [None])[0]
+
+    event = {
+        'type': 'climb',
+        'stairwell_id': stairwell_id,
+        'direction': direction,
+        'user_id': user['id'],
+        'first_name': user['first_name'],
+        'last_name': user['last_name'],
+        'time_taken': workout.time_taken,
+        'number_of_steps': workout.number_of_steps,
+        'rank': rank['rank'] if rank else None,
+        'fastest': bool(fastest and fastest['user_id'] == user['id']
+                        and fastest['time_taken'] >= workout.time_taken),
+        'time': time.time()
+        }
+    return event
+
+
+def publish_climbs(stairwell_id, events, version):
+    """
+    Retire a stairwell's cached leaderboard and publish its committed
+    climbs to the leaderboard stream.  The events are appended to the log
+    before the version is bumped, so the other processes never see the new
+    version without its climbs.
+
+    :param int stairwell_id: Stairwell climbed
+    :param list events: climb events, see build_climb_event
+    :param str version: the new leaderboard version, see new_version
+    """
+    # for the other processes, then the local subscribers
+    try:
+        if events:
+            events = append_events(stairwell_id, events, version)
+    finally:
+        invalidate_leaderboard(stairwell_id, version=version)
+
+    if _broadcaster is not None and events:
+        _broadcaster.publish(stairwell_id, events)
+
+
+def stream_leaderboard(stairwell_id):
+    """
+    Subscribe to a stairwell's leaderboard.  The returned generator yields
+    Server-Sent Events until the client disconnects, with a comment every 
+    LEADERBOARD_STREAM_KEEPALIVE seconds so proxies keep the connection
+    open.
+
+    :param int stairwell_id: Stairwell to follow
+    :returns: generator of event stream chunks
+    """
+    keepalive = app.config['LEADERBOARD_STREAM_KEEPALIVE']
+    broadcaster = get_broadcaster()
+    queue = broadcaster.subscribe(stairwell_id,
+                                  get_leaderboard_version(stairwell_id),
+                                  get_event_position(stairwell_id))
+
+    def generate():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event = queue.get(timeout=keepalive)
+                except Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                yield "id: %s\nevent: %s\ndata: %s\n\n" % (
+                        event['id'], event['type'], simplejson.dumps(event))
+        finally:
+            broadcaster.unsubscribe(stairwell_id, queue)
+
+    return generate()
@@ -0,0 +1,276 @@
+"""
+    Workout Submissions
+    ~~~~~~~~~~~~~~~~~~~
+    Posts workouts to the MMF API in the background so the finish scan 
+    doesn't wait on the upstream API.  Workouts are queued in the 
+    workout_submission table and retried with backoff until they succeed.
+    
+    A submission is posted once: the mmf.workout.id is recorded (status 
+    'posted') in its own commit right after the post, then the local 
+    workout is reconciled in a separate step that is retried on its own, 
+    without posting again.
+"""
+import datetime
+import logging
+import threading
+
+import simplejson
+
+from mapmystairs import app, db
+from mapmystairs.mmf import MapMyFitnessAPI
+from mapmystairs.models import Workout, WorkoutSubmission
+from mapmystairs.utils import (adjust_leaderboard_energy,
+                               invalidate_leaderboard,
+                               remove_leaderboard_workout)
+
+
+# logging
+logger = logging.getLogger(__name__)
+
+# metabolic energy is in joules, workouts store kcal
+KCAL_PER_JOULE = 0.000239005736
+
+
+# functions
+def enqueue_workout_submission(vx_workout, user_id,
+                               oauth_token, oauth_token_secret):
+    """
+    Queue a vx workout to be posted to the MMF API.  Adds to the current 
+    db.session so the submission commits with the local workout.
+    
+    :param dict vx_workout: the workout to post
+    :param int user_id: User posting the workout
+    :param str oauth_token: User's mmf oauth token
+    :param str oauth_token_secret: User's mmf oauth token secret
+    :returns: WorkoutSubmission, its workout_id is the provisional id to 
+              save the local Workout with
+    """
+    submission = WorkoutSubmission(user_id=user_id,
+                                   payload=simplejson.dumps(vx_workout),
+                                   oauth_token=oauth_token,
+                                   oauth_token_secret=oauth_token_secret,
+                                   created_at=datetime.datetime.utcnow())
+    db.session.add(submission)
+    db.session.flush()
+    
+    # negative so it can't clash with a mmf.workout.id
+    submission.workout_id = -submission.id
+    
+    return submission
+
+
+def process_workout_submissions(limit=50):
+    """
+    Post or reconcile the submissions that are due
+    
+    :optparam int limit: max. number of submissions to process
+    :returns: number of submissions processed (successfully or not)
+    """
+    now = datetime.datetime.utcnow()
+    submission_ids = [r[0] for r in db.session.query(WorkoutSubmission.id)
+                      .filter(WorkoutSubmission.status.in_(['pending',
+                                                            'posted']),
+                              WorkoutSubmission.next_attempt_at <= now)
+                      .order_by(WorkoutSubmission.id)
+                      .limit(limit)]
+    db.session.commit()
+    
+    processed = 0
+    for submission_id in submission_ids:
+        if claim_workout_submission(submission_id):
+            submit_workout_submission(submission_id)
+            processed += 1
+    
+    return processed
+
+
+def claim_workout_submission(submission_id):
+    """
+    Lease a due submission so no other worker posts it at the same time.
+    If the worker dies the lease runs out and the submission is retried.
+    
+    :returns: True if this worker holds the lease
+    """
+    now = datetime.datetime.utcnow()
+    lease = now + datetime.timedelta(
+                    seconds=app.config['WORKOUT_SUBMISSION_LEASE'])
+    
+    claimed = WorkoutSubmission.query.filter(
+                    WorkoutSubmission.id == submission_id,
+                    WorkoutSubmission.status.in_(['pending', 'posted']),
+                    WorkoutSubmission.next_attempt_at <= now)\
+                .update({'next_attempt_at': lease,
+                         'attempts': WorkoutSubmission.attempts + 1},
+                        synchronize_session=False)
+    db.session.commit()
+    
+    return claimed == 1
+
+
+def submit_workout_submission(submission_id):
+    """
+    Post a claimed submission, unless it was posted already, and reconcile
+    the local workout with the result
+    
+    :returns: True if the workout was posted and reconciled
+    """
+    submission = WorkoutSubmission.query.get(submission_id)
+    
+    if submission.status == 'pending':
+        if not post_workout_submission(submission):
+            return False
+    
+    return reconcile_workout_submission(submission)
+
+
+def post_workout_submission(submission):
+    """
+    Post a submission to the MMF API and record the mmf.workout.id and 
+    energy burned right away, so a failure after the post never posts 
+    the workout twice.
+    
+    :returns: True if the workout was posted
+    """
+    # api connection
+    mmf = MapMyFitnessAPI(app.config['MMF_API_KEY'],
+                          app.config['MMF_API_SECRET'],
+                          token_key=submission.oauth_token,
+                          token_secret=submission.oauth_token_secret)
+    
+    try:
+        vx_result = mmf.call("/workout/", http_method="POST",
+                             data=submission.payload)
+        logger.debug("vx_result: %s", vx_result)
+        
+        workout_id = int(vx_result['_links']['self'][0]['id'])
+        energy_burned = vx_result['aggregates']\
+                        .get('metabolic_energy_total', 0) * KCAL_PER_JOULE
+    except Exception as e:
+        logger.warning("Posting %s failed: %r", submission, e)
+        
+        # retry with backoff
+        submission.last_error = repr(e)[:255]
+        if submission.attempts >= app.config['WORKOUT_SUBMISSION_ATTEMPTS']:
+            submission.status = 'failed'
+        else:
+            retry_later(submission)
+        db.session.commit()
+        return False
+    
+    # posted, never post again
+    submission.workout_id = workout_id
+    submission.energy_burned = energy_burned
+    submission.status = 'posted'
+    submission.last_error = None
+    db.session.commit()
+    
+    return True
+
+
+def reconcile_workout_submission(submission):
+    """
+    Swap the posted workout's mmf.workout.id into the local workout and 
+    correct its energy burned.  If the workout was imported already under
+    its mmf.workout.id, the provisional copy is dropped instead.  Retried 
+    with backoff on errors.
+    
+    :param WorkoutSubmission submission: a 'posted' submission
+    :returns: True if the workout was reconciled
+    """
+    stairwell_id = None
+    try:
+        workout = Workout.query.get(-submission.id)
+        if workout:
+            stairwell_id = workout.stairwell_id
+            
+            if Workout.query.get(submission.workout_id):
+                # imported meanwhile, see import_user_workouts
+                db.session.delete(workout)
+                db.session.flush()
+                remove_leaderboard_workout(workout)
+            else:
+                adjust_leaderboard_energy(
+                        workout,
+                        submission.energy_burned - (workout.energy_burned
+                                                    or 0))
+                workout.id = submission.workout_id
+                workout.energy_burned = submission.energy_burned
+        
+        submission.status = 'done'
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.exception("Reconciling %s failed", submission)
+        
+        # posted already, only the reconciliation is retried
+        submission.last_error = repr(e)[:255]
+        retry_later(submission)
+        db.session.commit()
+        return False
+    
+    if stairwell_id is not None:
+        invalidate_leaderboard(stairwell_id)
+    
+    return True
+
+
+def retry_later(submission):
+    """
+    Schedule the next attempt of a submission with exponential backoff
+    """
+    delay = min(5 * 2 ** submission.attempts, 60 * 60)
+    submission.next_attempt_at = datetime.datetime.utcnow() \
+                                 + datetime.timedelta(seconds=delay)
+
+
+class WorkoutSubmissionWorker(threading.Thread):
+    """
+    Background thread posting queued workouts.  Polls for retries every 
+    `poll_interval` seconds and is woken up for new submissions.
+    """
+    
+    def __init__(self, poll_interval):
+        threading.Thread.__init__(self, name="workout-submissions")
+        self.daemon = True
+        self.poll_interval = poll_interval
+        self.wakeup = threading.Event()
+    
+    def wake(self):
+        self.wakeup.set()
+    
+    def run(self):
+        while True:
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+            
+            with app.app_context():
+                try:
+                    while process_workout_submissions():
+                        pass
+                except Exception:
+                    logger.exception("Processing workout submissions failed")
+                finally:
+                    db.session.remove()
+
+
+# one worker per process, started on first use
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def wake_submission_worker():
+    """
+    Wake up (and if needed start) this process' submission worker
+    """
+    global _worker
+    
+    if not app.config['WORKOUT_SUBMISSION_WORKER']:
+        return
+    
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = WorkoutSubmissionWorker(
+                        app.config['WORKOUT_SUBMISSION_POLL_INTERVAL'])
+            _worker.start()
+    
+    _worker.wake()
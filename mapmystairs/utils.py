@@ -2,130 +2,1408 @@
     Miscellenous Utils
     ~~~~~~~~~~~~~~~~~~
 """
-from flask import flash, request
-from sqlalchemy.sql import func
+import datetime
+import logging
+import threading
+import time
+import uuid
+
+from flask import current_app, flash, request
+import pytz
+from sqlalchemy import inspect
+from sqlalchemy.sql import case, func, text
 
 from mapmystairs import cache, db
+from mapmystairs.database import fresh_reads, get_read_engine, new_version
+from mapmystairs.models import (DIRECTIONS, LeaderboardBucket,
+                                LeaderboardRollup, OrganizationRollup,
+                                Workout)
+from mapmystairs.snapshot import get_snapshot_leaderboards
+
+
+# logging
+logger = logging.getLogger(__name__)
 
 
 # functions
-def get_leaderboard(stairwell_id):
+def sql_in_params(name, values, params):
     """
-    Get the leaderboard for a stairwell
+    Build the named bind parameters for a SQL `IN (...)` clause
+    
+    :param str name: parameter name prefix
+    :param list values: values for the clause
+    :param dict params: bind parameters, updated in place
+    :returns: str, ie., ":name_0, :name_1"
+    """
+    placeholders = []
+    for n, value in enumerate(values):
+        params['%s_%s' % (name, n)] = value
+        placeholders.append(':%s_%s' % (name, n))
+    
+    return ", ".join(placeholders)
+
+
+def get_leaderboard_versions(stairwell_ids):
+    """
+    Get the current version of each stairwell's leaderboard.  The version 
+    is part of every leaderboard cache key so bumping it (see
+    invalidate_leaderboard) retires all cached copies at once.
+    
+    :returns: dict of stairwell_id -> version
+    """
+    version_keys = ["leaderboard-version-%s" % stairwell_id
+                    for stairwell_id in stairwell_ids]
+    versions = dict(zip(stairwell_ids, cache.get_many(*version_keys)))
+    
+    for stairwell_id, version_key in zip(stairwell_ids, version_keys):
+        if versions[stairwell_id] is None:
+            cache.add(version_key, new_version(),
+                      timeout=current_app.config['LEADERBOARD_CACHE_TIMEOUT'])
+            versions[stairwell_id] = cache.get(version_key)
+    
+    return versions
+
+
+def get_leaderboard_version(stairwell_id):
+    """
+    Get the current version of a stairwell's leaderboard
+    """
+    return get_leaderboard_versions([stairwell_id])[stairwell_id]
+
+
+def invalidate_leaderboard(stairwell_id, version=None):
     """
-    # cache_key
-    cache_key = "leaderboard-%s" % stairwell_id
+    Retire the cached leaderboard for a stairwell, ie., after a new workout 
+    was committed.  The previous board is still served as a stale copy 
+    while a single request recomputes the new one.
     
+    :param int stairwell_id: Stairwell id
+    :optparam str version: the new version, see new_version
+    :returns: str, the new version
+    """
+    version_key = "leaderboard-version-%s" % stairwell_id
+    if version is None:
+        version = new_version()
+    cache.set(version_key, version,
+              timeout=current_app.config['LEADERBOARD_CACHE_TIMEOUT'])
+    return version
+
+
+def get_leaderboard(stairwell_id, start=None, end=None):
+    """
+    Get the leaderboard for a stairwell
+    
+    :param int stairwell_id: Stairwell id
+    :optparam date start: first day of the date range
+    :optparam date end: last day of the date range
+    """
     # clear cache
     if request.args.get("_clear_cache"):
         flash('Leaderboard Cache Cleared!', category='info')
-        cache.delete(cache_key)
-        
+        invalidate_leaderboard(stairwell_id)
+    
+    return get_leaderboards([stairwell_id], start=start,
+                            end=end)[stairwell_id]
+
+
+def get_leaderboards(stairwell_ids, start=None, end=None):
+    """
+    Get the leaderboards for several stairwells, optionally limited to 
+    workouts in a date range
+    
+    :param list stairwell_ids: Stairwell ids
+    :optparam date start: first day of the date range
+    :optparam date end: last day of the date range
+    :returns: dict of stairwell_id -> leaderboard
+    """
+    def query(stairwell_ids):
+        return query_leaderboards(stairwell_ids, start=start, end=end)
+    
+    # all-time boards can be served from the snapshot after a restart
+    name = "leaderboard"
+    fallback = get_snapshot_leaderboards
+    if start or end:
+        name = "leaderboard-%s-%s" % (start, end)
+        fallback = None
+    
+    return get_cached_leaderboards(stairwell_ids, query, name=name,
+                                   fallback=fallback)
+
+
+def get_window_dates(window, time_zone):
+    """
+    Get the date range of a rolling leaderboard window
+    
+    :param str window: today, week (last 7 days) or month (this month)
+    :param str time_zone: time zone of the viewer
+    :returns: tuple of (start, end) dates, (None, None) for all time
+    """
+    today = datetime.datetime.now(pytz.timezone(time_zone)).date()
+    
+    if window == 'today':
+        return today, today
+    elif window == 'week':
+        return today - datetime.timedelta(days=6), today
+    elif window == 'month':
+        return today.replace(day=1), today
+    
+    return None, None
+
+
+def get_leaderboard_dates(args, time_zone):
+    """
+    Get the date range of a leaderboard request, a ?window= (see 
+    get_window_dates) or ?start=&end= dates (YYYY-MM-DD)
+    
+    Days before the bucket cutoff are only kept per month (see 
+    compact_leaderboard_buckets), so ranges reaching back before it must 
+    start on the 1st and end on the last day of a month.
+    
+    :param dict args: request arguments
+    :param str time_zone: time zone of the viewer
+    :raises ValueError: for invalid dates
+    :returns: tuple of (start, end) dates, (None, None) for all time
+    """
+    start, end = get_window_dates(args.get("window"), time_zone)
+    
+    if args.get("start"):
+        start = datetime.datetime.strptime(args["start"], '%Y-%m-%d').date()
+    if args.get("end"):
+        end = datetime.datetime.strptime(args["end"], '%Y-%m-%d').date()
+    
+    # compacted months only count whole
+    cutoff = get_bucket_cutoff()
+    if start and start < cutoff and start.day != 1:
+        raise ValueError("Date ranges before %s must start on the 1st"
+                         % cutoff)
+    if end and end < cutoff and (end + datetime.timedelta(days=1)).day != 1:
+        raise ValueError("Date ranges before %s must end on the last day "
+                         "of a month" % cutoff)
+    
+    return start, end
+
+
+def get_cached_leaderboards(stairwell_ids, query, name="leaderboard",
+                            fallback=None):
+    """
+    Get cached leaderboards for several stairwells.  Each board is cached 
+    under its own key, tied to the stairwell's leaderboard version, and all
+    missing boards are computed in one batch.
+    
+    Concurrent cache misses are coalesced: the request holding a board's 
+    recompute lock queries the database, the others serve the previous
+    (stale) board or wait for the new one.
+    
+    Boards without a stale copy, ie., after a restart, are served from the
+    `fallback` if it has them and recomputed in a background thread.  Each
+    board has the 'version' it was computed for, which tells stale and
+    fallback boards from current ones.
+    
+    :param list stairwell_ids: Stairwell ids
+    :param function query: query(stairwell_ids) -> dict of leaderboards
+    :optparam str name: cache key prefix for this kind of leaderboard
+    :optparam function fallback: fallback(stairwell_ids) -> dict of 
+                                 leaderboards, only for stairwells it has
+    :returns: dict of stairwell_id -> leaderboard
+    """
+    timeout = current_app.config['LEADERBOARD_CACHE_TIMEOUT']
+    
+    # cache keys
+    versions = get_leaderboard_versions(stairwell_ids)
+    cache_keys = dict((stairwell_id, "%s-%s-%s" % (name, stairwell_id,
+                                                   version))
+                      for stairwell_id, version in versions.items())
+    stale_keys = dict((stairwell_id, "%s-%s-stale" % (name, stairwell_id))
+                      for stairwell_id in stairwell_ids)
+    lock_keys = dict((stairwell_id, "%s-%s-lock" % (name, stairwell_id))
+                     for stairwell_id in stairwell_ids)
+    
     # check cache
-    leaderboard = cache.get(cache_key)
+    cached = cache.get_many(*[cache_keys[s] for s in stairwell_ids])
+    leaderboards = dict(zip(stairwell_ids, cached))
+    missing_ids = [s for s in stairwell_ids if leaderboards[s] is None]
+    
+    if not missing_ids:
+        return leaderboards
+    
+    def recompute(stairwell_ids):
+        try:
+            with fresh_reads(*[versions[s] for s in stairwell_ids]):
+                computed = query(stairwell_ids)
+            for stairwell_id in stairwell_ids:
+                computed[stairwell_id]['version'] = versions[stairwell_id]
+            cache.set_many(dict((cache_keys[s], computed[s])
+                                for s in stairwell_ids), timeout=timeout)
+            cache.set_many(dict((stale_keys[s], computed[s])
+                                for s in stairwell_ids), timeout=timeout)
+            return computed
+        finally:
+            cache.delete_many(*[lock_keys[s] for s in stairwell_ids])
     
-    if not leaderboard:
+    # try to take the recompute locks
+    lock_token = uuid.uuid4().hex
+    for stairwell_id in missing_ids:
+        cache.add(lock_keys[stairwell_id], lock_token,
+                  timeout=current_app.config['LEADERBOARD_LOCK_TIMEOUT'])
+    
+    lock_tokens = cache.get_many(*[lock_keys[s] for s in missing_ids])
+    locked_ids = [s for s, token in zip(missing_ids, lock_tokens)
+                  if token == lock_token]
+    waiting_ids = [s for s in missing_ids if s not in locked_ids]
+    
+    # serve the fallback for boards we hold the lock for but have no stale
+    # copy of, and recompute them in the background
+    if locked_ids and fallback is not None:
+        stale = cache.get_many(*[stale_keys[s] for s in locked_ids])
+        fallbacks = fallback([s for s, board in zip(locked_ids, stale)
+                              if board is None])
+        if fallbacks:
+            leaderboards.update(fallbacks)
+            locked_ids = [s for s in locked_ids if s not in fallbacks]
+            recompute_async(recompute, list(fallbacks))
+    
+    # recompute the boards we hold the lock for
+    if locked_ids:
+        leaderboards.update(recompute(locked_ids))
+    
+    # someone else is recomputing
+    if waiting_ids:
+        stale = cache.get_many(*[stale_keys[s] for s in waiting_ids])
+        leaderboards.update(zip(waiting_ids, stale))
+        waiting_ids = [s for s in waiting_ids if leaderboards[s] is None]
+        
+        # no stale copy, the fallback beats waiting
+        if waiting_ids and fallback is not None:
+            leaderboards.update(fallback(waiting_ids))
+            waiting_ids = [s for s in waiting_ids if leaderboards[s] is None]
         
-        # fastest up
-        fastest_up_workout = None
-        sql_fastest_workout = """
+        wait_until = time.time() + current_app.config['LEADERBOARD_LOCK_WAIT']
+        while waiting_ids and time.time() < wait_until:
+            time.sleep(0.05)
+            fresh = cache.get_many(*[cache_keys[s] for s in waiting_ids])
+            leaderboards.update(zip(waiting_ids, fresh))
+            waiting_ids = [s for s in waiting_ids if leaderboards[s] is None]
+        
+        # give up waiting
+        if waiting_ids:
+            with fresh_reads(*[versions[s] for s in waiting_ids]):
+                computed = query(waiting_ids)
+            for stairwell_id in waiting_ids:
+                computed[stairwell_id]['version'] = versions[stairwell_id]
+            leaderboards.update(computed)
+    
+    # return
+    return leaderboards
+
+
+def recompute_async(recompute, stairwell_ids):
+    """
+    Run recompute(stairwell_ids) in a background thread with the current
+    app context
+    """
+    app = current_app._get_current_object()
+    
+    def run():
+        with app.app_context():
+            try:
+                recompute(stairwell_ids)
+            except Exception:
+                logger.exception("Recomputing leaderboards %s failed",
+                                 stairwell_ids)
+    
+    thread = threading.Thread(target=run, name="leaderboard-recompute")
+    thread.daemon = True
+    thread.start()
+
+
+def query_leaderboards(stairwell_ids, start=None, end=None):
+    """
+    Query the leaderboards for several stairwells from the database, one
+    query for all of the podiums, one for the first page of every list and
+    one for the totals
+    
+    The lists come from the rollups or, for a date range, from the sum of
+    the leaderboard buckets in the range.  Later pages are read with
+    get_leaderboard_page.
+    
+    :returns: dict of stairwell_id -> leaderboard
+    """
+    podium_size = current_app.config['LEADERBOARD_PODIUM_SIZE']
+    page_size = current_app.config['LEADERBOARD_PAGE_SIZE']
+    
+    # fastest workouts
+    fastest_workouts = query_fastest_workouts(stairwell_ids, limit=podium_size,
+                                              start=start, end=end)
+    
+    # first page of each list, one part per stairwell / direction
+    params = {'limit': page_size + 1}
+    if start or end:
+        params['start'] = start or datetime.date.min
+        params['end'] = end or datetime.date.max
+    
+    sql_parts = []
+    for stairwell_id in stairwell_ids:
+        for direction in DIRECTIONS:
+            n = len(sql_parts)
+            params['stairwell_id_%s' % n] = stairwell_id
+            params['direction_%s' % n] = direction
+            sql_parts.append("""
+                SELECT * FROM (%s LIMIT :limit) AS l%s
+                """ % (sql_leaderboard_list(start, end, n='_%s' % n), n))
+    
+    sql_leaderboard_lists = """
+        SELECT * FROM (%s) l
+        ORDER BY
+            l.stairwell_id, l.direction, l.total_number_of_steps DESC,
+            l.user_id ASC;
+        """ % "UNION ALL".join(sql_parts)
+    
+    leaderboard_lists = {}
+    results = get_read_engine().execute(text(sql_leaderboard_lists), **params)
+    for r in results:
+        leaderboard_lists.setdefault((r[8], r[3]), [])\
+                         .append(leaderboard_row(r))
+    
+    # totals (from rollups, see update_leaderboard_rollup)
+    totals = dict((s, (0, 0)) for s in stairwell_ids)
+    params = {}
+    
+    if not start and not end:
+        sql_totals = """
             SELECT 
-                u.id as user_id, u.first_name, u.last_name,
-                w.workout_date,
-                w.time_taken, w.energy_burned, w.number_of_steps
+                stairwell_id, COUNT(DISTINCT user_id),
+                SUM(total_number_of_steps)
             FROM
-                workout w
-                INNER JOIN user u ON u.id = w.user_id
+                leaderboard_rollup
             WHERE
-                w.stairwell_id = 1 AND
-                w.direction = 'up'
-            ORDER BY
-                w.time_taken ASC
-            LIMIT 1;
-            """
-        results = db.engine.execute(sql_fastest_workout)
-        for r in results:
-            fastest_up_workout = {
-                'user_id': r[0],
-                'first_name': r[1],
-                'last_name': r[2],
-                'workout_date': r[3],
-                'time_taken': r[4],
-                'energy_burned': r[5],
-                'number_of_steps': r[6]
+                stairwell_id IN (%s)
+            GROUP BY
+                stairwell_id;
+            """ % sql_in_params('stairwell_id', stairwell_ids, params)
+    
+    else:
+        params['start'] = start or datetime.date.min
+        params['end'] = end or datetime.date.max
+        sql_totals = """
+            SELECT 
+                stairwell_id, COUNT(DISTINCT user_id),
+                SUM(total_number_of_steps)
+            FROM
+                leaderboard_bucket
+            WHERE
+                stairwell_id IN (%s) AND
+                bucket_date BETWEEN :start AND :end
+            GROUP BY
+                stairwell_id;
+            """ % sql_in_params('stairwell_id', stairwell_ids, params)
+    
+    results = get_read_engine().execute(text(sql_totals), **params)
+    for r in results:
+        totals[r[0]] = (r[1], int(r[2] or 0))
+    
+    # set leaderboards
+    leaderboards = {}
+    for stairwell_id in stairwell_ids:
+        podium = {}
+        pages = {}
+        for direction in DIRECTIONS:
+            podium[direction] = fastest_workouts.get((stairwell_id, direction),
+                                                     [])
+            pages[direction] = build_leaderboard_page(
+                    leaderboard_lists.get((stairwell_id, direction), []),
+                    page_size)
+        
+        leaderboards[stairwell_id] = {
+            'fastest_up': (podium['up'] or [None])[0],
+            'fastest_down': (podium['down'] or [None])[0],
+            'podium': podium,
+            'pages': pages,
+            'climber_count': totals[stairwell_id][0],
+            'total_number_of_steps': totals[stairwell_id][1]
             }
-            
-        # fastest down
-        fastest_down_workout = None
-        sql_fastest_workout = """
+    
+    # return
+    return leaderboards
+
+
+def sql_leaderboard_list(start=None, end=None, keyset=None, reverse=False,
+                         n=''):
+    """
+    SQL for one stairwell / direction leaderboard list in rank order: most
+    steps first, ties by user id.  The all-time list finds the stairwell /
+    direction's rollup rows, one per climber, with 
+    ix_leaderboard_rollup_rank, but MySQL 5.x can't read the mixed order 
+    (steps DESC, user_id ASC) off the index, so every page and rank lookup
+    sorts all of them.  Date range lists group the range's buckets, one 
+    per climber and day or month, and sort the groups.  Neither reads the 
+    workout table.
+    
+    Binds :stairwell_id<n> and :direction<n>, :start and :end for a date 
+    range and :steps and :user_id for a keyset.  Add the LIMIT yourself.
+    
+    :optparam date start: first day of the date range
+    :optparam date end: last day of the date range
+    :optparam str keyset: only rows 'after' or 'before' the :steps / 
+                          :user_id position, or the 'user' :user_id
+    :optparam bool reverse: lowest ranks first
+    :optparam str n: bind parameter suffix
+    :returns: str
+    """
+    if not start and not end:
+        steps, user_id = "r.total_number_of_steps", "r.user_id"
+        sql = """
             SELECT 
-                u.id as user_id, u.first_name, u.last_name,
-                w.workout_date,
-                w.time_taken, w.energy_burned, w.number_of_steps
+                u.id as user_id, u.first_name, u.last_name, r.direction,
+                r.workout_count,
+                r.min_time_taken,
+                r.total_energy_burned,
+                r.total_number_of_steps,
+                r.stairwell_id
             FROM
-                workout w
-                INNER JOIN user u ON u.id = w.user_id
+                leaderboard_rollup r
+                INNER JOIN user u ON u.id = r.user_id
             WHERE
-                w.stairwell_id = 1 AND
-                w.direction = 'down'
+                r.stairwell_id = :stairwell_id%(n)s AND
+                r.direction = :direction%(n)s
+                %(where)s
             ORDER BY
-                w.time_taken ASC
-            LIMIT 1;
+                r.total_number_of_steps %(order)s, r.user_id %(user_order)s
             """
-        results = db.engine.execute(sql_fastest_workout)
-        for r in results:
-            fastest_down_workout = {
-                'user_id': r[0],
-                'first_name': r[1],
-                'last_name': r[2],
-                'workout_date': r[3],
-                'time_taken': r[4],
-                'energy_burned': r[5],
-                'number_of_steps': r[6]
-            }
-            
-        # get leaderboard list
-        leaderboard_list = []
-        sql_leaderboard_list = """
+    else:
+        steps, user_id = "SUM(b.total_number_of_steps)", "u.id"
+        sql = """
             SELECT 
-                u.id as user_id, u.first_name, u.last_name, w.direction,
-                COUNT(w.id) as workout_count,
-                MIN(w.time_taken) as min_time_taken,
-                SUM(w.energy_burned) as total_energy_burned,
-                SUM(w.number_of_steps) as total_number_of_steps
+                u.id as user_id, u.first_name, u.last_name, b.direction,
+                SUM(b.workout_count) as workout_count,
+                MIN(b.min_time_taken) as min_time_taken,
+                SUM(b.total_energy_burned) as total_energy_burned,
+                SUM(b.total_number_of_steps) as total_number_of_steps,
+                b.stairwell_id
             FROM
-                workout w
-                INNER JOIN user u ON u.id = w.user_id
+                leaderboard_bucket b
+                INNER JOIN user u ON u.id = b.user_id
             WHERE
-                w.stairwell_id = 1
+                b.stairwell_id = :stairwell_id%(n)s AND
+                b.direction = :direction%(n)s AND
+                b.bucket_date BETWEEN :start AND :end
             GROUP BY
-                u.id, w.direction
+                b.stairwell_id, u.id, u.first_name, u.last_name, b.direction
+            %(having)s
             ORDER BY
-                SUM(w.number_of_steps) DESC;
+                SUM(b.total_number_of_steps) %(order)s, u.id %(user_order)s
             """
+    
+    # keyset condition
+    condition = None
+    if keyset == 'after':
+        condition = "(%s < :steps OR (%s = :steps AND %s > :user_id))" \
+                    % (steps, steps, user_id)
+    elif keyset == 'before':
+        condition = "(%s > :steps OR (%s = :steps AND %s < :user_id))" \
+                    % (steps, steps, user_id)
+    elif keyset == 'user':
+        condition = "%s = :user_id" % user_id
+    
+    return sql % {
+        'n': n,
+        'where': "AND %s" % condition if condition else "",
+        'having': "HAVING %s" % condition if condition else "",
+        'order': "ASC" if reverse else "DESC",
+        'user_order': "DESC" if reverse else "ASC"
+        }
+
+
+def leaderboard_row(r):
+    """
+    :param r: result row of sql_leaderboard_list
+    :returns: dict
+    """
+    return {
+        'user_id': r[0],
+        'first_name': r[1],
+        'last_name': r[2],
+        'direction': r[3],
+        'workout_count': r[4],
+        'min_time_taken': r[5],
+        'total_energy_burned': r[6],
+        'total_number_of_steps': int(r[7] or 0)
+        }
+
+
+def build_leaderboard_page(rows, page_size, first_rank=1):
+    """
+    Number the rows of a page and build the cursor of the next page
+    
+    :param list rows: up to page_size + 1 rows, the extra row only tells
+                      there is a next page
+    :param int page_size: rows per page
+    :optparam int first_rank: rank of the first row
+    :returns: dict with the page 'rows' and the 'next' page cursor or None
+    """
+    rows = rows[:page_size + 1]
+    for rank, row in enumerate(rows, first_rank):
+        row['rank'] = rank
+    
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = "%s-%s" % (last['total_number_of_steps'],
+                                 last['user_id'])
+    
+    return {'rows': rows, 'next': next_cursor}
+
+
+def parse_leaderboard_cursor(cursor):
+    """
+    :param str cursor: page cursor, ie., "<steps>-<user_id>"
+    :returns: tuple of (steps, user_id) or None if invalid
+    """
+    try:
+        steps, user_id = [int(c) for c in cursor.split('-')]
+    except (AttributeError, ValueError):
+        return None
+    
+    return steps, user_id
+
+
+def get_leaderboard_page(stairwell_id, direction, after=None, start=None,
+                         end=None):
+    """
+    Get a page of a leaderboard list.  The first page is part of the cached
+    leaderboard, later pages are cached with the leaderboard version.
+    
+    :param int stairwell_id: Stairwell id
+    :param str direction: up or down
+    :optparam str after: cursor of the page, see build_leaderboard_page
+    :optparam date start: first day of the date range
+    :optparam date end: last day of the date range
+    :returns: dict with the page 'rows' and the 'next' page cursor or None
+    """
+    cursor = parse_leaderboard_cursor(after)
+    if cursor is None:
+        return get_leaderboard(stairwell_id, start=start,
+                               end=end)['pages'][direction]
+    
+    version = get_leaderboard_version(stairwell_id)
+    cache_key = "leaderboard-page-%s-%s-%s-%s-%s-%s" % (
+                    stairwell_id, version, direction, start, end, after)
+    page = cache.get(cache_key)
+    
+    if page is None:
+        page_size = current_app.config['LEADERBOARD_PAGE_SIZE']
         
-        results = db.engine.execute(sql_leaderboard_list)
-        for r in results:
-            leaderboard_list.append({
-                'user_id': r[0],
-                'first_name': r[1],
-                'last_name': r[2],
-                'direction': r[3],
-                'workout_count': r[4],
-                'min_time_taken': r[5],
-                'total_energy_burned': r[6],
-                'total_number_of_steps': r[7]
-                })
-  
-        # set leaderboard
-        leaderboard = {
-            'fastest_up': fastest_up_workout,
-            'fastest_down': fastest_down_workout,
-            'list': leaderboard_list
+        params = {
+            'stairwell_id': stairwell_id,
+            'direction': direction,
+            'steps': cursor[0],
+            'user_id': cursor[1],
+            'start': start or datetime.date.min,
+            'end': end or datetime.date.max,
+            'limit': page_size + 1
             }
+        sql_page = sql_leaderboard_list(start, end, keyset='after') \
+                   + " LIMIT :limit"
+        
+        # the rank of the first row counts the users ahead, the cursor 
+        # only tells where the page starts
+        sql_ahead = "SELECT COUNT(*) FROM (%s) AS ahead" \
+                    % sql_leaderboard_list(start, end, keyset='before')
+        
+        with fresh_reads(version):
+            engine = get_read_engine()
+            rows = [leaderboard_row(r)
+                    for r in engine.execute(text(sql_page), **params)]
+            
+            first_rank = 1
+            if rows:
+                params['steps'] = rows[0]['total_number_of_steps']
+                params['user_id'] = rows[0]['user_id']
+                first_rank = engine.execute(text(sql_ahead),
+                                            **params).scalar() + 1
+        page = build_leaderboard_page(rows, page_size, first_rank=first_rank)
+        
+        cache.set(cache_key, page,
+                  timeout=current_app.config['LEADERBOARD_CACHE_TIMEOUT'])
+    
+    return page
+
 
-        # set cache
-        cache.set(cache_key, leaderboard, timeout=(5))  # 5s
+def get_leaderboard_rank(stairwell_id, direction, user_id, start=None,
+                         end=None):
+    """
+    Get a user's rank on a leaderboard list and the users right above and
+    below, cached with the leaderboard version
+    
+    :param int stairwell_id: Stairwell id
+    :param str direction: up or down
+    :param int user_id: User to rank
+    :optparam date start: first day of the date range
+    :optparam date end: last day of the date range
+    :returns: dict with the user's 'rank' and the neighbouring 'rows', or 
+              None if the user isn't on the board
+    """
+    version = get_leaderboard_version(stairwell_id)
+    cache_key = "leaderboard-rank-%s-%s-%s-%s-%s-%s" % (
+                    stairwell_id, version, direction, start, end, user_id)
+    
+    # cache misses are cached as False
+    rank = cache.get(cache_key)
+    if rank is None:
+        with fresh_reads(version):
+            rank = query_leaderboard_rank(stairwell_id, direction, user_id,
+                                          start=start, end=end) or False
+        cache.set(cache_key, rank,
+                  timeout=current_app.config['LEADERBOARD_CACHE_TIMEOUT'])
+    
+    return rank or None
+
+
+def query_leaderboard_rank(stairwell_id, direction, user_id, start=None,
+                           end=None):
+    """
+    Query a user's rank and LEADERBOARD_RANK_NEIGHBOURS users above and 
+    below from the database.  Counts the users ahead and reads the 
+    neighbours with keyset queries instead of ranking the whole board.
+    
+    :returns: dict with the user's 'rank' and the neighbouring 'rows', or 
+              None if the user isn't on the board
+    """
+    neighbours = current_app.config['LEADERBOARD_RANK_NEIGHBOURS']
+    params = {
+        'stairwell_id': stairwell_id,
+        'direction': direction,
+        'user_id': user_id,
+        'start': start or datetime.date.min,
+        'end': end or datetime.date.max,
+        'limit': neighbours
+        }
+    engine = get_read_engine()
+    
+    # user's row
+    sql_user = sql_leaderboard_list(start, end, keyset='user')
+    r = engine.execute(text(sql_user), **params).first()
+    if r is None:
+        return None
+    
+    row = leaderboard_row(r)
+    params['steps'] = row['total_number_of_steps']
+    
+    # users ahead
+    sql_ahead = "SELECT COUNT(*) FROM (%s) AS ahead" \
+                % sql_leaderboard_list(start, end, keyset='before')
+    rank = engine.execute(text(sql_ahead), **params).scalar() + 1
+    row['rank'] = rank
+    
+    # neighbours
+    sql_above = sql_leaderboard_list(start, end, keyset='before',
+                                     reverse=True) + " LIMIT :limit"
+    above = [leaderboard_row(a)
+             for a in engine.execute(text(sql_above), **params)]
+    above.reverse()
+    
+    sql_below = sql_leaderboard_list(start, end, keyset='after') \
+                + " LIMIT :limit"
+    below = [leaderboard_row(b)
+             for b in engine.execute(text(sql_below), **params)]
+    
+    rows = above + [row] + below
+    for n, r in enumerate(rows, rank - len(above)):
+        r['rank'] = n
+    
+    # return
+    return {'rank': rank, 'rows': rows}
+
+
+def get_organization_leaderboard(stairwell_id, organization_id):
+    """
+    Get the organization leaderboard for a stairwell, the totals of every 
+    organization and the ranking of the users within one organization
+    
+    :param int stairwell_id: Stairwell id
+    :param int organization_id: Organization to rank the users of
+    """
+    def query(stairwell_ids):
+        return query_organization_leaderboards(stairwell_ids, organization_id)
+    
+    return get_cached_leaderboards([stairwell_id], query,
+                name="leaderboard-org%s" % organization_id)[stairwell_id]
+
+
+def query_organization_leaderboards(stairwell_ids, organization_id):
+    """
+    Query the organization leaderboards for several stairwells from the
+    organization and leaderboard rollups
+    
+    :returns: dict of stairwell_id -> organization leaderboard
+    """
+    leaderboards = dict((s, {'organizations': [], 'list': []})
+                        for s in stairwell_ids)
+    
+    # organization totals
+    params = {}
+    sql_organization_list = """
+        SELECT 
+            o.id as organization_id, o.name, r.direction,
+            r.climber_count,
+            r.workout_count,
+            r.min_time_taken,
+            r.total_energy_burned,
+            r.total_number_of_steps,
+            r.stairwell_id
+        FROM
+            organization_rollup r
+            INNER JOIN organization o ON o.id = r.organization_id
+        WHERE
+            r.stairwell_id IN (%s)
+        ORDER BY
+            r.total_number_of_steps DESC;
+        """ % sql_in_params('stairwell_id', stairwell_ids, params)
+    
+    results = get_read_engine().execute(text(sql_organization_list), **params)
+    for r in results:
+        leaderboards[r[8]]['organizations'].append({
+            'organization_id': r[0],
+            'name': r[1],
+            'direction': r[2],
+            'climber_count': r[3],
+            'workout_count': r[4],
+            'min_time_taken': r[5],
+            'total_energy_burned': r[6],
+            'total_number_of_steps': r[7]
+            })
+    
+    # users within the organization
+    params = {'organization_id': organization_id}
+    sql_leaderboard_list = """
+        SELECT 
+            u.id as user_id, u.first_name, u.last_name, r.direction,
+            r.workout_count,
+            r.min_time_taken,
+            r.total_energy_burned,
+            r.total_number_of_steps,
+            r.stairwell_id
+        FROM
+            leaderboard_rollup r
+            INNER JOIN user u ON u.id = r.user_id
+        WHERE
+            r.organization_id = :organization_id AND
+            r.stairwell_id IN (%s)
+        ORDER BY
+            r.total_number_of_steps DESC;
+        """ % sql_in_params('stairwell_id', stairwell_ids, params)
+    
+    results = get_read_engine().execute(text(sql_leaderboard_list), **params)
+    for r in results:
+        leaderboards[r[8]]['list'].append({
+            'user_id': r[0],
+            'first_name': r[1],
+            'last_name': r[2],
+            'direction': r[3],
+            'workout_count': r[4],
+            'min_time_taken': r[5],
+            'total_energy_burned': r[6],
+            'total_number_of_steps': r[7]
+            })
+    
+    # return
+    return leaderboards
+
+
+def query_fastest_workouts(stairwell_ids, limit=1, start=None, end=None):
+    """
+    Get the fastest workouts for each stairwell and direction in a single
+    query.  Each (stairwell, direction) is its own index range scan of 
+    ix_workout_fastest so only `limit` rows are read per part.
+    
+    :param list stairwell_ids: Stairwell ids
+    :optparam int limit: number of workouts per stairwell and direction
+    :optparam date start: first day of the date range
+    :optparam date end: last day of the date range
+    :returns: dict of (stairwell_id, direction) -> list of workouts
+    """
+    fastest_workouts = {}
+    if not stairwell_ids:
+        return fastest_workouts
+    
+    # one fastest-N part per stairwell / direction
+    params = {'limit': limit}
+    sql_date_range = ""
+    if start:
+        params['start'] = start
+        sql_date_range += "AND workout_date >= :start"
+    if end:
+        params['end'] = end + datetime.timedelta(days=1)
+        sql_date_range += " AND workout_date < :end"
+    
+    sql_parts = []
+    for stairwell_id in stairwell_ids:
+        for direction in DIRECTIONS:
+            n = len(sql_parts)
+            params['stairwell_id_%s' % n] = stairwell_id
+            params['direction_%s' % n] = direction
+            sql_parts.append("""
+                SELECT * FROM (
+                    SELECT 
+                        id, stairwell_id, direction, user_id, workout_date,
+                        time_taken, energy_burned, number_of_steps
+                    FROM
+                        workout
+                    WHERE
+                        stairwell_id = :stairwell_id_%(n)s AND
+                        direction = :direction_%(n)s
+                        %(date_range)s
+                    ORDER BY
+                        time_taken ASC
+                    LIMIT :limit
+                ) AS f%(n)s
+                """ % {'n': n, 'date_range': sql_date_range})
+    
+    sql_fastest_workouts = """
+        SELECT 
+            f.stairwell_id, f.direction,
+            u.id as user_id, u.first_name, u.last_name,
+            f.workout_date,
+            f.time_taken, f.energy_burned, f.number_of_steps
+        FROM
+            (%s) f
+            INNER JOIN user u ON u.id = f.user_id
+        ORDER BY
+            f.stairwell_id, f.direction, f.time_taken ASC;
+        """ % "UNION ALL".join(sql_parts)
+    
+    results = get_read_engine().execute(text(sql_fastest_workouts), **params)
+    for r in results:
+        fastest_workouts.setdefault((r[0], r[1]), []).append({
+            'user_id': r[2],
+            'first_name': r[3],
+            'last_name': r[4],
+            'workout_date': r[5],
+            'time_taken': r[6],
+            'energy_burned': r[7],
+            'number_of_steps': r[8]
+            })
+    
+    # return
+    return fastest_workouts
+
+
+def sql_least(column, value):
+    """
+    Portable SQL expression for the smaller of a column and a value, NULLs
+    are skipped like MIN() does
+    """
+    if value is None:
+        return column
+    return case([(column.is_(None), value), (column > value, value)],
+                else_=column)
+
+
+def least(*values):
+    """
+    The smallest value, NULLs are skipped like MIN() does
+    
+    :returns: the smallest value that isn't None, or None
+    """
+    values = [v for v in values if v is not None]
+    return min(values) if values else None
+
+
+def rollup_aggregates(workouts):
+    """
+    :param list workouts: Workouts
+    :returns: dict, the rollup aggregates of the workouts
+    """
+    return {
+        'workout_count': len(workouts),
+        'min_time_taken': least(*[w.time_taken for w in workouts]),
+        'total_energy_burned': sum(w.energy_burned or 0 for w in workouts),
+        'total_number_of_steps': sum(w.number_of_steps or 0
+                                     for w in workouts)
+        }
+
+
+def rollup_increments(model, aggregates):
+    """
+    :param model: LeaderboardRollup, LeaderboardBucket or OrganizationRollup
+    :param dict aggregates: aggregates to add, see rollup_aggregates
+    :returns: dict of column -> SQL expression adding the aggregates to a 
+              rollup row
+    """
+    return {
+        'workout_count': model.workout_count + aggregates['workout_count'],
+        'min_time_taken': sql_least(model.min_time_taken,
+                                    aggregates['min_time_taken']),
+        'total_energy_burned': model.total_energy_burned
+                               + aggregates['total_energy_burned'],
+        'total_number_of_steps': model.total_number_of_steps
+                                 + aggregates['total_number_of_steps']
+        }
+
+
+def increment_rollup(rollup, aggregates):
+    """
+    Add aggregates to an existing rollup row, as SQL expressions so 
+    concurrent saves don't lose each other's increments
+    """
+    for column, value in rollup_increments(type(rollup), aggregates).items():
+        setattr(rollup, column, value)
+
+
+def insert_rollup(rollup, aggregates, **increments):
+    """
+    Insert a new rollup row.  Duplicate keys are ignored (INSERT IGNORE, 
+    INSERT OR IGNORE on SQLite) so if a concurrent save inserted the same 
+    row first, the aggregates are added to their row instead of failing 
+    the transaction.
+    
+    :param rollup: new LeaderboardRollup, LeaderboardBucket or 
+                   OrganizationRollup with the aggregates, not added to the
+                   session
+    :param dict aggregates: its aggregates, see rollup_aggregates
+    :optparam increments: more columns to increment on their row
+    :returns: bool, True if the row was inserted
+    """
+    model = type(rollup)
+    values = dict((column.key, getattr(rollup, column.key))
+                  for column in model.__table__.columns
+                  if getattr(rollup, column.key) is not None)
+    
+    insert = model.__table__.insert()\
+                            .prefix_with('IGNORE', dialect='mysql')\
+                            .prefix_with('OR IGNORE', dialect='sqlite')
+    if db.session.execute(insert, values).rowcount:
+        return True
+    
+    # their row, an UPDATE reads it even if committed after we started
+    increments.update(rollup_increments(model, aggregates))
+    model.query.filter(*[column == getattr(rollup, column.key)
+                         for column in inspect(model).primary_key])\
+               .update(increments, synchronize_session=False)
+    return False
+
+
+def update_leaderboard_rollup(workout, organization_id=None):
+    """
+    Add a new workout to its stairwell / user / direction rollup, its daily
+    bucket and, if given, the stairwell / direction rollup of the user's 
+    organization, see add_leaderboard_workouts
+    
+    :param Workout workout: the new workout
+    :optparam int organization_id: the user's organization
+    """
+    add_leaderboard_workouts([workout], organization_id=organization_id)
+
+
+def add_leaderboard_workouts(workouts, organization_id=None):
+    """
+    Add new workouts of a user to their stairwell / user / direction 
+    rollups, their buckets (daily, or monthly before the bucket cutoff) 
+    and, if given, the stairwell / direction rollups of the user's 
+    organization.  Each row is updated once with the aggregates of all of 
+    its workouts.
+    
+    Adds to the current db.session so it commits in the same transaction
+    as the workouts themselves.  Concurrent first workouts of a row don't 
+    fail, see insert_rollup.
+    
+    :param list workouts: the new Workouts of a single user
+    :optparam int organization_id: the user's organization
+    """
+    cutoff = get_bucket_cutoff()
+    
+    groups = {}
+    for workout in workouts:
+        groups.setdefault((workout.stairwell_id, workout.user_id,
+                           workout.direction), []).append(workout)
+    
+    for (stairwell_id, user_id, direction), group in sorted(groups.items()):
+        aggregates = rollup_aggregates(group)
+        
+        rollup = LeaderboardRollup.query.get((stairwell_id, user_id,
+                                              direction))
+        new_climber = rollup is None
+        
+        if new_climber:
+            rollup = LeaderboardRollup(stairwell_id=stairwell_id,
+                                       user_id=user_id,
+                                       direction=direction,
+                                       organization_id=organization_id,
+                                       **aggregates)
+            new_climber = insert_rollup(rollup, aggregates)
+        else:
+            increment_rollup(rollup, aggregates)
+        
+        # buckets, compacted months take their days' workouts.  Workouts 
+        # without a date aren't in any date range.
+        buckets = {}
+        for workout in group:
+            if workout.workout_date is None:
+                continue
+            bucket_date = workout.workout_date.date()
+            period = 'day'
+            if bucket_date < cutoff:
+                bucket_date, period = bucket_date.replace(day=1), 'month'
+            buckets.setdefault((bucket_date, period), []).append(workout)
+        
+        for (bucket_date, period), days in sorted(buckets.items()):
+            bucket_aggregates = rollup_aggregates(days)
+            bucket = LeaderboardBucket.query.get((stairwell_id, bucket_date,
+                                                  period, user_id,
+                                                  direction))
+            if not bucket:
+                bucket = LeaderboardBucket(stairwell_id=stairwell_id,
+                                           bucket_date=bucket_date,
+                                           period=period,
+                                           user_id=user_id,
+                                           direction=direction,
+                                           **bucket_aggregates)
+                insert_rollup(bucket, bucket_aggregates)
+            else:
+                increment_rollup(bucket, bucket_aggregates)
+        
+        # organization rollup
+        if organization_id is None:
+            continue
+        
+        org_rollup = OrganizationRollup.query.get((organization_id,
+                                                   stairwell_id,
+                                                   direction))
+        if not org_rollup:
+            org_rollup = OrganizationRollup(organization_id=organization_id,
+                                            stairwell_id=stairwell_id,
+                                            direction=direction,
+                                            climber_count=1,
+                                            **aggregates)
+            increments = {}
+            if new_climber:
+                increments['climber_count'] = \
+                        OrganizationRollup.climber_count + 1
+            insert_rollup(org_rollup, aggregates, **increments)
+        else:
+            if new_climber:
+                org_rollup.climber_count = \
+                        OrganizationRollup.climber_count + 1
+            increment_rollup(org_rollup, aggregates)
+
+
+def adjust_leaderboard_energy(workout, energy_burned):
+    """
+    Correct the energy sums of the rollups a workout was added to, ie., 
+    once the MMF API has calculated the real energy burned.
+    
+    :param Workout workout: workout already added to the rollups
+    :param float energy_burned: difference to add
+    """
+    rollup = LeaderboardRollup.query.get((workout.stairwell_id,
+                                          workout.user_id,
+                                          workout.direction))
+    if not rollup:
+        return
+    
+    rollup.total_energy_burned = LeaderboardRollup.total_energy_burned \
+                                    + energy_burned
+    
+    # daily bucket, or its month if compacted already
+    bucket = None
+    if workout.workout_date is not None:
+        bucket_date = workout.workout_date.date()
+        bucket = LeaderboardBucket.query.get((workout.stairwell_id,
+                                              bucket_date, 'day',
+                                              workout.user_id,
+                                              workout.direction)) \
+                 or LeaderboardBucket.query.get((workout.stairwell_id,
+                                                 bucket_date.replace(day=1),
+                                                 'month', workout.user_id,
+                                                 workout.direction))
+    if bucket:
+        bucket.total_energy_burned = LeaderboardBucket.total_energy_burned \
+                                        + energy_burned
+    
+    # organization rollup
+    if rollup.organization_id is not None:
+        org_rollup = OrganizationRollup.query.get((rollup.organization_id,
+                                                   workout.stairwell_id,
+                                                   workout.direction))
+        if org_rollup:
+            org_rollup.total_energy_burned = \
+                    OrganizationRollup.total_energy_burned + energy_burned
+
+
+def remove_leaderboard_workout(workout):
+    """
+    Take a deleted workout back out of the rollups it was added to, ie., a
+    provisional workout that was imported meanwhile.  Counts and sums are
+    decremented, rows left without workouts are deleted and the fastest 
+    times of the affected rows are recomputed, as a time can't be 
+    subtracted.
+    
+    Flush the workout's delete first.  Adds to the current db.session so 
+    it commits in the same transaction as the delete.
+    
+    :param Workout workout: deleted workout, already added to the rollups
+    """
+    rollup = LeaderboardRollup.query.get((workout.stairwell_id,
+                                          workout.user_id,
+                                          workout.direction))
+    if not rollup:
+        return
+    
+    organization_id = rollup.organization_id
+    aggregates = rollup_aggregates([workout])
+    workouts = Workout.query.filter(
+                    Workout.stairwell_id == workout.stairwell_id,
+                    Workout.user_id == workout.user_id,
+                    Workout.direction == workout.direction)
+    
+    def decrement(row, query):
+        model = type(row)
+        row.workout_count = model.workout_count \
+                            - aggregates['workout_count']
+        row.total_energy_burned = model.total_energy_burned \
+                                  - aggregates['total_energy_burned']
+        row.total_number_of_steps = model.total_number_of_steps \
+                                    - aggregates['total_number_of_steps']
+        db.session.flush()
+        
+        if row.workout_count <= 0:
+            db.session.delete(row)
+            return False
+        
+        row.min_time_taken = query.scalar()
+        return True
+    
+    # daily bucket, or its month if compacted already
+    if workout.workout_date is not None:
+        bucket_date = workout.workout_date.date()
+        bucket = LeaderboardBucket.query.get((workout.stairwell_id,
+                                              bucket_date, 'day',
+                                              workout.user_id,
+                                              workout.direction))
+        end = bucket_date + datetime.timedelta(days=1)
+        if not bucket:
+            bucket_date = bucket_date.replace(day=1)
+            bucket = LeaderboardBucket.query.get((workout.stairwell_id,
+                                                  bucket_date, 'month',
+                                                  workout.user_id,
+                                                  workout.direction))
+            end = (bucket_date + datetime.timedelta(days=31))\
+                    .replace(day=1)
+        if bucket:
+            decrement(bucket, workouts.filter(
+                                Workout.workout_date >= bucket_date,
+                                Workout.workout_date < end)
+                              .with_entities(func.min(Workout.time_taken)))
+    
+    climber = decrement(rollup, workouts.with_entities(
+                                    func.min(Workout.time_taken)))
+    db.session.flush()
+    
+    # organization rollup
+    if organization_id is None:
+        return
+    
+    org_rollup = OrganizationRollup.query.get((organization_id,
+                                               workout.stairwell_id,
+                                               workout.direction))
+    if org_rollup:
+        if not climber:
+            org_rollup.climber_count = OrganizationRollup.climber_count - 1
+        decrement(org_rollup, LeaderboardRollup.query.filter(
+                    LeaderboardRollup.organization_id == organization_id,
+                    LeaderboardRollup.stairwell_id == workout.stairwell_id,
+                    LeaderboardRollup.direction == workout.direction)
+                  .with_entities(func.min(LeaderboardRollup.min_time_taken)))
+
+
+def rebuild_leaderboard_rollups(stairwell_id=None):
+    """
+    Rebuild the leaderboard and organization rollups and the leaderboard 
+    buckets from the workout table.  Rebuilding all stairwells recreates 
+    the rollup tables.
+    
+    :optparam int stairwell_id: only rebuild a single stairwell
+    """
+    params = {}
+    where = ""
+    where_workout = ""
+    and_rollup = ""
+    
+    if stairwell_id is not None:
+        params['stairwell_id'] = stairwell_id
+        where = "WHERE stairwell_id = :stairwell_id"
+        where_workout = "WHERE w.stairwell_id = :stairwell_id"
+        and_rollup = "AND r.stairwell_id = :stairwell_id"
+    else:
+        # rollups only hold derived data, recreate to pick up new columns
+        for model in (OrganizationRollup, LeaderboardRollup,
+                      LeaderboardBucket):
+            model.__table__.drop(db.engine, checkfirst=True)
+            model.__table__.create(db.engine)
+    
+    sql_delete_rollups = """
+        DELETE FROM leaderboard_rollup
+        %s;
+        """ % where
+    sql_delete_organization_rollups = """
+        DELETE FROM organization_rollup
+        %s;
+        """ % where
+    sql_delete_buckets = """
+        DELETE FROM leaderboard_bucket
+        %s;
+        """ % where
+    sql_insert_rollups = """
+        INSERT INTO leaderboard_rollup
+            (stairwell_id, user_id, direction, organization_id,
+             workout_count, min_time_taken,
+             total_energy_burned, total_number_of_steps)
+        SELECT 
+            w.stairwell_id, w.user_id, w.direction, u.organization_id,
+            COUNT(w.id),
+            MIN(w.time_taken),
+            SUM(w.energy_burned),
+            SUM(w.number_of_steps)
+        FROM
+            workout w
+            INNER JOIN user u ON u.id = w.user_id
+        %s
+        GROUP BY
+            w.stairwell_id, w.user_id, w.direction, u.organization_id;
+        """ % where_workout
+    sql_insert_organization_rollups = """
+        INSERT INTO organization_rollup
+            (organization_id, stairwell_id, direction,
+             climber_count, workout_count, min_time_taken,
+             total_energy_burned, total_number_of_steps)
+        SELECT 
+            r.organization_id, r.stairwell_id, r.direction,
+            COUNT(r.user_id),
+            SUM(r.workout_count),
+            MIN(r.min_time_taken),
+            SUM(r.total_energy_burned),
+            SUM(r.total_number_of_steps)
+        FROM
+            leaderboard_rollup r
+        WHERE
+            r.organization_id IS NOT NULL
+            %s
+        GROUP BY
+            r.organization_id, r.stairwell_id, r.direction;
+        """ % and_rollup
+    
+    sql_insert_buckets = """
+        INSERT INTO leaderboard_bucket
+            (stairwell_id, bucket_date, period, user_id, direction,
+             workout_count, min_time_taken,
+             total_energy_burned, total_number_of_steps)
+        SELECT 
+            w.stairwell_id, DATE(w.workout_date), 'day', w.user_id,
+            w.direction,
+            COUNT(w.id),
+            MIN(w.time_taken),
+            SUM(w.energy_burned),
+            SUM(w.number_of_steps)
+        FROM
+            workout w
+        %s
+        GROUP BY
+            w.stairwell_id, DATE(w.workout_date), w.user_id, w.direction;
+        """ % where_workout
+    
+    db.session.execute(text(sql_delete_organization_rollups), params)
+    db.session.execute(text(sql_delete_rollups), params)
+    db.session.execute(text(sql_delete_buckets), params)
+    db.session.execute(text(sql_insert_rollups), params)
+    db.session.execute(text(sql_insert_organization_rollups), params)
+    db.session.execute(text(sql_insert_buckets), params)
+    db.session.commit()
+    
+    # compact the old days again
+    compact_leaderboard_buckets(stairwell_id=stairwell_id)
+
+
+def get_bucket_cutoff(retention_days=None):
+    """
+    :optparam int retention_days: defaults to 
+                                  LEADERBOARD_BUCKET_RETENTION_DAYS
+    :returns: date, the 1st of the oldest month kept in daily buckets, the 
+              months before it are compacted
+    """
+    if retention_days is None:
+        retention_days = \
+                current_app.config['LEADERBOARD_BUCKET_RETENTION_DAYS']
+    
+    # only whole months are compacted
+    cutoff = datetime.date.today() - datetime.timedelta(days=retention_days)
+    return cutoff.replace(day=1)
+
+
+def compact_leaderboard_buckets(stairwell_id=None, retention_days=None):
+    """
+    Compact the daily leaderboard buckets of whole months older than
+    `retention_days` into a single bucket per month, dated the 1st.
+    
+    Date range queries select buckets by their date, so a compacted month 
+    is counted in full by ranges including its 1st and not at all by 
+    ranges starting after it.  get_leaderboard_dates refuses ranges that 
+    start or end mid-month before the cutoff, see get_bucket_cutoff.
+    
+    :optparam int stairwell_id: only compact a single stairwell
+    :optparam int retention_days: defaults to 
+                                  LEADERBOARD_BUCKET_RETENTION_DAYS
+    """
+    cutoff = get_bucket_cutoff(retention_days)
+    
+    query = LeaderboardBucket.query.filter(
+                    LeaderboardBucket.period == 'day',
+                    LeaderboardBucket.bucket_date < cutoff)
+    if stairwell_id is not None:
+        query = query.filter(LeaderboardBucket.stairwell_id == stairwell_id)
+    
+    # sum the days per month
+    months = {}
+    for bucket in query:
+        key = (bucket.stairwell_id, bucket.bucket_date.replace(day=1),
+               bucket.user_id, bucket.direction)
+        month = months.get(key)
+        
+        if not month:
+            months[key] = {
+                'workout_count': bucket.workout_count,
+                'min_time_taken': bucket.min_time_taken,
+                'total_energy_burned': bucket.total_energy_burned,
+                'total_number_of_steps': bucket.total_number_of_steps
+                }
+        else:
+            month['workout_count'] += bucket.workout_count
+            month['min_time_taken'] = least(month['min_time_taken'],
+                                            bucket.min_time_taken)
+            month['total_energy_burned'] += bucket.total_energy_burned
+            month['total_number_of_steps'] += bucket.total_number_of_steps
+        
+        db.session.delete(bucket)
+    
+    # merge into (existing) month buckets
+    for (s, bucket_date, user_id, direction), aggregates in months.items():
+        bucket = LeaderboardBucket.query.get((s, bucket_date, 'month',
+                                              user_id, direction))
+        if not bucket:
+            db.session.add(LeaderboardBucket(stairwell_id=s,
+                                             bucket_date=bucket_date,
+                                             period='month',
+                                             user_id=user_id,
+                                             direction=direction,
+                                             **aggregates))
+        else:
+            bucket.workout_count += aggregates['workout_count']
+            bucket.min_time_taken = least(bucket.min_time_taken,
+                                          aggregates['min_time_taken'])
+            bucket.total_energy_burned += aggregates['total_energy_burned']
+            bucket.total_number_of_steps += \
+                    aggregates['total_number_of_steps']
+    
+    db.session.commit()
     
     # return
-    return leaderboard
+    return len(months)
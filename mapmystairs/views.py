@@ -3,28 +3,50 @@
     ~~~~~
 """
 # system
-import datetime
 import itertools
 import logging
+import time
 
 # 3rd party libraries
-from flask import (abort, flash, make_response, render_template, 
+from flask import (abort, flash, g, jsonify, make_response, render_template,
                    redirect, Response, request, session, url_for)
-import pytz
-import simplejson
+from werkzeug.security import safe_str_cmp
 
 # our libraries
-from mapmystairs import app, db
-from mapmystairs.decorators import login_required
-from mapmystairs.models import Organization, Stairwell, User, Workout
+from mapmystairs import app, profiler
+from mapmystairs.analytics import get_user_stats
+from mapmystairs.climbs import (get_climb_token, save_climbs, start_climb,
+                                sync_climbs)
+from mapmystairs.decorators import admin_required, login_required
+from mapmystairs.identity import get_user_identity, login_user_identity
+from mapmystairs.metrics import render_metrics
+from mapmystairs.models import DIRECTIONS, Organization
 from mapmystairs.mmf import MapMyFitnessAPI
-from mapmystairs.utils import get_leaderboard
+from mapmystairs.queries import query_workout_rows, workout_rows_cursor
+from mapmystairs.sessions import (clear_active_climb, get_active_climb,
+                                  set_active_climb)
+from mapmystairs.stairwells import (find_stairwells, get_registry_version,
+                                    get_stairwell, get_stairwell_hotlinks,
+                                    get_stairwells)
+from mapmystairs.stream import stream_leaderboard
+from mapmystairs.utils import (get_leaderboard, get_leaderboard_dates,
+                               get_leaderboard_page, get_leaderboard_rank,
+                               get_leaderboard_version, get_leaderboards,
+                               get_organization_leaderboard)
 
 
 # logging
 logger = logging.getLogger(__name__)
 
 
+@app.before_request
+def load_user():
+    """
+    Load the logged in user's identity into g.user
+    """
+    g.user = get_user_identity(session.get('user_id'))
+
+
 # views
 @app.route('/about')
 def about():
@@ -68,57 +90,17 @@ def auth_authorize():
         token_secret = credentials['oauth_token_secret'][0]
         user_id = credentials['user_id'][0]
         
+        # get or create user
+        identity = login_user_identity(user_id, token_key, token_secret,
+                                       organization_id)
+        
         # set session
         session['token_key'] = token_key
         session['token_secret'] = token_secret
-        session['user_id'] = user_id
-        
-        # get or create user
-        user_dict = None
-        user = User.query.filter_by(id=user_id).first()
-        
-        if not user:
-
-            # get current user
-            mmf = MapMyFitnessAPI(app.config['MMF_API_KEY'],
-                              app.config['MMF_API_SECRET'],
-                              token_key=token_key,
-                              token_secret=token_secret)
-        
-            mmf_user = mmf.call("/user/%s/" % user_id)
-            
-            # build user dict
-            user_dict = {
-                'id': user_id,
-                'username': mmf_user['username'],
-                'email': mmf_user['email'],
-                'first_name': mmf_user['first_name'],
-                'last_name': mmf_user['last_name'],
-                'organization_id': organization_id,
-                'time_zone': mmf_user['time_zone'],
-                'oauth_token': token_key,
-                'oauth_token_secret': token_secret
-                }
-            user = User(**user_dict)
-            
-            # add user
-            db.session.add(user)
-            db.session.commit()
+        session['user_id'] = identity['id']
         
-        if not user_dict:
-            user_dict = {
-                'id': user.id,
-                'username': user.username,
-                'email': user.email,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'organization_id': user.organization_id,
-                'time_zone': user.time_zone,
-                'oauth_token': user.oauth_token,
-                'oauth_token_secret': user.oauth_token_secret
-                }
-            
-        session['user'] = user_dict
+        # new session id for the logged in session, see rotate_session
+        app.session_interface.rotate_session(session)
         
         # redirect to leaderboard page
         return redirect(url_for("leaderboard"))
@@ -183,6 +165,57 @@ def debug():
     return fake_error
 
 
+@app.route('/metrics')
+def metrics():
+    """
+    Request metrics of this process in the Prometheus text format, for
+    scrapers sending the METRICS_TOKEN or, without one, the 
+    METRICS_ALLOWED_IPS only
+    """
+    if not app.config['METRICS_ENDPOINT']:
+        abort(404)
+    
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if not safe_str_cmp(request.headers.get('Authorization', ''),
+                            'Bearer %s' % token):
+            abort(403)
+    
+    # behind a proxy remote_addr is the proxy's, only trust direct 
+    # connections
+    elif 'X-Forwarded-For' in request.headers \
+            or request.remote_addr not in app.config['METRICS_ALLOWED_IPS']:
+        abort(403)
+
+    # return metrics
+    return Response(render_metrics(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/admin/slow-queries', methods=['GET', 'POST'])
+@admin_required
+def admin_slow_queries():
+    """
+    Slow SQL statements of this process, see SQL_PROFILER in settings.
+    POST clears them.
+    """
+    slow_query_profiler = profiler.profiler
+    
+    if request.method == 'POST' and slow_query_profiler is not None:
+        slow_query_profiler.clear()
+        return redirect(url_for('admin_slow_queries'))
+    
+    # build context
+    context = {
+        'profiler': slow_query_profiler,
+        'samples': slow_query_profiler.get_samples()
+                   if slow_query_profiler else []
+        }
+    
+    # return template
+    return render_template('admin_slow_queries.html', **context)
+
+
 @app.route('/')
 def index():
     """
@@ -190,7 +223,7 @@ def index():
     """
     
     # if user
-    if session.get("user"):
+    if g.user:
         # redirect to leaderboard page
         return redirect(url_for("leaderboard"))
     
@@ -198,46 +231,244 @@ def index():
     return render_template('index.html')
 
 
-@app.route('/leaderboard')
+@app.route('/leaderboard', defaults={'stairwell_id': 1})
+@app.route('/leaderboard/<int:stairwell_id>')
 @login_required
-def leaderboard():
+def leaderboard(stairwell_id):
     """
     Main Leaderboard
     
+    Filter by ?window=today|week|month or a ?start=&end= date range 
+    (YYYY-MM-DD).
+    
     TODO: get user stairwells
-    TODO: date range filter
     TODO: different sort order
-    TODO: caching
     """
     
-    # TODO: get user stairwells
-    stairwell_id = 1
-    stairwell = Stairwell.query.get(stairwell_id)
+    # get stairwell
+    stairwell = get_stairwell(stairwell_id)
+    if not stairwell:
+        abort(404)
+    
+    # date range
+    window = request.args.get("window")
+    try:
+        start, end = get_leaderboard_dates(request.args, g.user['time_zone'])
+    except ValueError:
+        flash('Invalid date range', category='error')
+        start, end = None, None
     
     # leaderboard
-    leaderboard = get_leaderboard(stairwell_id)
+    leaderboard = get_leaderboard(stairwell_id, start=start, end=end)
+    
+    # a page of each list and the user's rank, ?after_up=&after_down= 
+    pages = {}
+    ranks = {}
+    for direction in DIRECTIONS:
+        pages[direction] = get_leaderboard_page(stairwell_id, direction,
+                                after=request.args.get("after_%s" % direction),
+                                start=start, end=end)
+        ranks[direction] = get_leaderboard_rank(stairwell_id, direction,
+                                                g.user['id'],
+                                                start=start, end=end)
+    
+    # the user's pace, percentile, trend and streaks (all time)
+    stats = get_user_stats(stairwell_id, g.user['id'], g.user['time_zone'])
+    
+    # page links, keeping the date range
+    if window:
+        page_args = {'window': window}
+    else:
+        page_args = dict((k, request.args[k]) for k in ('start', 'end')
+                         if request.args.get(k))
+    
+    top_url = url_for('leaderboard', stairwell_id=stairwell_id, **page_args)
+    next_urls = {}
+    for direction, page in pages.items():
+        if page['next']:
+            page_args['after_%s' % direction] = page['next']
+            next_urls[direction] = url_for('leaderboard',
+                                           stairwell_id=stairwell_id,
+                                           **page_args)
+            del page_args['after_%s' % direction]
     
     # build context
     context = {
         'stairwell': stairwell,
-        'leaderboard': leaderboard
+        'leaderboard': leaderboard,
+        'version': leaderboard.get('version') or \
+                   get_leaderboard_version(stairwell_id),
+        'pages': pages,
+        'ranks': ranks,
+        'stats': stats,
+        'top_url': top_url,
+        'next_urls': next_urls,
+        'window': window,
+        'start': start,
+        'end': end
         }
     
     # return template
     return render_template('leaderboard.html', **context)
 
 
+@app.route('/api/leaderboard/<int:stairwell_id>/<direction>')
+@login_required
+def api_leaderboard(stairwell_id, direction):
+    """
+    JSON Leaderboard for polling clients
+    
+    Takes the same ?window=, ?start=&end= and ?after= arguments as the 
+    leaderboard page.  The ETag is the leaderboard version, so polls with 
+    If-None-Match get a 304 until the next workout without touching the 
+    board.
+    """
+    
+    # get stairwell
+    stairwell = get_stairwell(stairwell_id)
+    if not stairwell or direction not in DIRECTIONS:
+        abort(404)
+    
+    # date range
+    try:
+        start, end = get_leaderboard_dates(request.args, g.user['time_zone'])
+    except ValueError:
+        abort(400)
+    after = request.args.get("after")
+    
+    # not modified
+    version = get_leaderboard_version(stairwell_id)
+    etag = "%s-%s-%s-%s-%s-%s" % (version, direction, start, end, after,
+                                  g.user['id'])
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    
+    # leaderboard
+    leaderboard = get_leaderboard(stairwell_id, start=start, end=end)
+    page = get_leaderboard_page(stairwell_id, direction, after=after,
+                                start=start, end=end)
+    rank = get_leaderboard_rank(stairwell_id, direction, g.user['id'],
+                                start=start, end=end)
+    
+    # a stale or snapshot board is tagged with its own version, so the next
+    # poll gets the current board
+    if leaderboard.get('version', version) != version:
+        etag = "%s-%s-%s-%s-%s-%s" % (leaderboard['version'], direction,
+                                      start, end, after, g.user['id'])
+    
+    response = jsonify({
+        'stairwell_id': stairwell_id,
+        'direction': direction,
+        'start': start.isoformat() if start else None,
+        'end': end.isoformat() if end else None,
+        'climber_count': leaderboard['climber_count'],
+        'total_number_of_steps': leaderboard['total_number_of_steps'],
+        'podium': leaderboard['podium'][direction],
+        'list': page['rows'],
+        'next': page['next'],
+        'rank': rank
+        })
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    
+    # return
+    return response
+
+
+@app.route('/stream/leaderboard/<int:stairwell_id>')
+@login_required
+def leaderboard_stream(stairwell_id):
+    """
+    Live Leaderboard for lobby displays, a Server-Sent Events stream of 
+    climbs (and other updates) on a stairwell
+    """
+    
+    # get stairwell
+    stairwell = get_stairwell(stairwell_id)
+    if not stairwell:
+        abort(404)
+    
+    response = Response(stream_leaderboard(stairwell_id),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    
+    # return
+    return response
+
+
+@app.route('/leaderboard/<int:stairwell_id>/organizations')
+@login_required
+def leaderboard_organizations(stairwell_id):
+    """
+    Organization Leaderboard, organizations in the same building and the
+    ranking within the user's organization
+    """
+    
+    # get stairwell
+    stairwell = get_stairwell(stairwell_id)
+    if not stairwell:
+        abort(404)
+    
+    # leaderboard
+    organization_id = g.user['organization_id']
+    leaderboard = get_organization_leaderboard(stairwell_id, organization_id)
+    
+    # build context
+    context = {
+        'stairwell': stairwell,
+        'organization_id': organization_id,
+        'leaderboard': leaderboard
+        }
+    
+    # return template
+    return render_template('leaderboard_organizations.html', **context)
+
+
+@app.route('/leaderboards')
+@login_required
+def leaderboard_overview():
+    """
+    Leaderboard summary of all Stairwells
+    """
+    
+    # get stairwells
+    stairwells = get_stairwells()
+    
+    # leaderboards, computed in one batch
+    leaderboards = get_leaderboards([stairwell.id for stairwell in stairwells])
+    
+    # build context dict
+    context = {
+        'stairwells': stairwells,
+        'leaderboards': leaderboards
+        }
+    
+    # return template
+    return render_template('leaderboard_overview.html', **context)
+
+
 @app.route('/stairwells')
 def stairwell_list():
     """
-    List all Stairwells
+    List all Stairwells, or those at ?city=&postal_code=
     """
     
     # get stairwells
-    stairwells = Stairwell.query.all()
+    city = request.args.get("city")
+    postal_code = request.args.get("postal_code")
+    if city and postal_code:
+        stairwells = find_stairwells(city, postal_code)
+    else:
+        stairwells = get_stairwells()
     
     # build context dict
-    context = {'stairwells': stairwells}
+    context = {
+        'stairwells': stairwells,
+        'stairwells_version': get_registry_version()
+        }
     
     # return template
     return render_template('stairwell_list.html', **context)
@@ -249,21 +480,20 @@ def stairwell_view(stairwell_id):
     View Stairwell Record 
     """
     
-    # get stairwells
-    stairwell = Stairwell.query.get(stairwell_id)
-    
-    # build hotlinks
-    up_link = url_for('workout', stairwell_id=stairwell.id,
-                      direction="up", _external=True)
+    # get stairwell
+    stairwell = get_stairwell(stairwell_id)
+    if not stairwell:
+        abort(404)
     
-    down_link = url_for('workout', stairwell_id=stairwell.id,
-                      direction="down", _external=True)
+    # hotlinks, built once per stairwell
+    hotlinks = get_stairwell_hotlinks(stairwell)
     
     # build context dict
     context = {
                'stairwell': stairwell,
-               'up_link': up_link,
-               'down_link': down_link
+               'stairwells_version': get_registry_version(),
+               'up_link': hotlinks['up'],
+               'down_link': hotlinks['down']
                }
     
     # return template
@@ -283,8 +513,8 @@ def workout(stairwell_id, direction):
     # handle cancel
     if cancel_flag or cancel_flag == "True":
         
-        # delete session
-        session["workout"] = None
+        # drop active climb
+        clear_active_climb(session.sid)
         
         # info message
         flash('Stair Climb Cancelled!', category='info')
@@ -299,124 +529,104 @@ def workout(stairwell_id, direction):
         'cancel_flag': cancel_flag 
     }
     
-    # check to see if existing session exists
-    workout = session.get("workout")
+    # check to see if an active climb exists
+    climb = get_active_climb(session.sid)
     
-    if not workout:
+    if not climb:
         
         # get stairwell
-        stairwell = Stairwell.query.get(stairwell_id)
+        stairwell = get_stairwell(stairwell_id)
+        if not stairwell:
+            abort(404)
 
-        # build workout name
-        workout_name = 'walked %s %s stairs' % (direction,
-                                                stairwell.number_of_steps)
-        
-        # build workout
-        workout_start = datetime.datetime.now(pytz.utc)
+        # start climb
+        climb = start_climb(stairwell, direction, time.time(),
+                            g.user['time_zone'])
         
-        workout = {
-            'activity_type_id': 133,
-            'name': workout_name,
-            'start_datetime': workout_start,
-            'start_locale_timezone': session['user']['time_zone'],
-            'stairwell_id': stairwell_id,
-            'notes': 'climbed %s' % stairwell.name,
-            'number_of_steps':  stairwell.number_of_steps,
-            'direction': direction
-            }
-        
-        session['workout'] = workout
+        set_active_climb(session.sid, climb)
         
     else:
 
-        workout_start = workout["start_datetime"]
-        
-        # convert back to UTC as pickle lost timezone
-        workout_start = datetime.datetime(workout_start.year,
-                            workout_start.month, workout_start.day,
-                            workout_start.hour, workout_start.minute,
-                            workout_start.second, tzinfo=pytz.utc)
-        
         # only save if scan the top or bottom
-        if direction != workout["direction"]:
-            
-            now = datetime.datetime.now(pytz.utc)
-            
-            # delta in seconds
-            active_time_total = (now - workout_start).total_seconds()
-            
-            # build vx workout
-            fmt = '%Y-%m-%d %H:%M:%S %Z'
-            vx_workout = {
-                "start_datetime": workout_start.strftime(fmt),
-                "name": workout["name"],
-                "notes": workout.get("notes", ""),
-                "privacy": "/v7.0/privacy_option/1/",
-                "aggregates": {
-                    "active_time_total": active_time_total,
-                },
-                "time_series": {
-                    "steps": [[0, 0], 
-                              [active_time_total, workout["number_of_steps"]]]
-                },
-                "start_locale_timezone": workout["start_locale_timezone"],
-                "activity_type": "/v7.0/activity_type/%s/" \
-                                    % workout["activity_type_id"]
-                }
+        if direction != climb.direction:
             
-            logger.debug("vx_workout: %s", vx_workout)
+            # save the climb, timed from scan to scan
+            save_climbs(g.user, [(climb, climb.elapsed(), None)])
             
-            # api connection
-            mmf = MapMyFitnessAPI(
-                        app.config['MMF_API_KEY'],
-                        app.config['MMF_API_SECRET'],
-                        token_key=session["user"]["oauth_token"],
-                        token_secret=session["user"]["oauth_token_secret"]
-                        )
-        
-            vx_result = mmf.call("/workout/", http_method="POST",
-                              data=simplejson.dumps(vx_workout))
-            logger.debug("vx_result: %s", vx_result)
-            
-            # build workout
-            tz = pytz.timezone(session["user"]["time_zone"])
-            time_taken = vx_result['aggregates']['elapsed_time_total']
-            energy_burned = vx_result['aggregates']\
-                            .get('metabolic_energy_total', 0) * 0.000239005736
-                            
-            w = Workout(**{
-                        'id': vx_result['_links']['self'][0]['id'], 
-                        'workout_date': workout_start.astimezone(tz)\
-                                            .strftime('%Y-%m-%d %H:%M:%S'),
-                        'user_id': session['user']['id'],
-                        'time_taken': time_taken, 
-                        'number_of_steps': workout["number_of_steps"], 
-                        'energy_burned': energy_burned,
-                        'stairwell_id': workout["stairwell_id"],
-                        'direction': workout["direction"]
-                        })
-            
-            # add workout
-            logger.debug("Saving w:%s", w)
-            db.session.add(w)
-            db.session.commit()
-            
-            session['workout'] = None
+            clear_active_climb(session.sid)
             flash('Stair Climb Saved!', category='success')
     
             # redirect to leaderboard page
             return redirect(url_for("leaderboard"))
         
-    # add workout to context
-    context['workout'] = workout
-    
-    # calculate epcoh
-    workout_start_epoch = (workout_start \
-                           - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc))\
-                           .total_seconds()
-                           
-    context['workout_start_epoch'] = workout_start_epoch
+    # add climb to context
+    context['workout'] = climb
+    context['workout_start_epoch'] = climb.start_epoch
+    context['climb_token'] = get_climb_token(g.user['id'], climb)
+    context['server_epoch'] = time.time()
     
     # return template
     return render_template('workout.html', **context)
-    
\ No newline at end of file
+    
+
+@app.route('/workout/sync', methods=['POST'])
+@login_required
+def workout_sync():
+    """
+    Save climbs timed by the phone, several at once if it was offline.
+    Expects {"climbs": [{"client_id", "climb_token", "finish_epoch"}, ...]}
+    with the token of the climb's start and its finish on the server's 
+    clock.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('climbs'), list):
+        return jsonify(error="Expected a list of climbs"), 400
+    
+    climbs = data['climbs']
+    if len(climbs) > app.config['WORKOUT_SYNC_MAX_CLIMBS']:
+        return jsonify(error="At most %s climbs per sync" 
+                             % app.config['WORKOUT_SYNC_MAX_CLIMBS']), 400
+    
+    # save climbs
+    result, finished = sync_climbs(g.user, climbs, time.time())
+    
+    # drop the active climb once the phone finished it
+    climb = get_active_climb(session.sid)
+    if climb and any(c.stairwell_id == climb.stairwell_id
+                     and c.direction == climb.direction
+                     and c.start_epoch == climb.start_epoch
+                     for c in finished):
+        clear_active_climb(session.sid)
+    
+    # return result
+    return jsonify(**result)
+
+
+@app.route('/history')
+@login_required
+def climb_history():
+    """
+    The user's climbs, newest first.  A page is a single query of the 
+    columns shown, ?before= is the cursor of the next page.
+    """
+    page_size = app.config['CLIMB_HISTORY_PAGE_SIZE']
+    
+    # one extra row tells there is a next page
+    rows = query_workout_rows(g.user['id'], page_size + 1,
+                              before=request.args.get("before"))
+    next_url = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_url = url_for('climb_history',
+                           before=workout_rows_cursor(rows[-1]))
+    
+    # build context
+    context = {
+        'workouts': rows,
+        'top_url': url_for('climb_history') if request.args.get("before")
+                   else None,
+        'next_url': next_url
+        }
+    
+    # return template
+    return render_template('climb_history.html', **context)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""
+    Benchmark
+    ~~~~~~~~~
+    Load test of the climb -> leaderboard hot path.  Seeds a scratch
+    database, points the MapMyFitness API at a local fake, then drives
+    climbs (/workout start and finish scans) and /leaderboard reads from
+    a number of concurrent clients through the WSGI app and reports
+    latency percentiles, throughput and SQL queries per request.
+
+        $ python scripts/benchmark.py --users 500 --workouts 20000 \\
+            --concurrency 8 --requests 2000
+
+    Uses a temporary SQLite database unless --database-uri is given, which
+    is wiped, so only pass --reset with a scratch database.
+"""
+import argparse
+import BaseHTTPServer
+import datetime
+import logging
+import os
+import random
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+
+import simplejson
+
+
+# fake MapMyFitness API
+class FakeMMFHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers workout posts and user profile reads like the MMF API, after
+    `latency` seconds
+    """
+    protocol_version = 'HTTP/1.1'
+    latency = 0
+    workout_ids = iter(xrange(10 ** 9, 2 * 10 ** 9))
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, body):
+        time.sleep(self.latency)
+        body = simplejson.dumps(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        user_id = self.path.rstrip('/').split('/')[-1]
+        self.respond({
+            'username': 'user%s' % user_id,
+            'email': 'user%s@example.com' % user_id,
+            'first_name': 'User',
+            'last_name': user_id,
+            'time_zone': 'America/Chicago'
+            })
+
+    def do_POST(self):
+        vx_workout = simplejson.loads(
+                self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        with self.lock:
+            workout_id = next(self.workout_ids)
+        self.respond({
+            '_links': {'self': [{'id': str(workout_id)}]},
+            'aggregates': {
+                'metabolic_energy_total':
+                    vx_workout['aggregates']['active_time_total'] * 1000
+                }
+            })
+
+
+class FakeMMFServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_fake_mmf(latency):
+    """
+    :param float latency: seconds each fake API call takes
+    :returns: str, API url of the fake
+    """
+    FakeMMFHandler.latency = latency
+    server = FakeMMFServer(('127.0.0.1', 0), FakeMMFHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%s/v7.0' % server.server_address[1]
+
+
+# seeding
+def seed(db, users, stairwells, workouts, days):
+    """
+    Seed a scratch database with random users, stairwells and workouts,
+    then build the leaderboard rollups
+    """
+    from mapmystairs.models import DIRECTIONS, Organization, Stairwell, \
+                                   User, Workout
+    from mapmystairs.utils import rebuild_leaderboard_rollups
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.add(Organization('Benchmark'))
+    for n in range(stairwells):
+        db.session.add(Stairwell('Stairwell %s' % n, 'Austin', 'TX', 'us',
+                                 '787%02d' % n, 10, 200))
+    db.session.commit()
+
+    db.session.execute(User.__table__.insert(), [{
+        'id': user_id,
+        'username': 'user%s' % user_id,
+        'email': 'user%s@example.com' % user_id,
+        'first_name': 'User',
+        'last_name': str(user_id),
+        'time_zone': 'America/Chicago',
+        'organization_id': 1,
+        'oauth_token': 'token',
+        'oauth_token_secret': 'secret'
+        } for user_id in range(1, users + 1)])
+
+    now = datetime.datetime.now().replace(microsecond=0)
+    rows = [{
+        'id': workout_id,
+        'workout_date': now - datetime.timedelta(
+                                seconds=random.randint(0, days * 86400)),
+        'user_id': random.randint(1, users),
+        'time_taken': random.randint(40, 300),
+        'number_of_steps': 200,
+        'energy_burned': random.randint(10, 60),
+        'stairwell_id': random.randint(1, stairwells),
+        'direction': random.choice(DIRECTIONS)
+        } for workout_id in range(1, workouts + 1)]
+    for n in range(0, len(rows), 1000):
+        db.session.execute(Workout.__table__.insert(), rows[n:n + 1000])
+    db.session.commit()
+
+    rebuild_leaderboard_rollups()
+
+
+# load
+class Stats(object):
+    """
+    Latencies and query counts per request type
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.queries = {}
+        self.errors = {}
+
+    def add(self, name, latency, queries, error=False):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(latency)
+            self.queries.setdefault(name, []).append(queries)
+            if error:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def drive(app, db, args, stats):
+    """
+    Run args.requests requests from args.concurrency clients.  Each client
+    is a random user climbing with probability args.climb_ratio and
+    reading a leaderboard otherwise.
+    """
+    from flask import url_for
+    from sqlalchemy import event
+
+    counter = threading.local()
+
+    def count_query(*args):
+        counter.queries = getattr(counter, 'queries', 0) + 1
+    event.listen(db.engine, 'before_cursor_execute', count_query)
+
+    remaining = [args.requests]
+    remaining_lock = threading.Lock()
+
+    def request(client, name, url, status):
+        counter.queries = 0
+        started = time.time()
+        response = client.get(url)
+        stats.add(name, time.time() - started, counter.queries,
+                  error=response.status_code != status)
+
+    # leaderboard urls, stairwell 1 is /leaderboard
+    with app.test_request_context():
+        leaderboard_urls = [url_for('leaderboard', stairwell_id=stairwell_id,
+                                    window=window)
+                            for stairwell_id in range(1, args.stairwells + 1)
+                            for window in (None, None, 'today', 'week',
+                                           'month')]
+
+    def run(user_id):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = user_id
+
+        while True:
+            with remaining_lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+
+            stairwell_id = random.randint(1, args.stairwells)
+            if random.random() < args.climb_ratio:
+                request(client, 'climb start',
+                        '/workout/%s/up' % stairwell_id, 200)
+                request(client, 'climb finish',
+                        '/workout/%s/down' % stairwell_id, 302)
+            else:
+                request(client, 'leaderboard',
+                        random.choice(leaderboard_urls), 200)
+
+    threads = [threading.Thread(target=run,
+                                args=(random.randint(1, args.users),))
+               for n in range(args.concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    event.remove(db.engine, 'before_cursor_execute', count_query)
+    return time.time() - started
+
+
+def report(stats, elapsed):
+    total = sum(len(l) for l in stats.latencies.values())
+    print "%s requests in %.1fs, %.1f requests/s" % (total, elapsed,
+                                                      total / elapsed)
+    print "%-14s %7s %7s %8s %8s %8s %9s" % ("", "count", "errors",
+                                             "p50 ms", "p95 ms", "p99 ms",
+                                             "queries")
+    for name in sorted(stats.latencies):
+        latencies = stats.latencies[name]
+        queries = stats.queries[name]
+        print "%-14s %7s %7s %8.1f %8.1f %8.1f %9.1f" % (
+                name, len(latencies), stats.errors.get(name, 0),
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 95) * 1000,
+                percentile(latencies, 99) * 1000,
+                float(sum(queries)) / len(queries))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Benchmark climbs and leaderboard reads")
+    parser.add_argument('--database-uri',
+                        help="scratch database, default a temporary SQLite")
+    parser.add_argument('--reset', action='store_true',
+                        help="allow wiping --database-uri")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--stairwells', type=int, default=3)
+    parser.add_argument('--workouts', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=120,
+                        help="spread seeded workouts over this many days")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--climb-ratio', type=float, default=0.1,
+                        help="share of requests that are climbs")
+    parser.add_argument('--mmf-latency', type=float, default=0.05,
+                        help="seconds each fake MMF API call takes")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.database_uri and not args.reset:
+        parser.error("--database-uri is wiped, pass --reset to confirm")
+    random.seed(args.seed)
+
+    # configure before the app is imported
+    tmp = tempfile.mkdtemp(prefix='mapmystairs-benchmark-')
+    os.environ['SQLALCHEMY_DATABASE_URI'] = args.database_uri \
+            or 'sqlite:///%s' % os.path.join(tmp, 'benchmark.db')
+    os.environ['CACHE_DIR'] = os.path.join(tmp, 'cache')
+    os.environ['MMF_API_URL'] = start_fake_mmf(args.mmf_latency)
+    os.environ.setdefault('MMF_API_KEY', 'benchmark')
+    os.environ.setdefault('MMF_API_SECRET', 'benchmark')
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+                                        os.path.abspath(__file__))))
+    from mapmystairs import app, db
+    logging.getLogger().setLevel(logging.WARNING)
+
+    try:
+        with app.app_context():
+            started = time.time()
+            seed(db, args.users, args.stairwells, args.workouts, args.days)
+            print "Seeded %s users, %s stairwells, %s workouts in %.1fs" % (
+                    args.users, args.stairwells, args.workouts,
+                    time.time() - started)
+
+        stats = Stats()
+        elapsed = drive(app, db, args, stats)
+        report(stats, elapsed)
+    finally:
+        shutil.rmtree(tmp, True)
+
+
+if __name__ == '__main__':
+    main()
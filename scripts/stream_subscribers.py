@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+    Leaderboard Stream Subscribers
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Simulates N lobby displays following a leaderboard stream and reports
+    how many events each received and how long delivery took.
+
+    Start the app (ie., `gunicorn -k gevent mapmystairs:app`), log in with
+    a browser and copy the value of its `session` cookie, then:
+
+        $ python scripts/stream_subscribers.py --url \\
+            http://localhost:8000/stream/leaderboard/1 \\
+            --session <cookie> --subscribers 200 --duration 60
+
+    and climb (or import workouts) while it runs.
+"""
+import argparse
+import threading
+import time
+
+import requests
+import simplejson
+
+
+class Subscriber(threading.Thread):
+    """
+    One display reading the event stream until `stop_at`
+    """
+
+    def __init__(self, url, cookies, stop_at):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.url = url
+        self.cookies = cookies
+        self.stop_at = stop_at
+        self.connected = False
+        self.events = []
+        self.latencies = []
+        self.error = None
+
+    def run(self):
+        try:
+            response = requests.get(self.url, cookies=self.cookies,
+                                    stream=True, timeout=(5, 30))
+            response.raise_for_status()
+            self.connected = True
+
+            event_type = None
+            for line in response.iter_lines(chunk_size=1):
+                if time.time() > self.stop_at:
+                    break
+
+                if line.startswith('event: '):
+                    event_type = line[7:]
+                elif line.startswith('data: '):
+                    event = simplejson.loads(line[6:])
+                    self.events.append(event_type)
+                    self.latencies.append(time.time() - event['time'])
+
+            response.close()
+        except Exception as e:
+            self.error = repr(e)
+
+
+def percentile(values, p):
+    """
+    :returns: the p-th percentile of values, None if empty
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Simulate displays following a leaderboard stream")
+    parser.add_argument('--url', required=True,
+                        help="leaderboard stream url")
+    parser.add_argument('--session',
+                        help="session cookie of a logged in user")
+    parser.add_argument('--subscribers', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=30,
+                        help="seconds to listen")
+    args = parser.parse_args()
+
+    cookies = {'session': args.session} if args.session else {}
+    stop_at = time.time() + args.duration
+
+    subscribers = [Subscriber(args.url, cookies, stop_at)
+                   for n in range(args.subscribers)]
+    for subscriber in subscribers:
+        subscriber.start()
+
+    # streams only end on an event or keep-alive after stop_at
+    for subscriber in subscribers:
+        subscriber.join(max(stop_at - time.time(), 0) + 35)
+
+    # report
+    connected = [s for s in subscribers if s.connected]
+    errors = [s.error for s in subscribers if s.error]
+    events = [len(s.events) for s in connected]
+    latencies = [l for s in connected for l in s.latencies]
+
+    print "subscribers: %s connected of %s, %s errors" % (
+            len(connected), len(subscribers), len(errors))
+    if errors:
+        print "first error: %s" % errors[0]
+    if events:
+        print "events per subscriber: min %s max %s" % (min(events),
+                                                        max(events))
+    if latencies:
+        print "delivery latency: p50 %.3fs p95 %.3fs max %.3fs" % (
+                percentile(latencies, 50), percentile(latencies, 95),
+                max(latencies))
+
+
+if __name__ == '__main__':
+    main()
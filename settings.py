@@ -3,10 +3,167 @@
     ~~~~~~~~
 """
 import os
+import tempfile
+
+# Logging, DEBUG logs every request and slows them down
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
 
 # "https://api.mapmyapi.com/v7.0"
 MMF_API_KEY = os.environ['MMF_API_KEY']
 MMF_API_SECRET = os.environ['MMF_API_SECRET']
+MMF_API_URL = os.environ.get('MMF_API_URL')  # ie., a local stub server
+MMF_API_POOL_SIZE = int(os.environ.get('MMF_API_POOL_SIZE', 10))
+MMF_API_CONNECT_TIMEOUT = float(os.environ.get('MMF_API_CONNECT_TIMEOUT',
+                                               3.05))  # seconds
+MMF_API_READ_TIMEOUT = float(os.environ.get('MMF_API_READ_TIMEOUT', 10))
 
 # SQLAlchemy
-SQLALCHEMY_DATABASE_URI = os.environ['SQLALCHEMY_DATABASE_URI']
\ No newline at end of file
+SQLALCHEMY_DATABASE_URI = os.environ['SQLALCHEMY_DATABASE_URI']
+# connection pool of each engine, None uses the Flask-SQLAlchemy defaults
+# (10 connections recycled every 2 hours on MySQL)
+SQLALCHEMY_POOL_SIZE = int(os.environ['SQLALCHEMY_POOL_SIZE']) \
+        if os.environ.get('SQLALCHEMY_POOL_SIZE') else None
+SQLALCHEMY_MAX_OVERFLOW = int(os.environ['SQLALCHEMY_MAX_OVERFLOW']) \
+        if os.environ.get('SQLALCHEMY_MAX_OVERFLOW') else None
+SQLALCHEMY_POOL_TIMEOUT = int(os.environ['SQLALCHEMY_POOL_TIMEOUT']) \
+        if os.environ.get('SQLALCHEMY_POOL_TIMEOUT') else None  # seconds
+SQLALCHEMY_POOL_RECYCLE = int(os.environ['SQLALCHEMY_POOL_RECYCLE']) \
+        if os.environ.get('SQLALCHEMY_POOL_RECYCLE') else None  # seconds
+# test pooled connections before use, drops connections the server closed
+SQLALCHEMY_POOL_PRE_PING = os.environ.get('SQLALCHEMY_POOL_PRE_PING',
+                                          'true').lower() == 'true'
+# read replica for leaderboard and stairwell queries, see database.py, and
+# seconds after a change during which reads still go to the primary
+SQLALCHEMY_REPLICA_URI = os.environ.get('SQLALCHEMY_REPLICA_URI')
+if SQLALCHEMY_REPLICA_URI:
+    SQLALCHEMY_BINDS = {'replica': SQLALCHEMY_REPLICA_URI}
+SQLALCHEMY_REPLICA_LAG = float(os.environ.get('SQLALCHEMY_REPLICA_LAG', 5))
+
+# Workout submissions
+# workouts are posted to the MMF API by a background thread in each web
+# process, disable it when running `manage.py process_submissions` instead
+WORKOUT_SUBMISSION_WORKER = os.environ.get('WORKOUT_SUBMISSION_WORKER',
+                                           'true').lower() == 'true'
+WORKOUT_SUBMISSION_POLL_INTERVAL = float(
+        os.environ.get('WORKOUT_SUBMISSION_POLL_INTERVAL', 5))  # seconds
+WORKOUT_SUBMISSION_LEASE = int(os.environ.get('WORKOUT_SUBMISSION_LEASE',
+                                              60))  # seconds
+WORKOUT_SUBMISSION_ATTEMPTS = int(os.environ.get('WORKOUT_SUBMISSION_ATTEMPTS',
+                                                 10))
+
+# Workout sync, climbs timed by the phone and uploaded in batches
+WORKOUT_SYNC_MAX_CLIMBS = int(os.environ.get('WORKOUT_SYNC_MAX_CLIMBS', 50))
+WORKOUT_SYNC_MAX_AGE = int(os.environ.get('WORKOUT_SYNC_MAX_AGE',
+                                          7 * 86400))  # seconds
+WORKOUT_SYNC_CLOCK_SKEW = int(os.environ.get('WORKOUT_SYNC_CLOCK_SKEW',
+                                             60))  # seconds
+# synced climbs faster than this are rejected, stair races run ~0.3s
+WORKOUT_MIN_SECONDS_PER_STEP = float(
+        os.environ.get('WORKOUT_MIN_SECONDS_PER_STEP', 0.2))
+
+# Climb history, workouts per page of /history
+CLIMB_HISTORY_PAGE_SIZE = int(os.environ.get('CLIMB_HISTORY_PAGE_SIZE', 1000))
+
+# Cache
+# The default is shared by all workers on a host, use 'simple' for a per 
+# process cache or any other Flask-Cache backend (memcached, redis, ...)
+CACHE_TYPE = os.environ.get('CACHE_TYPE',
+                            'mapmystairs.caching.lrufilesystem')
+CACHE_DIR = os.environ.get('CACHE_DIR',
+                           os.path.join(tempfile.gettempdir(), 'mapmystairs'))
+CACHE_THRESHOLD = int(os.environ.get('CACHE_THRESHOLD', 2000))  # entries
+CACHE_KEY_PREFIX = os.environ.get('CACHE_KEY_PREFIX', 'mapmystairs_')
+if os.environ.get('CACHE_MEMCACHED_SERVERS'):
+    CACHE_MEMCACHED_SERVERS = os.environ['CACHE_MEMCACHED_SERVERS'].split(',')
+if os.environ.get('CACHE_REDIS_URL'):
+    CACHE_REDIS_URL = os.environ['CACHE_REDIS_URL']
+
+# Leaderboard cache
+# boards are invalidated when a workout is saved so they can live long
+LEADERBOARD_CACHE_TIMEOUT = int(os.environ.get('LEADERBOARD_CACHE_TIMEOUT',
+                                               60 * 60 * 24))  # 1 day
+# how long a recompute may hold the lock / others wait for it (seconds)
+LEADERBOARD_LOCK_TIMEOUT = int(os.environ.get('LEADERBOARD_LOCK_TIMEOUT', 30))
+LEADERBOARD_LOCK_WAIT = float(os.environ.get('LEADERBOARD_LOCK_WAIT', 5))
+# number of fastest climbs shown per direction
+LEADERBOARD_PODIUM_SIZE = int(os.environ.get('LEADERBOARD_PODIUM_SIZE', 3))
+# rows per leaderboard page, users shown above and below your rank
+LEADERBOARD_PAGE_SIZE = int(os.environ.get('LEADERBOARD_PAGE_SIZE', 25))
+LEADERBOARD_RANK_NEIGHBOURS = int(
+        os.environ.get('LEADERBOARD_RANK_NEIGHBOURS', 5))
+# daily leaderboard buckets older than this are compacted per month
+LEADERBOARD_BUCKET_RETENTION_DAYS = int(
+        os.environ.get('LEADERBOARD_BUCKET_RETENTION_DAYS', 90))
+# all-time boards served after a restart until they're recomputed, an 
+# empty path turns the snapshot off (see mapmystairs/snapshot.py)
+LEADERBOARD_SNAPSHOT_PATH = os.environ.get(
+        'LEADERBOARD_SNAPSHOT_PATH',
+        os.path.join(tempfile.gettempdir(),
+                     'mapmystairs-leaderboard.snapshot'))
+LEADERBOARD_SNAPSHOT_INTERVAL = int(
+        os.environ.get('LEADERBOARD_SNAPSHOT_INTERVAL', 600))  # seconds, 0=off
+
+# Sessions and active climbs, in their own cache so they're never evicted
+# for leaderboards.  The default never evicts live sessions, on more than
+# one host use a shared backend that doesn't evict either (ie., redis with
+# maxmemory-policy noeviction)
+SESSION_CACHE_TYPE = os.environ.get('SESSION_CACHE_TYPE',
+                                    'mapmystairs.caching.sessionfilesystem')
+SESSION_CACHE_DIR = os.environ.get(
+        'SESSION_CACHE_DIR',
+        os.path.join(tempfile.gettempdir(), 'mapmystairs-sessions'))
+
+# Sessions, seconds an unfinished climb is kept before it expires
+ACTIVE_CLIMB_TIMEOUT = int(os.environ.get('ACTIVE_CLIMB_TIMEOUT', 3600))
+
+# User identity cache, see mapmystairs/identity.py
+USER_IDENTITY_CACHE_SIZE = int(
+        os.environ.get('USER_IDENTITY_CACHE_SIZE', 1000))
+USER_IDENTITY_TTL = int(os.environ.get('USER_IDENTITY_TTL', 60))
+USER_IDENTITY_CACHE_TIMEOUT = int(
+        os.environ.get('USER_IDENTITY_CACHE_TIMEOUT', 7 * 86400))
+USER_PROFILE_MAX_AGE = int(os.environ.get('USER_PROFILE_MAX_AGE', 86400))
+USER_PROFILE_REFRESH_INTERVAL = int(
+        os.environ.get('USER_PROFILE_REFRESH_INTERVAL', 300))
+
+# Stairwell registry, seconds between checks for stairwell changes
+STAIRWELL_REGISTRY_CHECK_INTERVAL = int(
+        os.environ.get('STAIRWELL_REGISTRY_CHECK_INTERVAL', 10))
+
+# Leaderboard stream, see mapmystairs/stream.py
+LEADERBOARD_STREAM_POLL_INTERVAL = float(
+        os.environ.get('LEADERBOARD_STREAM_POLL_INTERVAL', 1.0))
+LEADERBOARD_STREAM_KEEPALIVE = int(
+        os.environ.get('LEADERBOARD_STREAM_KEEPALIVE', 15))
+LEADERBOARD_STREAM_EVENT_TIMEOUT = int(
+        os.environ.get('LEADERBOARD_STREAM_EVENT_TIMEOUT', 300))
+
+# Admins, comma separated MMF user ids allowed on the /admin pages
+ADMIN_USER_IDS = set(int(user_id) for user_id
+                     in os.environ.get('ADMIN_USER_IDS', '').split(',')
+                     if user_id.strip())
+
+# Slow query log, see mapmystairs/profiler.py
+# logs statements slower than the threshold (seconds) with their EXPLAIN
+# plan and keeps the latest samples for /admin/slow-queries
+SQL_PROFILER = os.environ.get('SQL_PROFILER', 'false').lower() == 'true'
+SQL_PROFILER_THRESHOLD = float(os.environ.get('SQL_PROFILER_THRESHOLD',
+                                              0.1))
+SQL_PROFILER_SAMPLES = int(os.environ.get('SQL_PROFILER_SAMPLES', 100))
+SQL_PROFILER_EXPLAIN = os.environ.get('SQL_PROFILER_EXPLAIN',
+                                      'true').lower() == 'true'
+
+# Metrics, see mapmystairs/metrics.py
+# serve /metrics for Prometheus, and add a Server-Timing header to responses
+METRICS_ENDPOINT = os.environ.get('METRICS_ENDPOINT',
+                                  'false').lower() == 'true'
+# scrapers send it as "Authorization: Bearer <token>", required behind a
+# proxy like the Heroku router
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# addresses allowed to scrape /metrics directly without a token
+METRICS_ALLOWED_IPS = set(ip.strip() for ip
+                          in os.environ.get('METRICS_ALLOWED_IPS',
+                                            '127.0.0.1').split(',')
+                          if ip.strip())
+METRICS_SERVER_TIMING = os.environ.get('METRICS_SERVER_TIMING',
+                                       'false').lower() == 'true'